@@ -0,0 +1,442 @@
+#!/usr/bin/python
+
+# This script streams a drawing to the Escher over serial, so that
+# drawings of any size can be run without compiling them into the
+# firmware or copying them to SPIFFS. The G-code is run through the
+# usual gcoderip.py pipeline and the waypoints are sent in binary
+# frames with a sliding window of unacknowledged frames.
+#
+#   ./escherstream.py --port /dev/cu.SLAB_USBtoUART bb8.gcode
+#   ./escherstream.py --simulate --loss 0.02 bb8.gcode
+#
+# Each frame is:
+#
+#   0xE5 0xC4                 sync bytes
+#   type   (uint8)            FRAME_DATA, FRAME_END or FRAME_ACK
+#   seq    (uint16)           sequence number, wrapping at 65536
+#   length (uint16)           payload length, at most MAX_PAYLOAD
+#   payload
+#   crc    (uint16)           CRC-CCITT (0xFFFF start) of type..payload
+#
+# all little-endian. A DATA payload is a run of waypoints in
+# gcoderip.packPoints format, the first of them absolute, so every frame
+# stands on its own. END follows the last DATA frame. The device accepts
+# frames strictly in order, ignoring anything else, and answers every
+# frame it sees with an ACK whose seq is the next one it expects. The
+# host keeps up to --window frames in flight, resending from the oldest
+# unacknowledged frame on a timeout or on the first repeated ACK.
+#
+# --simulate runs the device end in a thread on a local pty, so that
+# throughput and recovery from lost or corrupted frames can be tried
+# without hardware.
+#
+# Instead of G-code, a manifest written by gcoderip.py --manifest can be
+# streamed, starting from any chunk with --resume. If the device stops
+# answering, the last chunk it acknowledged in full is reported, so the
+# drawing can be picked up from the one after.
+#
+#   ./escherstream.py --port /dev/cu.SLAB_USBtoUART --manifest relativity.json
+#   ./escherstream.py --port /dev/cu.SLAB_USBtoUART --manifest relativity.json \
+#       --resume 12
+
+from __future__ import division, print_function
+
+import argparse
+import binascii
+import fileinput
+import json
+import os
+import random
+import select
+import struct
+import sys
+import threading
+import time
+
+try:
+  import serial
+except ImportError:
+  serial = None
+
+import gcoderip
+
+SYNC = b'\xe5\xc4'
+FRAME_HEADER = struct.Struct('<BHH')
+FRAME_CRC = struct.Struct('<H')
+FRAME_DATA = 1
+FRAME_END = 2
+FRAME_ACK = 3
+MAX_PAYLOAD = 1024
+SEQ_MODULUS = 0x10000
+
+# Default baud rate, as set up by Serial.begin() in Escher.ino.
+BAUD = 115200
+
+
+def frameCrc(body):
+  return binascii.crc_hqx(bytes(body), 0xffff)
+
+
+# Encode one frame as bytes.
+def encodeFrame(kind, seq, payload=b''):
+  body = FRAME_HEADER.pack(kind, seq % SEQ_MODULUS, len(payload)) + \
+      bytes(payload)
+  return SYNC + body + FRAME_CRC.pack(frameCrc(body))
+
+
+# Incrementally pulls frames out of a byte stream. Bytes before a sync
+# pattern and frames that fail their CRC are skipped, and counted.
+class FrameReader(object):
+  def __init__(self):
+    self.buffer = bytearray()
+    self.skipped = 0
+    self.crc_errors = 0
+
+  # Add data, returning a list of the (type, seq, payload) frames now
+  # complete.
+  def feed(self, data):
+    self.buffer.extend(data)
+    frames = []
+    buf = self.buffer
+    while True:
+      start = buf.find(SYNC)
+      if start < 0:
+        # Keep a last byte that might be the start of a sync pattern.
+        keep = 1 if buf[-1:] == SYNC[:1] else 0
+        self.skipped += len(buf) - keep
+        del buf[:len(buf) - keep]
+        break
+      if start > 0:
+        self.skipped += start
+        del buf[:start]
+      if len(buf) < len(SYNC) + FRAME_HEADER.size:
+        break
+      (kind, seq, length) = FRAME_HEADER.unpack_from(bytes(buf), len(SYNC))
+      if length > MAX_PAYLOAD:
+        # Not really a frame; look for the next sync pattern.
+        self.skipped += 1
+        del buf[:1]
+        continue
+      end = len(SYNC) + FRAME_HEADER.size + length
+      if len(buf) < end + FRAME_CRC.size:
+        break
+      (crc,) = FRAME_CRC.unpack_from(bytes(buf), end)
+      if crc != frameCrc(buf[len(SYNC):end]):
+        self.crc_errors += 1
+        del buf[:1]
+        continue
+      frames.append((kind, seq, bytes(buf[end - length:end])))
+      del buf[:end + FRAME_CRC.size]
+    return frames
+
+
+# A serial port on a raw POSIX file descriptor, used when pyserial is
+# not installed (and for the simulator's end of the pty).
+class FdPort(object):
+  def __init__(self, fd, timeout=0.05):
+    import tty
+    self.fd = fd
+    self.timeout = timeout
+    tty.setraw(fd)
+
+  @classmethod
+  def open(cls, path, timeout=0.05):
+    return cls(os.open(path, os.O_RDWR | os.O_NOCTTY), timeout)
+
+  def read(self, size=4096):
+    (ready, _, _) = select.select([self.fd], [], [], self.timeout)
+    if not ready:
+      return b''
+    return os.read(self.fd, size)
+
+  def write(self, data):
+    data = memoryview(bytes(data))
+    while len(data):
+      data = data[os.write(self.fd, data):]
+
+  def close(self):
+    os.close(self.fd)
+
+
+# Open the serial port at path, with pyserial if it is available.
+def openPort(path, baud=BAUD, timeout=0.05):
+  if serial is not None:
+    return serial.Serial(path, baud, timeout=timeout)
+  return FdPort.open(path, timeout)
+
+
+# Read whatever has arrived on port, waiting up to its timeout.
+def readAvailable(port):
+  if not hasattr(port, 'in_waiting'):
+    return port.read(4096)
+  return port.read(max(port.in_waiting, 1))
+
+
+# Split waypoints into DATA frame payloads of up to points_per_frame
+# points each.
+def framePayloads(waypoints, points_per_frame=64):
+  waypoints = list(waypoints)
+  payloads = []
+  for i in range(0, len(waypoints), points_per_frame):
+    payload = gcoderip.packPoints(waypoints[i:i+points_per_frame])
+    if len(payload) > MAX_PAYLOAD:
+      raise ValueError('%d points do not fit in a frame' % points_per_frame)
+    payloads.append(payload)
+  return payloads
+
+
+# Send waypoints to the device on port, returning a dict of statistics.
+# Raises IOError if the device stops answering for give_up seconds. If
+# progress is given, it is called with the number of points the device
+# has acknowledged whenever that goes up.
+def streamWaypoints(port, waypoints, window=8, points_per_frame=64,
+                    timeout=0.2, give_up=10.0, progress=None):
+  if not 0 < window < SEQ_MODULUS // 2:
+    raise ValueError('window must be between 1 and %d' % (SEQ_MODULUS // 2 - 1))
+  frames = [encodeFrame(FRAME_DATA, seq, payload) for (seq, payload) in
+            enumerate(framePayloads(waypoints, points_per_frame))]
+  frames.append(encodeFrame(FRAME_END, len(frames)))
+  stats = {'points': len(waypoints), 'frames': len(frames), 'bytes': 0,
+           'retransmits': 0, 'timeouts': 0, 'fast_retransmits': 0}
+  reader = FrameReader()
+  start = time.time()
+  base = 0          # Oldest unacknowledged frame.
+  nextframe = 0     # Next frame to send.
+  deadline = None   # When to give up waiting for frame base.
+  fast = None       # The base we have already fast-retransmitted for.
+  heard = start
+  while base < len(frames):
+    while nextframe < len(frames) and nextframe < base + window:
+      port.write(frames[nextframe])
+      stats['bytes'] += len(frames[nextframe])
+      if nextframe == base:
+        deadline = time.time() + timeout
+      nextframe += 1
+
+    resend = False
+    for (kind, seq, payload) in reader.feed(readAvailable(port)):
+      if kind != FRAME_ACK:
+        continue
+      heard = time.time()
+      advance = (seq - base) % SEQ_MODULUS
+      if 0 < advance <= nextframe - base:
+        base += advance
+        deadline = time.time() + timeout if base < nextframe else None
+        if progress is not None:
+          progress(min(base * points_per_frame, len(waypoints)))
+      elif advance == 0 and fast != base and nextframe > base:
+        # The device got something after a frame that went missing.
+        fast = base
+        stats['fast_retransmits'] += 1
+        resend = True
+
+    now = time.time()
+    if deadline is not None and now > deadline:
+      stats['timeouts'] += 1
+      resend = True
+    if resend:
+      stats['retransmits'] += nextframe - base
+      nextframe = base
+      deadline = None
+    if now - heard > give_up:
+      raise IOError('no answer from device for %.0f seconds' % give_up)
+
+  stats['seconds'] = time.time() - start
+  stats['crc_errors'] = reader.crc_errors
+  return stats
+
+
+# The device end of the protocol, run in a thread on a port. Received
+# points are collected in .points. Frames arriving from the host are
+# dropped with probability loss, bytes are corrupted with probability
+# corrupt, and ACKs going back are dropped with probability loss. If
+# baud is given, reading is slowed down to that line rate.
+class EscherSimulator(object):
+  def __init__(self, port, loss=0.0, corrupt=0.0, baud=None, seed=None):
+    self.port = port
+    self.loss = loss
+    self.corrupt = corrupt
+    self.baud = baud
+    self.random = random.Random(seed)
+    self.points = []
+    self.done = False
+    self.reader = FrameReader()
+    self.dropped = 0
+    self.keep_open = []
+    self._expected = 0
+    self._stop = threading.Event()
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+
+  def start(self):
+    self._thread.start()
+    return self
+
+  def stop(self):
+    self._stop.set()
+    self._thread.join()
+    self.port.close()
+    for fd in self.keep_open:
+      os.close(fd)
+
+  def _damage(self, data):
+    if not self.corrupt:
+      return data
+    data = bytearray(data)
+    for i in range(len(data)):
+      if self.random.random() < self.corrupt:
+        data[i] ^= 1 << self.random.randrange(8)
+    return data
+
+  def _run(self):
+    while not self._stop.is_set():
+      data = self.port.read(4096)
+      if not data:
+        continue
+      if self.baud:
+        # Ten bits per byte on the wire.
+        time.sleep(len(data) * 10.0 / self.baud)
+      for (kind, seq, payload) in self.reader.feed(self._damage(data)):
+        if self.random.random() < self.loss:
+          self.dropped += 1
+          continue
+        if seq == self._expected % SEQ_MODULUS and not self.done:
+          if kind == FRAME_DATA:
+            self.points += gcoderip.unpackPoints(payload)
+          elif kind == FRAME_END:
+            self.done = True
+          self._expected += 1
+        if self.random.random() < self.loss:
+          self.dropped += 1
+          continue
+        self.port.write(encodeFrame(FRAME_ACK, self._expected))
+
+
+# Open a pty with an EscherSimulator on one end. Returns the simulator
+# and the path of the other end for the host to open.
+def startSimulator(**kwargs):
+  import pty
+  import tty
+  (master, slave) = pty.openpty()
+  tty.setraw(slave)
+  simulator = EscherSimulator(FdPort(master), **kwargs)
+  # Keep the host's end open too, so the pty outlives the host closing it.
+  simulator.keep_open.append(slave)
+  return (simulator.start(), os.ttyname(slave))
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Stream a G-code drawing to the Escher over serial.')
+  parser.add_argument('--port', metavar='PATH',
+                      help='Serial port the Escher is on')
+  parser.add_argument('--baud', type=int, default=BAUD,
+                      help='Serial baud rate')
+  parser.add_argument('--window', type=int, default=8, metavar='FRAMES',
+                      help='Frames to send before waiting for an ACK')
+  parser.add_argument('--frame-points', type=int, default=64,
+                      metavar='POINTS', help='Waypoints per frame')
+  parser.add_argument('--timeout', type=float, default=0.2, metavar='SECONDS',
+                      help='Resend unacknowledged frames after this long')
+  parser.add_argument('--simulate', action='store_true',
+                      help='Stream to a simulated Escher on a local pty')
+  parser.add_argument('--loss', type=float, default=0.0, metavar='P',
+                      help='With --simulate, drop this fraction of frames')
+  parser.add_argument('--corrupt', type=float, default=0.0, metavar='P',
+                      help='With --simulate, corrupt this fraction of bytes')
+  parser.add_argument('--sim-baud', type=int, metavar='BAUD',
+                      help='With --simulate, limit the simulated line rate')
+  parser.add_argument('--manifest', metavar='FILE',
+                      help='Stream the chunks in a gcoderip.py --manifest '
+                           'file instead of G-code')
+  parser.add_argument('--resume', type=int, default=0, metavar='CHUNK',
+                      help='With --manifest, start from this chunk')
+  parser.add_argument('--chord-error', type=float, metavar='STEPS',
+                      help='As for gcoderip.py')
+  parser.add_argument('--simplify', type=float, metavar='STEPS',
+                      help='As for gcoderip.py')
+  parser.add_argument('--reorder', action='store_true',
+                      help='As for gcoderip.py')
+  parser.add_argument('files', nargs='*',
+                      help='G-code files to read (default: stdin)')
+  args = parser.parse_args()
+  if bool(args.port) == args.simulate:
+    parser.error('give exactly one of --port and --simulate')
+
+  if args.resume and not args.manifest:
+    parser.error('--resume needs --manifest')
+  if not 0 < args.window < SEQ_MODULUS // 2:
+    parser.error('--window must be between 1 and %d' % (SEQ_MODULUS // 2 - 1))
+  if args.frame_points < 1:
+    parser.error('--frame-points must be at least 1')
+
+  progress = None
+  if args.manifest:
+    try:
+      with open(args.manifest) as f:
+        manifest = json.load(f)
+      if not 0 <= args.resume < len(manifest['chunks']):
+        parser.error('--resume must be a chunk from 0 to %d' %
+                     (len(manifest['chunks']) - 1))
+      waypoints = gcoderip.resumePoints(manifest, args.resume)
+    except (IOError, ValueError, KeyError) as e:
+      parser.error('bad --manifest %s: %s' % (args.manifest, e))
+    # Where waypoints[0] is in the whole drawing, and how far it has got.
+    offset = manifest['chunks'][args.resume]['first'] - (args.resume > 0)
+    done = {'chunk': args.resume - 1}
+    def chunkProgress(acked):
+      while done['chunk'] + 1 < len(manifest['chunks']):
+        chunk = manifest['chunks'][done['chunk'] + 1]
+        if chunk['first'] + chunk['count'] > offset + acked:
+          break
+        done['chunk'] += 1
+    progress = chunkProgress
+  else:
+    try:
+      waypoints = gcoderip.processGcode(fileinput.input(args.files),
+                                        chord_error=args.chord_error,
+                                        simplify=args.simplify,
+                                        reorder=args.reorder)
+    except ValueError as e:
+      print('%s: %s' % (' '.join(args.files) or '<stdin>', e),
+            file=sys.stderr)
+      sys.exit(1)
+  simulator = None
+  if args.simulate:
+    (simulator, path) = startSimulator(loss=args.loss, corrupt=args.corrupt,
+                                       baud=args.sim_baud)
+  else:
+    path = args.port
+  port = openPort(path, args.baud)
+  try:
+    stats = streamWaypoints(port, waypoints, args.window, args.frame_points,
+                            args.timeout, progress=progress)
+  except IOError as e:
+    if progress is None:
+      raise
+    print('%s after chunk %d of %d; rerun with --resume %d' %
+          (e, done['chunk'], len(manifest['chunks']), done['chunk'] + 1),
+          file=sys.stderr)
+    sys.exit(1)
+  finally:
+    port.close()
+    if simulator:
+      simulator.stop()
+
+  print('Sent %d points in %d frames (%d bytes) in %.2fs: %.0f points/s' %
+        (stats['points'], stats['frames'], stats['bytes'], stats['seconds'],
+         stats['points'] / max(stats['seconds'], 1e-9)), file=sys.stderr)
+  print('%d frames resent (%d timeouts, %d fast), %d bad ACKs' %
+        (stats['retransmits'], stats['timeouts'], stats['fast_retransmits'],
+         stats['crc_errors']), file=sys.stderr)
+  if simulator:
+    ok = simulator.done and simulator.points == list(waypoints)
+    print('Simulator got %d points (%s), dropped %d frames, %d CRC errors' %
+          (len(simulator.points), 'all correct' if ok else 'MISMATCH',
+           simulator.dropped, simulator.reader.crc_errors), file=sys.stderr)
+    if not ok:
+      sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
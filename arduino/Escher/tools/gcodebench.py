@@ -0,0 +1,1527 @@
+#!/usr/bin/python
+
+# Benchmarks and consistency checks for gcoderip.py, run over the
+# bundled *.gcode drawings (or any files given on the command line).
+#
+#   ./gcodebench.py                 # run everything
+#   ./gcodebench.py parse           # run a single benchmark
+#   ./gcodebench.py parse bb8.gcode # ... on a single drawing
+
+from __future__ import division, print_function
+
+import argparse
+import base64
+import glob
+import io
+import json
+import math
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+import gcoderip
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# The original point-at-a-time arc interpolator.
+def legacyDoArc(posx, posy, x, y, cx, cy, cw, CM_PER_SEGMENT=0.1):
+  retval = []
+  dx = posx - cx
+  dy = posy - cy
+  radius = math.sqrt((dx*dx)+(dy*dy))
+  angle1 = gcoderip.atan3(posy - cy, posx - cx)
+  angle2 = gcoderip.atan3(y - cy, x - cx)
+  sweep = angle2 - angle1
+  if sweep < 0 and cw:
+    angle2 += 2.0 * math.pi
+  elif sweep > 0 and not cw:
+    angle1 += 2.0 * math.pi
+  sweep = angle2 - angle1
+  l = abs(sweep) * radius
+  num_segments = int(math.floor( l / CM_PER_SEGMENT ))
+  for i in range(num_segments):
+    fraction = (i * 1.0) / (num_segments * 1.0)
+    angle3 = (sweep * fraction) + angle1
+    nx = cx + math.cos(angle3) * radius
+    ny = cy + math.sin(angle3) * radius
+    retval.append((nx, ny))
+  retval.append((x, y))
+  return retval
+
+
+# The original two-regex parser, kept as a reference for comparison.
+def legacyParseGcode(input):
+  waypoints = []
+
+  for line in input:
+    m = re.match(r'(G0[01]) X([\d\.]+) Y([\d\.]+)', line)
+    if m:
+      x = float(m.group(2))
+      y = float(m.group(3))
+      waypoints.append((x, y))
+
+    m = re.match(r'(G0[23]) X([-\d\.]+) Y([-\d\.]+) (Z[-\d\.]+)? I([-\d\.]+) J([-\d\.]+)', line)
+    if m:
+      if len(waypoints) == 0:
+        continue
+      (curx, cury) = waypoints[-1]
+      x = float(m.group(2))
+      y = float(m.group(3))
+      i = float(m.group(5))
+      j = float(m.group(6))
+      cw = m.group(1) == 'G03'
+      curve = legacyDoArc(curx, cury, x, y, curx+i, cury+j, cw)
+      for pt in curve:
+        waypoints.append(pt)
+
+  if waypoints[-1] == (0., 0.):
+    waypoints = waypoints[:-1]
+
+  return waypoints
+
+
+# Just the lexing half of legacyParseGcode: the same two regexes and float
+# conversions, without interpolating arcs. Compared against tokenizeGcode.
+def legacyLexGcode(input):
+  words = []
+  for line in input:
+    m = re.match(r'(G0[01]) X([\d\.]+) Y([\d\.]+)', line)
+    if m:
+      words.append((float(m.group(2)), float(m.group(3))))
+    m = re.match(r'(G0[23]) X([-\d\.]+) Y([-\d\.]+) (Z[-\d\.]+)? I([-\d\.]+) J([-\d\.]+)', line)
+    if m:
+      words.append((float(m.group(2)), float(m.group(3)),
+                    float(m.group(5)), float(m.group(6))))
+  return words
+
+
+# The original conversion from end to end: legacyParseGcode, then the
+# original scaleToScreen and removeDuplicates on the scaled floats, then
+# truncating to whole steps as the header did. gcoderip now
+# deduplicates after truncating, so its points are these with the
+# repeats that truncation makes removed.
+def legacyProcessGcode(input):
+  pts = legacyParseGcode(input)
+  minx = min([x for (x, y) in pts])
+  maxx = max([x for (x, y) in pts])
+  miny = min([y for (x, y) in pts])
+  maxy = max([y for (x, y) in pts])
+  dx = maxx - minx
+  dy = maxy - miny
+  if dx > dy:
+    scale = gcoderip.WIDTH_STEPS / dx
+  else:
+    scale = gcoderip.HEIGHT_STEPS / dy
+  scaled = []
+  for (x, y) in pts:
+    scaled.append([(x-minx) * scale, (y-miny) * scale])
+  prev = None
+  ret = []
+  for point in scaled:
+    if prev == None or point != prev:
+      prev = point
+      ret.append((int(point[0]), int(point[1])))
+  return ret
+
+
+# Return the best wall time of repeat calls to fn().
+def timeit(fn, repeat):
+  best = None
+  for _ in range(repeat):
+    start = time.time()
+    fn()
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+
+def readLines(fn):
+  with open(fn) as f:
+    return f.readlines()
+
+
+def benchParse(files, repeat):
+  print('%-20s %8s %8s %10s %10s %8s %10s %10s %8s' %
+        ('file', 'lines', 'points', 'legacy ms', 'new ms', 'speedup',
+         'lex ms', 'token ms', 'speedup'))
+  totals = [0.0] * 4
+  ok = True
+  for fn in files:
+    lines = readLines(fn)
+    old = legacyParseGcode(lines)
+    new = gcoderip.parseGcode(lines)
+    if old != new:
+      print('MISMATCH: %s (%d vs %d points)' % (fn, len(old), len(new)))
+      ok = False
+    times = (timeit(lambda: legacyParseGcode(lines), repeat),
+             timeit(lambda: gcoderip.parseGcode(lines), repeat),
+             timeit(lambda: legacyLexGcode(lines), repeat),
+             timeit(lambda: list(gcoderip.tokenizeGcode(lines)), repeat))
+    totals = [t + u for t, u in zip(totals, times)]
+    print('%-20s %8d %8d %10.2f %10.2f %7.2fx %10.2f %10.2f %7.2fx' %
+          (os.path.basename(fn), len(lines), len(new),
+           times[0] * 1000, times[1] * 1000, times[0] / max(times[1], 1e-9),
+           times[2] * 1000, times[3] * 1000, times[2] / max(times[3], 1e-9)))
+  print('%-20s %8s %8s %10.2f %10.2f %7.2fx %10.2f %10.2f %7.2fx' %
+        ('total', '', '',
+         totals[0] * 1000, totals[1] * 1000, totals[0] / max(totals[1], 1e-9),
+         totals[2] * 1000, totals[3] * 1000, totals[2] / max(totals[3], 1e-9)))
+  return ok
+
+
+# Time the whole conversion, G-code lines to whole steps, against the
+# original, checking they give the same points once the original's
+# truncated repeats are removed.
+def benchProcess(files, repeat):
+  print('%-20s %8s %8s %10s %10s %8s' %
+        ('file', 'lines', 'points', 'legacy ms', 'new ms', 'speedup'))
+  (total_old, total_new) = (0.0, 0.0)
+  ok = True
+  for fn in files:
+    lines = readLines(fn)
+    old = legacyProcessGcode(lines)
+    new = gcoderip.processGcode(lines)
+    if new != gcoderip.removeDuplicates(old):
+      print('MISMATCH: %s (%d vs %d points)' % (fn, len(old), len(new)))
+      ok = False
+    t_old = timeit(lambda: legacyProcessGcode(lines), repeat)
+    t_new = timeit(lambda: gcoderip.processGcode(lines), repeat)
+    total_old += t_old
+    total_new += t_new
+    print('%-20s %8d %8d %10.2f %10.2f %7.2fx' %
+          (os.path.basename(fn), len(lines), len(new), t_old * 1000,
+           t_new * 1000, t_old / max(t_new, 1e-9)))
+  print('%-20s %8s %8s %10.2f %10.2f %7.2fx' %
+        ('total', '', '', total_old * 1000, total_new * 1000,
+         total_old / max(total_new, 1e-9)))
+  return ok
+
+
+# Collect every arc in a file as (start, end, center, cw) tuples.
+def collectArcs(lines):
+  arcs = []
+  cur = None
+  for cmd in gcoderip.tokenizeGcode(lines):
+    if cmd.g >= 2 and cur is not None:
+      center = (cur[0] + cmd.i, cur[1] + cmd.j)
+      arcs.append((cur, (cmd.x, cmd.y), center, cmd.g == 3))
+    cur = (cmd.x, cmd.y)
+  return arcs
+
+
+def benchArcs(files, repeat):
+  if gcoderip.np is None:
+    print('numpy is not installed, skipping')
+    return True
+  np = gcoderip.np
+  tolerance = 1e-9
+  print('%-20s %6s %8s %10s %10s %8s %10s' %
+        ('file', 'arcs', 'points', 'scalar ms', 'numpy ms', 'speedup',
+         'max error'))
+  total_old = total_new = 0.0
+  ok = True
+  for fn in files:
+    arcs = collectArcs(readLines(fn))
+    if not arcs:
+      continue
+    (starts, ends, centers, cw) = [np.array(a) for a in zip(*arcs)]
+
+    def scalar():
+      return [gcoderip.doArc(s[0], s[1], e[0], e[1], c[0], c[1], w)
+              for (s, e, c, w) in arcs]
+
+    def vector():
+      return gcoderip.doArcs(starts, ends, centers, cw)
+
+    old = scalar()
+    (new, counts) = vector()
+    if [len(pts) for pts in old] != counts.tolist():
+      print('MISMATCH: %s has different point counts' % fn)
+      ok = False
+      continue
+    err = np.abs(np.array([pt for pts in old for pt in pts]) - new).max()
+    if err > tolerance:
+      print('MISMATCH: %s differs by %g' % (fn, err))
+      ok = False
+    t_old = timeit(scalar, repeat)
+    t_new = timeit(vector, repeat)
+    total_old += t_old
+    total_new += t_new
+    print('%-20s %6d %8d %10.2f %10.2f %7.2fx %10.2g' %
+          (os.path.basename(fn), len(arcs), len(new), t_old * 1000,
+           t_new * 1000, t_old / max(t_new, 1e-9), err))
+  print('%-20s %6s %8s %10.2f %10.2f %7.2fx' %
+        ('total', '', '', total_old * 1000, total_new * 1000,
+         total_old / max(total_new, 1e-9)))
+  return ok
+
+
+# Run the default post-processing on a list of waypoints.
+def toSteps(waypoints):
+  return gcoderip.scaleToSteps(waypoints)
+
+
+def benchChord(files, repeat, chord_error=0.5):
+  print('%-20s %10s %10s %8s %10s %10s' %
+        ('file', 'fixed pts', 'chord pts', 'ratio', 'fixed ms', 'chord ms'))
+  for fn in files:
+    lines = readLines(fn)
+    fixed = toSteps(gcoderip.parseGcode(lines))
+    chord = toSteps(gcoderip.parseGcode(lines, chord_error=chord_error))
+    t_fixed = timeit(lambda: toSteps(gcoderip.parseGcode(lines)), repeat)
+    t_chord = timeit(lambda: toSteps(gcoderip.parseGcode(
+        lines, chord_error=chord_error)), repeat)
+    print('%-20s %10d %10d %7.1fx %10.2f %10.2f' %
+          (os.path.basename(fn), len(fixed), len(chord),
+           len(fixed) / float(max(len(chord), 1)),
+           t_fixed * 1000, t_chord * 1000))
+  return True
+
+
+# Distance from point p to segment ab.
+def segmentDistance(p, a, b):
+  (dx, dy) = (b[0] - a[0], b[1] - a[1])
+  (ex, ey) = (p[0] - a[0], p[1] - a[1])
+  length2 = dx*dx + dy*dy
+  t = 0.0
+  if length2 > 0:
+    t = min(1.0, max(0.0, (ex*dx + ey*dy) / length2))
+  return math.hypot(ex - t*dx, ey - t*dy)
+
+
+# Largest distance from any original point to the simplified segment
+# that replaced it. simplified must hold the same objects as pts.
+def simplifyError(pts, simplified):
+  worst = 0.0
+  k = 0
+  for pt in pts:
+    if k + 1 < len(simplified) and pt is simplified[k+1]:
+      k += 1
+      continue
+    if pt is not simplified[k]:
+      worst = max(worst, segmentDistance(pt, simplified[k], simplified[k+1]))
+  return worst
+
+
+def benchSimplify(files, repeat, tolerance=0.5):
+  print('%-20s %8s %8s %8s %8s %10s' %
+        ('file', 'before', 'after', 'ratio', 'ms', 'max error'))
+  ok = True
+  for fn in files:
+    # A list, so that simplifyError can match up the point objects.
+    pts = list(toSteps(gcoderip.parseGcode(readLines(fn))))
+    simplified = gcoderip.simplifyPath(pts, tolerance)
+    err = simplifyError(pts, simplified)
+    if err > tolerance:
+      print('MISMATCH: %s strays %g steps' % (fn, err))
+      ok = False
+    elapsed = timeit(lambda: gcoderip.simplifyPath(pts, tolerance), repeat)
+    print('%-20s %8d %8d %7.1fx %8.2f %10.3f' %
+          (os.path.basename(fn), len(pts), len(simplified),
+           len(pts) / float(max(len(simplified), 1)), elapsed * 1000, err))
+  # Tight spirals are the worst case for Ramer-Douglas-Peucker, so the
+  # time here should only double with the number of points.
+  for n in (10000, 20000, 40000):
+    pts = spiral(n)
+    simplified = gcoderip.simplifyPath(pts, tolerance)
+    err = simplifyError(pts, simplified)
+    if err > tolerance:
+      print('MISMATCH: %d point spiral strays %g steps' % (n, err))
+      ok = False
+    elapsed = timeit(lambda: gcoderip.simplifyPath(pts, tolerance), repeat)
+    print('%-20s %8d %8d %7.1fx %8.2f %10.3f' %
+          ('spiral', len(pts), len(simplified),
+           len(pts) / float(max(len(simplified), 1)), elapsed * 1000, err))
+  return ok
+
+
+# A spiral of n points in whole steps, winding out from the middle of
+# the Etch-a-Sketch one step further each turn.
+def spiral(n):
+  pts = []
+  t = 0.0
+  while len(pts) < n:
+    r = 2.0 + t / (2.0 * math.pi)
+    pt = (int(round(360 + r * math.cos(t))), int(round(250 + r * math.sin(t))))
+    if not pts or pt != pts[-1]:
+      pts.append(pt)
+    t += 0.5 / r
+  return pts
+
+
+# The undirected segments drawn by a list of subpaths, ignoring the
+# strokes between them.
+def subpathSegments(subpaths):
+  segments = []
+  for path in subpaths:
+    for (a, b) in zip(path, path[1:]):
+      segments.append(tuple(sorted((a, b))))
+  return sorted(segments)
+
+
+def benchReorder(files, repeat):
+  print('%-20s %8s %12s %12s %8s %8s' %
+        ('file', 'paths', 'travel', 'reordered', 'saved', 'ms'))
+  ok = True
+  for fn in files:
+    subpaths = gcoderip.parseSubpaths(readLines(fn))
+    if not subpaths:
+      continue
+    start = subpaths[0][0]
+    scale = gcoderip.screenScale(*gcoderip.pointBounds(
+        [pt for path in subpaths for pt in path]))
+    ordered = gcoderip.orderSubpaths(subpaths)
+    if subpathSegments(ordered) != subpathSegments(subpaths):
+      print('MISMATCH: %s draws different segments after reordering' % fn)
+      ok = False
+    before = gcoderip.pathTravel(subpaths, start) * scale
+    after = gcoderip.pathTravel(ordered, start) * scale
+    elapsed = timeit(lambda: gcoderip.orderSubpaths(subpaths), repeat)
+    print('%-20s %8d %12.0f %12.0f %7.0f%% %8.1f' %
+          (os.path.basename(fn), len(subpaths), before, after,
+           100.0 * (before - after) / max(before, 1e-9), elapsed * 1000))
+  return ok
+
+
+# Read the points back out of a pairs-format header.
+def readPairsHeader(text):
+  return [(int(x), int(y)) for (x, y) in
+          re.findall(r'make_pair\((-?\d+), (-?\d+)\)', text)]
+
+
+def benchPacked(files, repeat):
+  print('%-20s %8s %10s %10s %8s %10s' %
+        ('file', 'points', 'pair bytes', 'packed', 'ratio', 'decode ms'))
+  ok = True
+  for fn in files:
+    pts = toSteps(gcoderip.parseGcode(readLines(fn)))
+    out = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+    gcoderip.writePairsHeader(pts, out)
+    expected = readPairsHeader(out.getvalue())
+    data = gcoderip.packPoints(pts)
+    if gcoderip.unpackPoints(data) != expected:
+      print('MISMATCH: %s does not decode to the pairs header' % fn)
+      ok = False
+    elapsed = timeit(lambda: gcoderip.unpackPoints(data), repeat)
+    print('%-20s %8d %10d %10d %7.1fx %10.2f' %
+          (os.path.basename(fn), len(pts), len(pts) * 8, len(data),
+           len(pts) * 8.0 / max(len(data), 1), elapsed * 1000))
+  return ok
+
+
+def benchDrawing(files, repeat, block_size=256):
+  print('%-20s %8s %8s %10s %10s %10s' %
+        ('file', 'points', 'blocks', 'bytes', 'read ms', 'seek ms'))
+  ok = True
+  for fn in files:
+    pts = toSteps(gcoderip.parseGcode(readLines(fn)))
+    expected = [(int(x), int(y)) for (x, y) in pts]
+    f = io.BytesIO()
+    gcoderip.writeDrawing(pts, f, block_size=block_size)
+    f.seek(0)
+    (header, got) = gcoderip.readDrawing(f)
+    if got != expected or header.num_points != len(expected):
+      print('MISMATCH: %s does not round-trip' % fn)
+      ok = False
+    try:
+      gcoderip.writeDrawing(pts, io.BytesIO(),
+                            profile='x' * (gcoderip.DRAWING_PROFILE_BYTES + 1))
+      print('MISMATCH: %s wrote a truncated profile name' % fn)
+      ok = False
+    except ValueError:
+      pass
+    last = header.num_blocks - 1
+    if gcoderip.readDrawingBlock(f, header, last) != expected[last*block_size:]:
+      print('MISMATCH: %s last block differs' % fn)
+      ok = False
+
+    def read():
+      f.seek(0)
+      gcoderip.readDrawing(f)
+
+    def seek():
+      f.seek(0)
+      gcoderip.readDrawingBlock(f, gcoderip.readDrawingHeader(f), last)
+
+    print('%-20s %8d %8d %10d %10.2f %10.3f' %
+          (os.path.basename(fn), header.num_points, header.num_blocks,
+           len(f.getvalue()), timeit(read, repeat) * 1000,
+           timeit(seek, repeat) * 1000))
+  return ok
+
+
+# A file-like object that throws away everything written to it.
+class NullWriter:
+  def write(self, data):
+    pass
+
+
+# Run fn() under tracemalloc, returning (peak bytes allocated, seconds).
+def peakMemory(fn):
+  tracemalloc.start()
+  start = time.time()
+  try:
+    fn()
+    return (tracemalloc.get_traced_memory()[1], time.time() - start)
+  finally:
+    tracemalloc.stop()
+
+
+# The points in a pairs header, and its GCODE_NUM_POINTS.
+def readPairsTable(text):
+  count = re.search(r'#define GCODE_NUM_POINTS (\d+)', text)
+  return (readPairsHeader(text), int(count.group(1)) if count else None)
+
+
+# Compare the memory and time used by streamGcode with the in-memory
+# pipeline, checking that it writes exactly the points processGcode
+# gives, with and without chord_error and for a larger machine.
+def benchStream(files, repeat):
+  if tracemalloc is None:
+    print('tracemalloc is not available, skipping')
+    return True
+  print('%-20s %10s %12s %12s %10s %10s' %
+        ('file', 'KB', 'peak KB', 'stream KB', 'ms', 'stream ms'))
+  ok = True
+  for fn in files:
+    def inMemory():
+      with open(fn) as f:
+        gcoderip.writePairsHeader(gcoderip.processGcode(f), NullWriter())
+
+    def streaming():
+      gcoderip.streamGcode(fn, NullWriter())
+
+    (peak, elapsed) = peakMemory(inMemory)
+    (stream_peak, stream_elapsed) = peakMemory(streaming)
+    for (chord_error, width, height) in ((None, 720, 500), (0.5, 720, 500),
+                                         (0.5, 900, 700)):
+      out = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+      gcoderip.streamGcode(fn, out, chord_error, width, height)
+      (streamed, count) = readPairsTable(out.getvalue())
+      expected = list(gcoderip.processGcode(readLines(fn),
+                                            chord_error=chord_error,
+                                            width=width, height=height))
+      if streamed != expected or count != len(expected):
+        print('MISMATCH: %s streamed %d points, not %d, with chord error %s '
+              'at %dx%d' % (fn, len(streamed), len(expected), chord_error,
+                            width, height))
+        ok = False
+    print('%-20s %10d %12d %12d %10.1f %10.1f' %
+          (os.path.basename(fn), os.path.getsize(fn) / 1024, peak / 1024,
+           stream_peak / 1024, elapsed * 1000, stream_elapsed * 1000))
+  return ok
+
+
+def benchPng(files, repeat):
+  vectorized = gcoderip.np is not None
+  print('%-20s %8s %10s %10s %8s' %
+        ('file', 'points', 'python ms', 'numpy ms', 'png ms'))
+  ok = True
+  for fn in files:
+    pts = toSteps(gcoderip.parseGcode(readLines(fn)))
+    images = [gcoderip.rasterize(pts, vectorized=False)]
+    if vectorized:
+      images.append(gcoderip.rasterize(pts, vectorized=True))
+    for (pixels, w, h) in images:
+      # Every waypoint must have been drawn.
+      margin = 4
+      height = h - 1 - 2 * margin
+      for (x, y) in pts:
+        (px, py) = (int(x) + margin, height - int(y) + margin)
+        if pixels[py * w + px] != 0:
+          print('MISMATCH: %s is missing point (%d, %d)' % (fn, x, y))
+          ok = False
+          break
+    t_python = timeit(lambda: gcoderip.rasterize(pts, vectorized=False), repeat)
+    t_numpy = float('nan')
+    if vectorized:
+      t_numpy = timeit(lambda: gcoderip.rasterize(pts, vectorized=True), repeat)
+    t_png = timeit(lambda: gcoderip.writePng(os.devnull, images[-1]), repeat)
+    print('%-20s %8d %10.2f %10.2f %8.2f' %
+          (os.path.basename(fn), len(pts), t_python * 1000, t_numpy * 1000,
+           t_png * 1000))
+  return ok
+
+
+# Plan speeds for each file, check that they are physically possible,
+# and compare estimated draw times with the firmware's constant speed.
+def benchPlan(files, repeat):
+  a = gcoderip.PLAN_ACCELERATION
+  print('%-20s %8s %8s %10s %10s %8s' %
+        ('file', 'points', 'plan ms', 'base s', 'planned s', 'speedup'))
+  ok = True
+  for fn in files:
+    pts = toSteps(gcoderip.parseGcode(readLines(fn)))
+    speeds = gcoderip.planMotion(pts)
+    if speeds and (speeds[0] != 0 or speeds[-1] != 0):
+      print('MISMATCH: %s does not start and end at rest' % fn)
+      ok = False
+    ipts = [(int(x), int(y)) for (x, y) in pts]
+    for i in range(len(ipts) - 1):
+      length = math.hypot(ipts[i+1][0] - ipts[i][0], ipts[i+1][1] - ipts[i][1])
+      if abs(speeds[i+1] ** 2 - speeds[i] ** 2) > 2 * a * length + 1e-6:
+        print('MISMATCH: %s needs too much acceleration at point %d' % (fn, i))
+        ok = False
+        break
+    t_plan = timeit(lambda: gcoderip.planMotion(pts), repeat)
+    base = gcoderip.constantSpeedTime(pts)
+    planned = gcoderip.plannedTime(pts, speeds)
+    print('%-20s %8d %8.1f %10.1f %10.1f %7.2fx' %
+          (os.path.basename(fn), len(pts), t_plan * 1000, base, planned,
+           base / planned if planned else float('nan')))
+  return ok
+
+
+# Largest distance from any of pts to the polyline path, using a grid
+# of the path's segments so that only those nearby are measured. Only
+# distances up to cell are found exactly; anything further comes back
+# as infinity.
+def pathDeviation(pts, path, cell):
+  grid = {}
+  for k in range(len(path) - 1):
+    ((x0, y0), (x1, y1)) = (path[k], path[k+1])
+    steps = int(math.hypot(x1 - x0, y1 - y0) / (cell / 2.0)) + 1
+    for s in range(steps + 1):
+      t = float(s) / steps
+      key = (int(math.floor((x0 + t * (x1 - x0)) / cell)),
+             int(math.floor((y0 + t * (y1 - y0)) / cell)))
+      cellSegments = grid.setdefault(key, [])
+      if not cellSegments or cellSegments[-1] != k:
+        cellSegments.append(k)
+  if len(path) == 1:
+    grid[(int(math.floor(path[0][0] / cell)),
+          int(math.floor(path[0][1] / cell)))] = [0]
+    path = [path[0], path[0]]
+
+  worst = 0.0
+  for (px, py) in pts:
+    (gx, gy) = (int(math.floor(px / cell)), int(math.floor(py / cell)))
+    best = float('inf')
+    for dx in range(-2, 3):
+      for dy in range(-2, 3):
+        for k in grid.get((gx + dx, gy + dy), ()):
+          best = min(best, segmentDistance((px, py), path[k], path[k+1]))
+    worst = max(worst, best)
+  return worst
+
+
+# Parse G-code into subpaths as the firmware draws them, with arcs split
+# into FIRMWARE_CM_PER_SEGMENT segments rather than the host's finer
+# default.
+def firmwareSubpaths(lines):
+  commands = list(gcoderip.tokenizeGcode(lines))
+  runs = []
+  cur = None
+  for cmd in commands:
+    if cmd.g >= 2 and cur is not None:
+      runs.append(gcoderip.doArc(
+          cur[0], cur[1], cmd.x, cmd.y, cur[0] + cmd.i, cur[1] + cmd.j,
+          cmd.g == 3, CM_PER_SEGMENT=gcoderip.FIRMWARE_CM_PER_SEGMENT))
+    else:
+      runs.append([(cmd.x, cmd.y)] if cmd.g < 2 else [])
+    cur = (cmd.x, cmd.y)
+  subpaths = gcoderip.groupSubpaths(commands, runs)
+  if subpaths and subpaths[-1] and subpaths[-1][-1] == (0., 0.):
+    subpaths[-1].pop()
+  return [path for path in subpaths if path]
+
+
+# Fit arcs to each drawing, then re-parse the G-code written out as the
+# firmware would draw it and check that every original point is still
+# within the tolerance.
+def benchFitArcs(files, repeat, tolerance=0.05):
+  print('%-20s %8s %8s %10s %10s %8s %8s' %
+        ('file', 'lines', 'fitted', 'bytes', 'fitted', 'max dev', 'ms'))
+  ok = True
+  for fn in files:
+    lines = readLines(fn)
+    subpaths = gcoderip.parseSubpaths(lines)
+    def fit():
+      return [(path[0], gcoderip.fitArcs(path, tolerance)[0])
+              for path in subpaths]
+    fitted = fit()
+    out = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+    gcoderip.writeFittedGcode(fitted, out, tolerance)
+    output = out.getvalue()
+    refitted = firmwareSubpaths(output.splitlines(True))
+    worst = 0.0
+    if len(refitted) != len(subpaths):
+      print('MISMATCH: %s has %d subpaths after fitting, not %d' %
+            (fn, len(refitted), len(subpaths)))
+      ok = False
+    else:
+      for (path, fitted_path) in zip(subpaths, refitted):
+        worst = max(worst, pathDeviation(path, fitted_path, 4 * tolerance))
+      if worst > tolerance + 1e-5:
+        print('MISMATCH: %s strays %.4f from the original' % (fn, worst))
+        ok = False
+    t = timeit(fit, repeat)
+    print('%-20s %8d %8d %10d %10d %8.4f %8.1f' %
+          (os.path.basename(fn), len(lines), output.count('\n'),
+           sum(len(l) for l in lines), len(output), worst, t * 1000))
+  return ok
+
+
+# Points every spacing along the polyline pts.
+def samplePath(pts, spacing):
+  samples = list(pts[:1])
+  for (a, b) in zip(pts, pts[1:]):
+    steps = int(math.hypot(b[0] - a[0], b[1] - a[1]) / spacing) + 1
+    for s in range(1, steps + 1):
+      t = float(s) / steps
+      samples.append((a[0] + t * (b[0] - a[0]), a[1] + t * (b[1] - a[1])))
+  return samples
+
+
+# Remove overlapping strokes from each drawing and check that the result
+# draws exactly the same ink: everything in the original is still
+# drawn, and nothing is drawn that was not there before.
+def benchOverlaps(files, repeat, tolerance=0.5):
+  ok = True
+  # A stroke that doubles back along itself should be cut out.
+  zigzag = [(0.0, 0.0), (10.0, 0.0), (5.0, 0.0), (10.0, 0.0), (20.0, 0.0)]
+  if gcoderip.removeOverlaps(zigzag, tolerance) != \
+      [(0.0, 0.0), (10.0, 0.0), (20.0, 0.0)]:
+    print('MISMATCH: retraced zigzag was not removed')
+    ok = False
+
+  print('%-20s %8s %8s %10s %10s %7s %8s' %
+        ('file', 'points', 'after', 'distance', 'after', 'saved', 'ms'))
+  for fn in files:
+    pts = toSteps(gcoderip.parseGcode(readLines(fn)))
+    result = gcoderip.removeOverlaps(pts, tolerance)
+    lost = pathDeviation(samplePath(pts, tolerance), result, 4 * tolerance)
+    added = pathDeviation(samplePath(result, tolerance), pts, 4 * tolerance)
+    if max(lost, added) > tolerance + 1e-6:
+      print('MISMATCH: %s draws different ink (%.2f lost, %.2f added)' %
+            (fn, lost, added))
+      ok = False
+    t = timeit(lambda: gcoderip.removeOverlaps(pts, tolerance), repeat)
+    (before, after) = (gcoderip.pathLength(pts), gcoderip.pathLength(result))
+    print('%-20s %8d %8d %10d %10d %6.1f%% %8.1f' %
+          (os.path.basename(fn), len(pts), len(result), before, after,
+           100.0 * (before - after) / before if before else 0.0, t * 1000))
+  return ok
+
+
+# Parse each drawing split across 1, 2, 4, ... worker processes (up to
+# the number of CPUs, and at least 2), checking the result matches the
+# sequential parse and reporting the wall-clock speedup for each.
+def benchParallel(files, repeat):
+  counts = [1]
+  while counts[-1] < max(2, multiprocessing.cpu_count()):
+    counts.append(counts[-1] * 2)
+  print('%d CPUs' % multiprocessing.cpu_count())
+  print('%-20s %8s %8s %s' % ('file', 'lines', 'seq ms',
+                              ' '.join(['%8s' % ('x%d' % c) for c in counts])))
+  ok = True
+  for fn in files:
+    lines = readLines(fn)
+    for chord_error in (None, 0.5):
+      expected = gcoderip.parseGcode(lines, chord_error=chord_error)
+      if gcoderip.parallelParse(lines, 2, chord_error) != expected:
+        print('MISMATCH: %s parses differently in parallel' % fn)
+        ok = False
+    t_seq = timeit(lambda: gcoderip.parseGcode(lines), repeat)
+    speedups = []
+    for c in counts:
+      t = timeit(lambda: gcoderip.parallelParse(lines, c), repeat)
+      speedups.append('%7.2fx' % (t_seq / t))
+    print('%-20s %8d %8.1f %s' % (os.path.basename(fn), len(lines),
+                                  t_seq * 1000, ' '.join(speedups)))
+  return ok
+
+
+# Write every level of detail in profiles.json from one parse, and
+# compare against parsing once per output. Every output must match a
+# separate processGcode run (simplified to the tolerance reported), and
+# budgets must be respected.
+def benchLod(files, repeat):
+  profiles = gcoderip.loadProfiles(gcoderip.PROFILES)
+  outputs = profiles['outputs']
+  print('%-20s %8s %10s %10s %8s' %
+        ('file', 'outputs', 'shared ms', 'separate ms', 'speedup'))
+  ok = True
+  outdir = tempfile.mkdtemp()
+  try:
+    for fn in files:
+      lines = readLines(fn)
+      results = gcoderip.writeLevelsOfDetail(lines, profiles, 'bench', outdir)
+      for (output, tolerance, waypoints) in results:
+        machine = profiles['machines'][output['machine']]
+        if output.get('max_points') is not None and \
+            len(waypoints) > output['max_points']:
+          print('MISMATCH: %s %s has %d points, over budget' %
+                (fn, output['name'], len(waypoints)))
+          ok = False
+        expected = gcoderip.processGcode(lines, width=machine['width'],
+                                         height=machine['height'])
+        if tolerance is not None:
+          expected = gcoderip.simplifyPath(expected, tolerance)
+        if waypoints != expected:
+          print('MISMATCH: %s %s differs from a separate parse' %
+                (fn, output['name']))
+          ok = False
+
+      def separate():
+        for output in outputs:
+          machine = profiles['machines'][output['machine']]
+          waypoints = gcoderip.processGcode(lines, width=machine['width'],
+                                            height=machine['height'])
+          (waypoints, _) = gcoderip.simplifyToBudget(
+              waypoints, output.get('simplify'), output.get('max_points'))
+          with open(os.path.join(outdir, 'separate.h'), 'w') as f:
+            gcoderip.HEADER_FORMATS[output.get('format', 'pairs')](waypoints,
+                                                                   f)
+      t_shared = timeit(lambda: gcoderip.writeLevelsOfDetail(
+          lines, profiles, 'bench', outdir), repeat)
+      t_separate = timeit(separate, repeat)
+      print('%-20s %8d %10.1f %10.1f %7.2fx' %
+            (os.path.basename(fn), len(outputs), t_shared * 1000,
+             t_separate * 1000, t_separate / t_shared))
+  finally:
+    shutil.rmtree(outdir)
+  return ok
+
+
+# Compare the integer StepArray pipeline with the old one, which kept
+# float [x, y] lists and only truncated when printing the header. The
+# points must be exactly what the header says, and the same as the old
+# points once truncated and with repeats dropped.
+def benchSteps(files, repeat):
+  print('%-20s %8s %8s %10s %10s %8s %8s' %
+        ('file', 'floats', 'steps', 'float KB', 'steps KB', 'float ms',
+         'steps ms'))
+  ok = True
+  for fn in files:
+    waypoints = gcoderip.parseGcode(readLines(fn))
+    floats = gcoderip.removeDuplicates(gcoderip.scaleToScreen(waypoints))
+    steps = gcoderip.scaleToSteps(waypoints)
+    expected = gcoderip.removeDuplicates([(int(x), int(y))
+                                          for (x, y) in floats])
+    out = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+    gcoderip.writePairsHeader(steps, out)
+    if steps != expected or list(steps) != readPairsHeader(out.getvalue()):
+      print('MISMATCH: %s steps differ from the truncated float points' % fn)
+      ok = False
+    float_kb = step_kb = float('nan')
+    if tracemalloc is not None:
+      float_kb = peakMemory(lambda: gcoderip.removeDuplicates(
+          gcoderip.scaleToScreen(waypoints)))[0] / 1024.0
+      step_kb = peakMemory(lambda: gcoderip.scaleToSteps(waypoints))[0] / 1024.0
+    t_float = timeit(lambda: gcoderip.removeDuplicates(
+        gcoderip.scaleToScreen(waypoints)), repeat)
+    t_steps = timeit(lambda: gcoderip.scaleToSteps(waypoints), repeat)
+    print('%-20s %8d %8d %10.0f %10.0f %8.1f %8.1f' %
+          (os.path.basename(fn), len(floats), len(steps), float_kb, step_kb,
+           t_float * 1000, t_steps * 1000))
+  return ok
+
+
+# Stream each drawing to the simulated Escher on a pty, with increasing
+# frame loss and byte corruption, checking every point arrives intact.
+# Also estimates the rate at the firmware's 115200 baud from the bytes
+# sent per point.
+def benchSerial(files, repeat, conditions=((0.0, 0.0), (0.01, 0.0001),
+                                          (0.05, 0.001))):
+  try:
+    import escherstream
+  except ImportError as e:
+    print('escherstream is not available (%s), skipping' % e)
+    return True
+  print('%-20s %6s %8s %8s %8s %8s %10s %10s' %
+        ('file', 'loss', 'corrupt', 'points', 'frames', 'resent', 'points/s',
+         '@%d' % escherstream.BAUD))
+  ok = True
+  for fn in files:
+    pts = toSteps(gcoderip.parseGcode(readLines(fn)))
+    for (loss, corrupt) in conditions:
+      (simulator, path) = escherstream.startSimulator(loss=loss,
+                                                      corrupt=corrupt, seed=1)
+      port = escherstream.openPort(path)
+      try:
+        stats = escherstream.streamWaypoints(port, pts)
+      finally:
+        port.close()
+        simulator.stop()
+      if not simulator.done or simulator.points != list(pts):
+        print('MISMATCH: %s arrived wrong with loss %g' % (fn, loss))
+        ok = False
+      rate = stats['points'] / max(stats['seconds'], 1e-9)
+      line_rate = escherstream.BAUD / 10.0 * stats['points'] / stats['bytes']
+      print('%-20s %6.2f %8.4f %8d %8d %8d %10.0f %10.0f' %
+            (os.path.basename(fn), loss, corrupt, stats['points'],
+             stats['frames'], stats['retransmits'], rate, line_rate))
+  return ok
+
+
+# Record per-stage stats for each drawing, checking that the stages
+# hand on what the next one takes, that the counts agree with the final
+# result, and that measuring the stages one at a time does not change
+# the points from the usual chained run (also timed, as "chained").
+def benchStages(files, repeat):
+  names = ['tokenize', 'expand', 'reorder', 'scale', 'dedup', 'simplify',
+           'overlaps']
+  print('%-20s %s' % ('file', ' '.join(['%10s' % n for n in
+                                         names + ['chained']])))
+  options = dict(reorder=True, simplify=0.5, overlaps=0.5)
+  ok = True
+  for fn in files:
+    lines = readLines(fn)
+    stats = {}
+    waypoints = gcoderip.processGcode(lines, stats=stats, **options)
+    stages = stats['stages']
+    if [s['stage'] for s in stages] != names:
+      print('MISMATCH: %s ran stages %s' % (fn, [s['stage'] for s in stages]))
+      ok = False
+      continue
+    for (a, b) in zip(stages, stages[1:]):
+      gives = [k for k in a if k.endswith('_out')]
+      takes = [k for k in b if k.endswith('_in')]
+      if gives[0][:-4] != takes[0][:-3] or a[gives[0]] != b[takes[0]]:
+        print('MISMATCH: %s %s gives %d %s but %s takes %d %s' %
+              (fn, a['stage'], a[gives[0]], gives[0][:-4], b['stage'],
+               b[takes[0]], takes[0][:-3]))
+        ok = False
+    dedup = stages[4]
+    if stages[-1]['points_out'] != len(waypoints) or \
+        dedup['points_in'] - dedup['duplicates'] != dedup['points_out'] or \
+        stats['commands'] != stages[0]['commands_out']:
+      print('MISMATCH: %s point counts do not add up' % fn)
+      ok = False
+    t_chained = timeit(lambda: gcoderip.processGcode(lines, **options),
+                       repeat)
+    if gcoderip.processGcode(lines, **options) != waypoints:
+      print('MISMATCH: %s differs when the stages are measured' % fn)
+      ok = False
+    print('%-20s %s' % (os.path.basename(fn),
+                        ' '.join(['%8.1fms' % (s['seconds'] * 1000)
+                                  for s in stages] +
+                                 ['%8.1fms' % (t_chained * 1000)])))
+  return ok
+
+
+# Split each drawing into chunks with a manifest, checking that the
+# chunks replay to the same points, that resuming from every chunk gives
+# the rest of the drawing from the right position, and that damage to
+# a chunk is caught. Times writing the manifest and replaying it.
+def benchChunks(files, repeat, chunk_points=1024):
+  print('%-20s %8s %8s %10s %10s %10s' %
+        ('file', 'points', 'chunks', 'json KB', 'write ms', 'replay ms'))
+  ok = True
+  for fn in files:
+    pts = list(gcoderip.processGcode(readLines(fn)))
+    out = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+    gcoderip.writeManifest(pts, out, chunk_points)
+    text = out.getvalue()
+    manifest = json.loads(text)
+    if gcoderip.replayManifest(manifest) != pts:
+      print('MISMATCH: %s chunks do not replay to the drawing' % fn)
+      ok = False
+    for (index, chunk) in enumerate(manifest['chunks']):
+      resumed = gcoderip.resumePoints(manifest, index)
+      if index and resumed[0] != pts[chunk['first'] - 1] or \
+          resumed[-len(pts) + chunk['first']:] != pts[chunk['first']:]:
+        print('MISMATCH: %s resuming from chunk %d' % (fn, index))
+        ok = False
+    if pts:
+      damaged = json.loads(text)
+      chunk = damaged['chunks'][len(damaged['chunks']) // 2]
+      data = bytearray(base64.b64decode(chunk['data']))
+      data[len(data) // 2] ^= 0x01
+      chunk['data'] = base64.b64encode(bytes(data)).decode('ascii')
+      try:
+        gcoderip.replayManifest(damaged)
+        print('MISMATCH: %s damaged chunk %d was not caught' %
+              (fn, chunk['index']))
+        ok = False
+      except ValueError:
+        pass
+    t_write = timeit(lambda: gcoderip.writeManifest(
+        pts, io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO(),
+        chunk_points), repeat)
+    t_replay = timeit(lambda: gcoderip.replayManifest(manifest), repeat)
+    print('%-20s %8d %8d %10.1f %10.1f %10.1f' %
+          (os.path.basename(fn), len(pts), len(manifest['chunks']),
+           len(text) / 1024.0, t_write * 1000, t_replay * 1000))
+  return ok
+
+
+# Synthetic serialplot telemetry for a drawing: an MDW line for each
+# point with the target one point ahead, as the firmware prints them
+# with Serial.println, and some other chatter mixed in. Returns the
+# bytes and the records they hold.
+def telemetry(pts):
+  pts = list(pts)
+  chunks = []
+  records = []
+  for i in range(1, len(pts)):
+    if i % 500 == 0:
+      chunks.append(b'EscherStepper: Steppers still running\r\n')
+    record = pts[i-1] + pts[i]
+    chunks.append(('MDW %d %d %d %d\r\n' % record).encode('ascii'))
+    records.append(record)
+  return (b''.join(chunks), records)
+
+
+# The original serialplot.py loop: one read() per byte, building up each
+# line by concatenation and parsing it with split(). Reads size bytes.
+def legacyPlotReader(port, size):
+  records = []
+  curline = b''
+  while size > 0:
+    c = port.read(1)
+    size -= len(c)
+    curline += c
+    if c == b'\n':
+      line = curline
+      curline = b''
+      if line.startswith(b'MDW '):
+        try:
+          vals = line.split()
+          records.append((int(vals[1]), int(vals[2]), int(vals[3]),
+                          int(vals[4])))
+        except (IndexError, ValueError):
+          pass
+  return records
+
+
+# Read size bytes of telemetry with a serialplot.SerialReader.
+def bulkPlotReader(port, size):
+  import serialplot
+  reader = serialplot.SerialReader(port)
+  records = []
+  while reader.bytes < size:
+    records += reader.poll()
+  return records
+
+
+# Run reader over data fed through a fresh pty (standing in for the
+# serial port) by a writer thread, or from a file if source is 'file'.
+# Returns the records and the seconds taken.
+def runPlotReader(reader, data, source, tmpdir):
+  if source == 'file':
+    path = os.path.join(tmpdir, 'telemetry')
+    with open(path, 'wb') as f:
+      f.write(data)
+    port = io.FileIO(path, 'r')
+    writer = None
+  else:
+    import pty
+    import threading
+    import tty
+    (master, slave) = pty.openpty()
+    tty.setraw(slave)
+    port = io.FileIO(slave, 'r')
+    def write():
+      for i in range(0, len(data), 4096):
+        os.write(master, data[i:i+4096])
+    writer = threading.Thread(target=write)
+    writer.daemon = True
+  try:
+    start = time.time()
+    if writer is not None:
+      writer.start()
+    records = reader(port, len(data))
+    elapsed = time.time() - start
+  finally:
+    if writer is not None:
+      writer.join()
+      os.close(master)
+    port.close()
+  return (records, elapsed)
+
+
+# Compare serialplot's bulk SerialReader with the original byte-at-a-time
+# loop on each drawing's telemetry, from a file and through a pty,
+# checking both get every record. At 2,000,000 baud the Escher can send
+# up to 200 KB/s.
+def benchPlotReader(files, repeat):
+  print('%-20s %6s %8s %8s %12s %12s %8s' %
+        ('file', 'source', 'records', 'KB', 'legacy KB/s', 'bulk KB/s',
+         'speedup'))
+  ok = True
+  tmpdir = tempfile.mkdtemp()
+  try:
+    for fn in files:
+      (data, expected) = telemetry(toSteps(gcoderip.parseGcode(readLines(fn))))
+      for source in ('file', 'pty'):
+        times = {}
+        for (name, reader) in (('legacy', legacyPlotReader),
+                               ('bulk', bulkPlotReader)):
+          for _ in range(repeat):
+            (records, elapsed) = runPlotReader(reader, data, source, tmpdir)
+            if records != expected:
+              print('MISMATCH: %s %s reader got %d of %d records from %s' %
+                    (fn, name, len(records), len(expected), source))
+              ok = False
+            times[name] = min(times.get(name, elapsed), elapsed)
+        kb = len(data) / 1024.0
+        print('%-20s %6s %8d %8.0f %12.0f %12.0f %7.1fx' %
+              (os.path.basename(fn), source, len(expected), kb,
+               kb / max(times['legacy'], 1e-9), kb / max(times['bulk'], 1e-9),
+               times['legacy'] / max(times['bulk'], 1e-9)))
+  finally:
+    shutil.rmtree(tmpdir)
+  return ok
+
+
+# Stands in for serialplot's Tk canvas, which cannot be opened without
+# a display: keeps the color and coordinates of each line item, and
+# makes each flush to the screen take flush_cost seconds, about what Tk
+# takes to redraw.
+class NullCanvas(object):
+  def __init__(self, flush_cost=0.002):
+    self.lines = {}
+    self.flush_cost = flush_cost
+
+  def create_line(self, *coords, **options):
+    item = len(self.lines) + 1
+    self.lines[item] = (options.get('fill'), coords)
+    return item
+
+  def coords(self, item, *coords):
+    self.lines[item] = (self.lines[item][0], coords)
+
+  def flush(self):
+    time.sleep(self.flush_cost)
+
+  # The path drawn in color, joining up the line items in order.
+  def path(self, color):
+    pts = []
+    for item in sorted(self.lines):
+      (fill, coords) = self.lines[item]
+      if fill == color:
+        run = list(zip(coords[0::2], coords[1::2]))
+        pts += run[1:] if pts and run[0] == pts[-1] else run
+    return pts
+
+
+# serialplot's original way of drawing: a canvas item per segment.
+class SegmentPlotter(object):
+  def __init__(self, canvas):
+    import serialplot
+    self.canvas = canvas
+    self.screenPoint = serialplot.screenPoint
+    self.cur = self.curt = (0, serialplot.HEIGHT)
+
+  def plot(self, records):
+    for (x, y, tx, ty) in records:
+      (x, y) = self.screenPoint(x, y)
+      (tx, ty) = self.screenPoint(tx, ty)
+      self.canvas.create_line(self.cur[0], self.cur[1], x, y, fill="black")
+      self.canvas.create_line(self.curt[0], self.curt[1], tx, ty,
+                              fill="blue")
+      (self.cur, self.curt) = ((x, y), (tx, ty))
+
+
+# Feed each drawing's telemetry from a file through serialplot's reader
+# thread and fixed-rate Renderer, onto a NullCanvas, checking every
+# record is drawn. The records taken in per second are compared with
+# the original loop, which drew and flushed each record as it arrived,
+# for up to a second. Then checks that a renderer that cannot keep up
+# has records dropped, and counted, rather than holding up the reader.
+def benchPlotRender(files, repeat, budget=1.0):
+  try:
+    import serialplot
+  except ImportError as e:
+    print('serialplot is not available (%s), skipping' % e)
+    return True
+  print('%-20s %8s %12s %12s %8s %8s %8s' %
+        ('file', 'records', 'inline rec/s', 'thread rec/s', 'frames',
+         'maxqueue', 'dropped'))
+  ok = True
+  tmpdir = tempfile.mkdtemp()
+  try:
+    for fn in files:
+      (data, expected) = telemetry(toSteps(gcoderip.parseGcode(readLines(fn))))
+      path = os.path.join(tmpdir, 'telemetry')
+      with open(path, 'wb') as f:
+        f.write(data)
+
+      # The original structure: draw and flush every record in turn.
+      canvas = NullCanvas()
+      plotter = SegmentPlotter(canvas)
+      reader = serialplot.SerialReader(io.FileIO(path, 'r'))
+      (inline, start) = (0, time.time())
+      while reader.bytes < len(data) and time.time() - start < budget:
+        for record in reader.poll():
+          plotter.plot([record])
+          canvas.flush()
+          inline += 1
+      inline_rate = inline / (time.time() - start)
+      reader.port.close()
+
+      for queue_batches in (serialplot.QUEUE_BATCHES, 1):
+        canvas = NullCanvas()
+        pending = serialplot.queue.Queue(queue_batches)
+        reader = serialplot.SerialReader(io.FileIO(path, 'r'),
+                                         chunk_size=4096)
+        thread = serialplot.ReaderThread(reader, pending)
+        renderer = serialplot.Renderer(serialplot.Plotter(canvas), pending,
+                                       canvas.flush)
+        start = time.time()
+        thread.start()
+        while reader.bytes < len(data) or not pending.empty():
+          renderer.tick()
+        read_time = time.time() - start
+        thread.stop()
+        thread.join()
+        reader.port.close()
+        drawn = renderer.records
+        if drawn + thread.dropped != len(expected):
+          print('MISMATCH: %s drew %d and dropped %d of %d records' %
+                (fn, drawn, thread.dropped, len(expected)))
+          ok = False
+        if queue_batches > 1:
+          path_drawn = removeRepeats(canvas.path('black'))
+          if thread.dropped or path_drawn != removeRepeats(
+              [(0, serialplot.HEIGHT)] +
+              [serialplot.screenPoint(x, y) for (x, y, tx, ty) in expected]):
+            print('MISMATCH: %s lost records with room to spare' % fn)
+            ok = False
+          print('%-20s %8d %12.0f %12.0f %8d %8d %8d' %
+                (os.path.basename(fn), len(expected), inline_rate,
+                 len(expected) / read_time, renderer.frames, thread.max_depth,
+                 thread.dropped))
+  finally:
+    shutil.rmtree(tmpdir)
+  return ok
+
+
+# pts without any point that repeats the one before it.
+def removeRepeats(pts):
+  return [pt for (i, pt) in enumerate(pts) if i == 0 or pt != pts[i-1]]
+
+
+# Play each drawing's telemetry into serialplot's Plotter a frame at a
+# time, as it would arrive at 2 Mbaud and 30 frames/s, and the same for
+# the original item-per-segment drawing. Reports the canvas items left
+# at the end, and the time to draw the first and last tenth of the
+# frames (on a NullCanvas, so Tk's own cost per item is not included).
+# Checks the polylines trace the same path as the segments.
+def benchPlotSession(files, repeat, records_per_frame=333):
+  try:
+    import serialplot
+  except ImportError as e:
+    print('serialplot is not available (%s), skipping' % e)
+    return True
+  print('%-20s %8s %10s %10s %12s %12s' %
+        ('file', 'records', 'seg items', 'poly items', 'poly first ms',
+         'poly last ms'))
+  ok = True
+  for fn in files:
+    (data, expected) = telemetry(toSteps(gcoderip.parseGcode(readLines(fn))))
+    frames = [expected[i:i+records_per_frame]
+              for i in range(0, len(expected), records_per_frame)]
+    results = {}
+    for (name, make) in (('segments', SegmentPlotter),
+                         ('polylines', serialplot.Plotter)):
+      canvas = NullCanvas()
+      plotter = make(canvas)
+      times = []
+      for frame in frames:
+        start = time.time()
+        plotter.plot(frame)
+        times.append(time.time() - start)
+      results[name] = (canvas, times)
+    for color in ('black', 'blue'):
+      if removeRepeats(results['segments'][0].path(color)) != \
+          removeRepeats(results['polylines'][0].path(color)):
+        print('MISMATCH: %s polylines do not follow the %s path' %
+              (fn, color))
+        ok = False
+    times = results['polylines'][1]
+    tenth = max(len(times) // 10, 1)
+    print('%-20s %8d %10d %10d %12.2f %12.2f' %
+          (os.path.basename(fn), len(expected),
+           len(results['segments'][0].lines),
+           len(results['polylines'][0].lines),
+           1000.0 * sum(times[:tenth]) / tenth,
+           1000.0 * sum(times[-tenth:]) / tenth))
+  return ok
+
+
+# Stands in for a serial port, handing out data chunk_size bytes at a
+# time.
+class MemoryPort(object):
+  def __init__(self, data, chunk_size=4096):
+    self.data = data
+    self.offset = 0
+    self.chunk_size = chunk_size
+
+  def read(self, size):
+    size = min(size, self.chunk_size)
+    chunk = self.data[self.offset:self.offset+size]
+    self.offset += len(chunk)
+    return chunk
+
+
+# Read everything in data with a serialplot reader class.
+def readTelemetry(reader_class, data):
+  reader = reader_class(MemoryPort(data))
+  records = []
+  while reader.bytes < len(data):
+    records += reader.poll()
+  return (records, reader)
+
+
+# Compare decoding each drawing's telemetry as MDW lines and as binary
+# frames, with numpy (if available) and without, checking all three get
+# every record.
+def benchTelemetry(files, repeat):
+  import serialplot
+  decoders = [('text', serialplot.SerialReader, True),
+              ('binary', serialplot.FrameReader, True),
+              ('binary-py', serialplot.FrameReader, False)]
+  if serialplot.np is None:
+    decoders.pop(1)
+  print('%-20s %8s %9s %9s %s' %
+        ('file', 'records', 'text B/r', 'frame B/r',
+         ' '.join(['%12s' % ('%s r/s' % name) for (name, _, _) in decoders])))
+  ok = True
+  for fn in files:
+    (text, expected) = telemetry(toSteps(gcoderip.parseGcode(readLines(fn))))
+    frames = serialplot.encodeFrames(expected)
+    rates = []
+    for (name, reader_class, use_numpy) in decoders:
+      data = text if name == 'text' else frames
+      saved = serialplot.np
+      if not use_numpy:
+        serialplot.np = None
+      try:
+        if readTelemetry(reader_class, data)[0] != expected:
+          print('MISMATCH: %s %s decoder lost records' % (fn, name))
+          ok = False
+        elapsed = timeit(lambda: readTelemetry(reader_class, data), repeat)
+      finally:
+        serialplot.np = saved
+      rates.append(len(expected) / max(elapsed, 1e-9))
+    print('%-20s %8d %9.1f %9.1f %s' %
+          (os.path.basename(fn), len(expected),
+           len(text) / max(len(expected), 1),
+           len(frames) / max(len(expected), 1),
+           ' '.join(['%12.0f' % rate for rate in rates])))
+  return ok
+
+
+# Damage a synthetic stream of binary frames (with some text chatter
+# mixed in, as the firmware prints) by flipping random bits, and check
+# the FrameReader recovers: the records it returns are in order, and it
+# gets every frame that was not touched, bar one per damaged frame that
+# happens to pass its CRC (about 1 in 256).
+def benchFrameRecovery(files, repeat, count=20000,
+                       rates=(0.0, 0.0001, 0.001, 0.01)):
+  import random
+  import serialplot
+  records = [(i % 32768, i // 32768, -(i % 32768), 7) for i in range(count)]
+  chunks = []
+  for i in range(0, count, 1000):
+    chunks.append(serialplot.encodeFrames(records[i:i+1000]))
+    chunks.append(b'EscherStepper: Steppers still running\r\n')
+  clean = b''.join(chunks)
+  size = serialplot.FRAME.size
+  print('%8s %8s %8s %10s %8s %8s %8s' %
+        ('flips', 'intact', 'damaged', 'recovered', 'missed', 'bad CRC',
+         'false'))
+  ok = True
+  rng = random.Random(1)
+  for rate in rates:
+    data = bytearray(clean)
+    flipped = set()
+    for _ in range(int(len(data) * rate)):
+      offset = rng.randrange(len(data))
+      data[offset] ^= 1 << rng.randrange(8)
+      flipped.add(offset)
+    # Which records went out in frames no bit of which was flipped.
+    intact = set()
+    offset = 0
+    for i in range(count):
+      offset = clean.find(serialplot.FRAME_SYNC, offset)
+      if not flipped.intersection(range(offset, offset + size)):
+        intact.add(i)
+      offset += size
+    (got, reader) = readTelemetry(serialplot.FrameReader, bytes(data))
+    index = dict((record, i) for (i, record) in enumerate(records))
+    found = [index[r] for r in got if r in index]
+    false = len(got) - len(found)
+    missed = len(intact - set(found))
+    if found != sorted(found) or missed > false or false > 5 + count * rate:
+      print('MISMATCH: recovery at flip rate %g' % rate)
+      ok = False
+    print('%8d %8d %8d %10d %8d %8d %8d' %
+          (len(flipped), len(intact), count - len(intact), len(found),
+           missed, reader.bad, false))
+  return ok
+
+
+# Record each drawing's telemetry as a serialplot session, as if it
+# arrived in 4 KB chunks at rate bytes/s. Replays it through the reader
+# thread and renderer as fast as possible, checking every record is
+# drawn along the same path. Then replays it sped up to take about
+# seconds, without the renderer (which could not keep up with most
+# drawings at that speed), checking the ReplayPort delivers every
+# record within 5% early or 20% (plus slack seconds) late. Also checks
+# that recording through a RecordingPort keeps every byte in order.
+def benchReplay(files, repeat, rate=200000, seconds=0.5, slack=0.05):
+  try:
+    import serialplot
+  except ImportError as e:
+    print('serialplot is not available (%s), skipping' % e)
+    return True
+  print('%-20s %8s %10s %8s %10s %12s %8s' %
+        ('file', 'records', 'session s', 'speed', 'replay s', 'rec/s',
+         'frames'))
+  ok = True
+  tmpdir = tempfile.mkdtemp()
+  try:
+    for fn in files:
+      (data, expected) = telemetry(toSteps(gcoderip.parseGcode(readLines(fn))))
+      path = os.path.join(tmpdir, 'session.escr')
+      writer = serialplot.SessionWriter(open(path, 'wb'))
+      for i in range(0, len(data), 4096):
+        writer.write(data[i:i+4096], (i + 4096) / rate)
+      writer.close()
+      with open(path, 'rb') as f:
+        times = [t for (t, chunk) in serialplot.readSession(f)]
+      duration = times[-1]
+
+      canvas = NullCanvas()
+      # A single batch of room, so a reader that did not wait for the
+      # renderer would drop records.
+      pending = serialplot.queue.Queue(1)
+      port = serialplot.ReplayPort(path, 0, timeout=0.01)
+      thread = serialplot.ReaderThread(serialplot.SerialReader(port),
+                                       pending, block=True)
+      renderer = serialplot.Renderer(serialplot.Plotter(canvas), pending,
+                                     canvas.flush)
+      start = time.time()
+      thread.start()
+      while not port.done or not pending.empty():
+        renderer.tick()
+      elapsed = time.time() - start
+      thread.stop()
+      thread.join()
+      port.close()
+      if thread.dropped or removeRepeats(canvas.path('black')) != \
+          removeRepeats([(0, serialplot.HEIGHT)] +
+                        [serialplot.screenPoint(x, y)
+                         for (x, y, tx, ty) in expected]):
+        print('MISMATCH: %s replay drew %d of %d records' %
+              (fn, renderer.records, len(expected)))
+        ok = False
+      print('%-20s %8d %10.2f %8.3g %10.2f %12.0f %8d' %
+            (os.path.basename(fn), len(expected), duration, 0, elapsed,
+             renderer.records / elapsed, renderer.frames))
+
+      # The first chunk is delivered straight away, and the rest at their
+      # recorded times after it, sped up. A session that arrived in one
+      # chunk takes no time at any speed.
+      if duration == times[0]:
+        continue
+      speed = duration / seconds
+      target = (duration - times[0]) / speed
+      port = serialplot.ReplayPort(path, speed, timeout=0.01)
+      reader = serialplot.SerialReader(port)
+      got = 0
+      start = time.time()
+      while reader.bytes < len(data) and not port.done:
+        got += len(reader.poll())
+      elapsed = time.time() - start
+      port.close()
+      if got != len(expected):
+        print('MISMATCH: %s replay at speed %g read %d of %d records' %
+              (fn, speed, got, len(expected)))
+        ok = False
+      if not 0.95 * target <= elapsed <= 1.2 * target + slack:
+        print('MISMATCH: %s replay at speed %g took %.2fs, not %.2fs' %
+              (fn, speed, elapsed, target))
+        ok = False
+      print('%-20s %8d %10.2f %8.3g %10.2f %12.0f %8s' %
+            (os.path.basename(fn), got, duration, speed, elapsed,
+             got / elapsed, '-'))
+
+      writer = serialplot.SessionWriter(open(path, 'wb'))
+      port = serialplot.RecordingPort(MemoryPort(data, 1000), writer)
+      (got, reader) = (0, serialplot.SerialReader(port))
+      while reader.bytes < len(data):
+        got += len(reader.poll())
+      port.writer.close()
+      with open(path, 'rb') as f:
+        chunks = list(serialplot.readSession(f))
+      times = [t for (t, chunk) in chunks]
+      if got != len(expected) or times != sorted(times) or \
+          b''.join(chunk for (t, chunk) in chunks) != data:
+        print('MISMATCH: %s recording did not keep the bytes read' % fn)
+        ok = False
+  finally:
+    shutil.rmtree(tmpdir)
+  return ok
+
+
+BENCHMARKS = [
+  ('parse', benchParse),
+  ('process', benchProcess),
+  ('arcs', benchArcs),
+  ('chord', benchChord),
+  ('simplify', benchSimplify),
+  ('reorder', benchReorder),
+  ('packed', benchPacked),
+  ('drawing', benchDrawing),
+  ('stream', benchStream),
+  ('png', benchPng),
+  ('plan', benchPlan),
+  ('fitarcs', benchFitArcs),
+  ('overlaps', benchOverlaps),
+  ('parallel', benchParallel),
+  ('lod', benchLod),
+  ('steps', benchSteps),
+  ('serial', benchSerial),
+  ('stages', benchStages),
+  ('chunks', benchChunks),
+  ('plotreader', benchPlotReader),
+  ('plotrender', benchPlotRender),
+  ('plotsession', benchPlotSession),
+  ('telemetry', benchTelemetry),
+  ('framerecovery', benchFrameRecovery),
+  ('replay', benchReplay),
+]
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark gcoderip.py.')
+  parser.add_argument('--repeat', type=int, default=3,
+                      help='Number of timed runs per measurement')
+  parser.add_argument('args', nargs='*',
+                      help='Benchmark names and/or G-code files')
+  args = parser.parse_args()
+
+  names = [a for a in args.args if a in dict(BENCHMARKS)]
+  files = [a for a in args.args if a not in dict(BENCHMARKS)]
+  if not files:
+    files = sorted(glob.glob(os.path.join(TOOLS_DIR, '*.gcode')))
+
+  ok = True
+  for (name, bench) in BENCHMARKS:
+    if names and name not in names:
+      continue
+    print('== %s' % name)
+    if not bench(files, args.repeat):
+      ok = False
+    print()
+  sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+  main()
@@ -5,25 +5,64 @@
 # stepper motor positions. It understands simple GCode
 # commands (G01, G02, and G03 only) and ignores all others
 # in the file.
+#
+# It can also be imported. processGcode runs the whole conversion, and
+# the Stage classes (Tokenize, ExpandArcs, Scale, Dedup, WriteHeader
+# and so on) can be chained into a Pipeline of your own.
 
+from __future__ import division, print_function
+
+import argparse
+import array
+import base64
+import collections
+import contextlib
 import fileinput
+import glob
+import hashlib
+import io
+import itertools
+import json
 import math
+import mmap
+import multiprocessing
+import os
 import re
+import shutil
+import struct
 import sys
+import tempfile
+import time
+import zlib
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
 
-import matplotlib.pyplot as plt
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
 
 # Width and height of Etch-a-Sketch in step units.
 # You can determine this experimentally (and it depends
 # on things like gearing, which steppers are being used,
 # etc.)
-# For larger knobs
-#WIDTH_STEPS = 900
-#HEIGHT_STEPS = 700
-# For smaller knobs
+# These are for the smaller knobs; other machines (like the
+# larger knobs) are described in profiles.json, see --machine.
 WIDTH_STEPS = 720
 HEIGHT_STEPS = 500
 
+# Machine profiles and level-of-detail outputs (see loadProfiles).
+PROFILES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'profiles.json')
+
+# Points per chunk for --chunks, by default, and the version of the
+# manifest files written with --manifest (see writeManifest).
+CHUNK_POINTS = 1024
+MANIFEST_VERSION = 1
+
 
 def atan3(dy, dx):
  a = math.atan2(dy,dx)
@@ -32,11 +71,9 @@ def atan3(dy, dx):
  return a
 
 
-# Adapted from:
-# https://www.marginallyclever.com/2014/03/how-to-improve-the-2-axis-cnc-gcode-interpreter-to-understand-arcs/
-def doArc(posx, posy, x, y, cx, cy, cw, CM_PER_SEGMENT=0.1): 
-  retval = []
-  dx = posx - cx 
+# Find the radius, start angle and (signed) sweep of an arc.
+def arcSweep(posx, posy, x, y, cx, cy, cw):
+  dx = posx - cx
   dy = posy - cy
   radius = math.sqrt((dx*dx)+(dy*dy))
 
@@ -51,80 +88,525 @@ def doArc(posx, posy, x, y, cx, cy, cw, CM_PER_SEGMENT=0.1):
     angle1 += 2.0 * math.pi
 
   sweep = angle2 - angle1
+  return (radius, angle1, sweep)
 
-  # get length of arc
-  l = abs(sweep) * radius
-  num_segments = int(math.floor( l / CM_PER_SEGMENT ))
 
-  for i in range(num_segments):
-    # interpolate around the arc
-    fraction = (i * 1.0) / (num_segments * 1.0)
-    angle3 = (sweep * fraction) + angle1
+# Number of segments needed so that no chord strays more than max_chord
+# from an arc of the given radius and sweep.
+def chordSegments(radius, sweep, max_chord):
+  if max_chord >= radius:
+    max_angle = math.pi
+  else:
+    max_angle = 2.0 * math.acos(1.0 - max_chord / radius)
+  return int(math.ceil(abs(sweep) / max_angle))
 
-    # find the intermediate position
-    nx = cx + math.cos(angle3) * radius
-    ny = cy + math.sin(angle3) * radius
 
-    # make a line to that intermediate position
-    retval.append((nx, ny))
+# Adapted from:
+# https://www.marginallyclever.com/2014/03/how-to-improve-the-2-axis-cnc-gcode-interpreter-to-understand-arcs/
+#
+# By default the arc is split into segments CM_PER_SEGMENT long. If
+# max_chord is given, the segment count is instead the smallest that
+# keeps every chord within max_chord of the true arc.
+def doArc(posx, posy, x, y, cx, cy, cw, CM_PER_SEGMENT=0.1, max_chord=None):
+  (radius, angle1, sweep) = arcSweep(posx, posy, x, y, cx, cy, cw)
+
+  if max_chord is None:
+    # get length of arc
+    l = abs(sweep) * radius
+    num_segments = int(math.floor( l / CM_PER_SEGMENT ))
+  else:
+    num_segments = chordSegments(radius, sweep, max_chord)
+
+  # interpolate around the arc, making a line to each intermediate
+  # position. Most arcs are only a few segments long, so a plain loop
+  # beats building a list of angles first.
+  cos = math.cos
+  sin = math.sin
+  n = num_segments * 1.0
+  retval = []
+  append = retval.append
+  for i in range(num_segments):
+    angle3 = (sweep * (i / n)) + angle1
+    append((cx + cos(angle3) * radius, cy + sin(angle3) * radius))
 
   # one last line hit the end
-  retval.append((x, y))
+  append((x, y))
   return retval
 
 
-def parseGcode(input):
-  waypoints = []
+# Bounding box (minx, maxx, miny, maxy) of an arc, including any
+# extremes it sweeps through between its two end points.
+def arcBounds(posx, posy, x, y, cx, cy, cw):
+  (radius, angle1, sweep) = arcSweep(posx, posy, x, y, cx, cy, cw)
+  xs = [posx, x]
+  ys = [posy, y]
+  (lo, hi) = sorted((angle1, angle1 + sweep))
+  for k in range(int(math.ceil(lo / (math.pi / 2))),
+                 int(math.floor(hi / (math.pi / 2))) + 1):
+    angle = k * math.pi / 2
+    xs.append(cx + math.cos(angle) * radius)
+    ys.append(cy + math.sin(angle) * radius)
+  return (min(xs), max(xs), min(ys), max(ys))
+
+
+# Vectorized version of doArc that interpolates a whole batch of arcs
+# in one pass. starts, ends and centers are (N, 2) arrays and cw is a
+# length-N boolean array. Returns an (M, 2) array holding the points of
+# every arc, one after another, and a length-N array with the number
+# of points belonging to each arc. max_chord works as for doArc.
+# Requires numpy.
+def doArcs(starts, ends, centers, cw, CM_PER_SEGMENT=0.1, max_chord=None):
+  starts = np.asarray(starts, dtype=float).reshape(-1, 2)
+  ends = np.asarray(ends, dtype=float).reshape(-1, 2)
+  centers = np.asarray(centers, dtype=float).reshape(-1, 2)
+  cw = np.asarray(cw, dtype=bool)
+
+  (dx, dy) = (starts - centers).T
+  radius = np.sqrt((dx*dx)+(dy*dy))
+
+  # find the sweep of the arc
+  angle1 = np.arctan2(dy, dx)
+  angle1[angle1 < 0] += math.pi * 2.0
+  angle2 = np.arctan2(ends[:, 1] - centers[:, 1], ends[:, 0] - centers[:, 0])
+  angle2[angle2 < 0] += math.pi * 2.0
+  sweep = angle2 - angle1
+  angle2[(sweep < 0) & cw] += 2.0 * math.pi
+  angle1[(sweep > 0) & ~cw] += 2.0 * math.pi
+  sweep = angle2 - angle1
+
+  # every arc gets num_segments interpolated points plus its end point
+  if max_chord is None:
+    num_segments = np.floor(np.abs(sweep) * radius / CM_PER_SEGMENT).astype(int)
+  else:
+    ratio = np.minimum(max_chord / np.maximum(radius, 1e-300), 2.0)
+    max_angle = np.minimum(2.0 * np.arccos(1.0 - ratio), math.pi)
+    num_segments = np.ceil(np.abs(sweep) / max_angle).astype(int)
+  counts = num_segments + 1
+
+  # index of the owning arc and of the point within it, for every point
+  arc = np.repeat(np.arange(len(counts)), counts)
+  i = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+  n = num_segments[arc]
+  angle3 = (sweep[arc] * (i / np.maximum(n, 1.0))) + angle1[arc]
+  pts = np.empty((len(arc), 2))
+  pts[:, 0] = centers[arc, 0] + np.cos(angle3) * radius[arc]
+  pts[:, 1] = centers[arc, 1] + np.sin(angle3) * radius[arc]
+
+  # one last line hit the end
+  last = (i == n)
+  pts[last] = ends
+  return (pts, counts)
+
+
+# A single motion command. g is the motion mode (0-3); x and y are the
+# (modal) target position; i and j are the arc center offsets, which are
+# only meaningful for G02/G03; f and z are the (modal) feed rate and
+# pen height, or None if they have not been set.
+GcodeCommand = collections.namedtuple('GcodeCommand', 'g x y i j f z')
+
+# Matches a single G-code word, e.g. 'X12.5' or 'G01'.
+_GCODE_WORD = re.compile(r'([GXYZIJFR])\s*([-+]?[\d.]+)')
+# Matches a whole line in the form the Inkscape plugin writes, e.g.
+# 'G02 X1.5 Y2.0 Z-0.125 I0.5 J0.0 F400.0' or 'G00 Z5.0 (Pen up)', with
+# nothing else on it.
+_GCODE_LINE = re.compile(r'G0?([0-3])(?: X([-+]?[\d.]+) Y([-+]?[\d.]+))?'
+                         r'(?: Z([-+]?[\d.]+))?'
+                         r'(?: I([-+]?[\d.]+) J([-+]?[\d.]+))?'
+                         r'(?: F([-+]?[\d.]+))?\s*(?:\([^)]*\)\s*)?$')
+# Matches a line with nothing but (comments) on it, if anything.
+_GCODE_BLANK = re.compile(r'\s*(?:\([^)]*\)\s*)*$')
+# Matches a (comment) or a ; comment running to the end of the line.
+_GCODE_COMMENT = re.compile(r'\([^)]*\)|;.*')
+# Motion modes, keyed by the text of the G word.
+_MOTION_MODES = {'0': 0, '00': 0, '1': 1, '01': 1,
+                 '2': 2, '02': 2, '3': 3, '03': 3}
+
 
+# Tokenize G-code, yielding a GcodeCommand for every G00-G03 move that
+# sets X or Y. Each line is scanned once and words may appear in any
+# order; the motion mode, position, feed rate and Z are modal, so lines
+# that omit them inherit the previous values.
+#
+# Nearly every line the Inkscape plugin writes is either blank, a
+# comment, or matches _GCODE_LINE, which picks it apart in one go. Only
+# the rest are split into words.
+def tokenizeGcode(input):
+  mode = None
+  x = y = None
+  f = z = None
+  simple = _GCODE_LINE.match
+  blank = _GCODE_BLANK.match
+  modes = _MOTION_MODES
+  # GcodeCommand's own constructor is slow, as namedtuples go through
+  # keyword handling.
+  command = tuple.__new__
   for line in input:
-    m = re.match('(G0[01]) X([\d\.]+) Y([\d\.]+)', line)
-    if m:
-      x = float(m.group(2))
-      y = float(m.group(3))
-      waypoints.append((x, y))
-
-    m = re.match('(G0[23]) X([-\d\.]+) Y([-\d\.]+) (Z[-\d\.]+)? I([-\d\.]+) J([-\d\.]+)', line)
-    if m:
-      if len(waypoints) == 0:
-        print sys.stderr, 'Warning! Unable to execute G02/G03 without known previous position.'
-        print sys.stderr, line
+    m = simple(line)
+    if m is not None:
+      (g, nx, ny, nz, i, j, nf) = m.groups()
+      if nz is not None:
+        z = float(nz)
+      if nf is not None:
+        f = float(nf)
+      if nx is None:
+        mode = modes[g]
         continue
-      (curx, cury) = waypoints[-1]
-      x = float(m.group(2))
-      y = float(m.group(3))
-      i = float(m.group(5))
-      j = float(m.group(6))
-      cw = False
-      if m.group(1) == 'G03':
-        # Docs say that G02 is clockwise, but maybe my math is wrong
-        # (or I'm flipped around in the y-axis) since G03 needs to
-        # be CW for this to work.
-        cw = True
-      curve = doArc(curx, cury, x, y, curx+i, cury+j, cw)
-      for pt in curve:
-        waypoints.append(pt)
+      if i is not None:
+        mode = modes[g]
+        x = float(nx)
+        y = float(ny)
+        yield command(GcodeCommand, (mode, x, y, float(i), float(j), f, z))
+        continue
+      if g < '2':
+        mode = modes[g]
+        x = float(nx)
+        y = float(ny)
+        yield command(GcodeCommand, (mode, x, y, 0.0, 0.0, f, z))
+        continue
+    elif blank(line) is not None:
+      continue
+
+    if '(' in line or ';' in line:
+      line = _GCODE_COMMENT.sub('', line)
+    words = _GCODE_WORD.findall(line)
+    if not words:
+      continue
+    words = dict(words)
+    if 'G' in words:
+      mode = modes.get(words['G'], mode)
+    if 'F' in words:
+      f = float(words['F'])
+    if 'Z' in words:
+      z = float(words['Z'])
+    nx = words.get('X')
+    ny = words.get('Y')
+    if (nx is None and ny is None) or mode is None:
+      continue
+    i = words.get('I')
+    j = words.get('J')
+    if mode >= 2 and i is None and j is None:
+      # Radius-format arcs are not supported; skip the move entirely.
+      print('Warning! Ignoring G0%d without I/J center offsets: %s' %
+            (mode, line.strip()), file=sys.stderr)
+      continue
+    nx = x if nx is None else float(nx)
+    ny = y if ny is None else float(ny)
+    if nx is None or ny is None:
+      print('Warning! Ignoring move without known previous position: %s' %
+            line.strip(), file=sys.stderr)
+      continue
+    x = nx
+    y = ny
+    yield GcodeCommand(mode, x, y,
+                       0.0 if i is None else float(i),
+                       0.0 if j is None else float(j), f, z)
+
+
+# Expand a stream of GcodeCommands into runs of (x, y) waypoints, one
+# list per command, with arcs broken up into line segments. Commands
+# that cannot be executed yield an empty list.
+def expandCommands(commands, max_chord=None):
+  cur = None
+  # Unpacking each command is quicker than reading its fields by name.
+  for (g, x, y, i, j, f, z) in commands:
+    if g < 2:
+      cur = (x, y)
+      yield [cur]
+      continue
+    if cur is None:
+      print('Warning! Unable to execute G02/G03 without known previous position.', file=sys.stderr)
+      yield []
+      continue
+    (curx, cury) = cur
+    # Docs say that G02 is clockwise, but maybe my math is wrong
+    # (or I'm flipped around in the y-axis) since G03 needs to
+    # be CW for this to work.
+    cw = (g == 3)
+    yield doArc(curx, cury, x, y, curx+i, cury+j, cw, max_chord=max_chord)
+    cur = (x, y)
+
+
+# Bounding box (minx, maxx, miny, maxy) of the path traced by a stream
+# of GcodeCommands, ignoring the final return to (0, 0) that parseGcode
+# trims off (unless trim is False).
+def commandBounds(commands, trim=True):
+  bounds = []
+  cur = None
+  pending = None
+  for cmd in commands:
+    if pending is not None:
+      bounds.append(pending)
+      pending = None
+    if cmd.g >= 2 and cur is not None:
+      (curx, cury) = cur
+      (minx, maxx, miny, maxy) = arcBounds(curx, cury, cmd.x, cmd.y,
+                                           curx+cmd.i, cury+cmd.j, cmd.g == 3)
+      bounds += [(minx, miny), (maxx, maxy)]
+    elif cmd.g < 2:
+      pending = (cmd.x, cmd.y)
+    cur = (cmd.x, cmd.y)
+    # Fold the points seen so far, to keep memory use constant.
+    if len(bounds) > 2:
+      (minx, maxx, miny, maxy) = pointBounds(bounds)
+      bounds = [(minx, miny), (maxx, maxy)]
+  if pending is not None and (not trim or pending != (0., 0.)):
+    bounds.append(pending)
+  return pointBounds(bounds)
+
+
+# Batched version of expandCommands that expands all arcs with doArcs.
+# Takes a list of GcodeCommands and returns an (N, 2) array of waypoints
+# along with the number of waypoints produced by each command.
+def vectorizedWaypoints(commands, max_chord=None):
+  counts = np.zeros(len(commands), dtype=int)
+  if not commands:
+    return (np.empty((0, 2)), counts)
+  # Arcs before the first G00/G01 have no known start, as in
+  # expandCommands.
+  skip = 0
+  while skip < len(commands) and commands[skip].g >= 2:
+    print('Warning! Unable to execute G02/G03 without known previous position.', file=sys.stderr)
+    skip += 1
+  cmds = np.array([cmd[:5] for cmd in commands[skip:]], dtype=float).reshape(-1, 5)
+  g = cmds[:, 0]
+  xy = cmds[:, 1:3]
+  is_arc = (g >= 2)
+  starts = np.roll(xy, 1, axis=0)[is_arc]
+  (arcpts, arccounts) = doArcs(starts, xy[is_arc],
+                               starts + cmds[is_arc, 3:5], g[is_arc] == 3,
+                               max_chord=max_chord)
+
+  # Splice the arc points in between the line endpoints.
+  counts[skip:] = 1
+  counts[skip:][is_arc] = arccounts
+  from_arc = np.repeat(is_arc, counts[skip:])
+  waypoints = np.empty((counts.sum(), 2))
+  waypoints[from_arc] = arcpts
+  waypoints[~from_arc] = xy[~is_arc]
+  return (waypoints, counts)
+
+
+# Tokenize the input, returning the commands and the max_chord to use
+# when expanding their arcs (see parseGcode).
+def prepareCommands(input, vectorized=False, chord_error=None):
+  return chordCommands(tokenizeGcode(input), vectorized, chord_error)
+
+
+# Get a stream of GcodeCommands ready to expand, returning them (as a
+# list, if the whole drawing has to be seen first) and the max_chord to
+# use for their arcs.
+def chordCommands(commands, vectorized=False, chord_error=None):
+  max_chord = None
+  if chord_error is not None or vectorized:
+    commands = list(commands)
+  if chord_error is not None and commands:
+    max_chord = chord_error / screenScale(*commandBounds(commands))
+  return (commands, max_chord)
 
 
+# Parse G-code into a list of (x, y) waypoints. With vectorized=True,
+# arcs are expanded in one batch with numpy, which is much faster on
+# arc-heavy drawings but may differ from doArc in the last few bits.
+#
+# If chord_error is given, arcs are split into as few segments as
+# possible while keeping within chord_error of the true curve, measured
+# in final stepper steps (i.e. after scaleToScreen).
+def parseGcode(input, vectorized=False, chord_error=None):
+  (commands, max_chord) = prepareCommands(input, vectorized, chord_error)
+  return expandWaypoints(commands, max_chord, vectorized)
+
+
+# The second half of parseGcode: expand GcodeCommands into a list of
+# waypoints.
+def expandWaypoints(commands, max_chord=None, vectorized=False):
+  if vectorized:
+    waypoints = [tuple(pt) for pt in
+                 vectorizedWaypoints(commands, max_chord)[0].tolist()]
+  else:
+    waypoints = list(itertools.chain.from_iterable(
+        expandCommands(commands, max_chord)))
+
   # Trim off (0, 0) point tacked on at end by Inkscape GCode plugin
-  if waypoints[-1] == (0., 0.):
+  if waypoints and waypoints[-1] == (0., 0.):
     waypoints = waypoints[:-1]
 
   return waypoints
 
 
-def scaleToScreen(pts):
-  # Find min and max ranges.
-  minx = min([x for (x, y) in pts])
-  maxx = max([x for (x, y) in pts])
-  miny = min([y for (x, y) in pts])
-  maxy = max([y for (x, y) in pts])
+# Like parseGcode, but returns the drawing as a list of subpaths, each a
+# list of waypoints. A new subpath starts at every G00 rapid move.
+def parseSubpaths(input, vectorized=False, chord_error=None):
+  (commands, max_chord) = prepareCommands(input, vectorized, chord_error)
+  return expandSubpaths(commands, max_chord, vectorized)
+
+
+# The second half of parseSubpaths: expand GcodeCommands into a list of
+# subpaths.
+def expandSubpaths(commands, max_chord=None, vectorized=False):
+  commands = list(commands)
+
+  if vectorized:
+    (waypoints, counts) = vectorizedWaypoints(commands, max_chord)
+    waypoints = [tuple(pt) for pt in waypoints.tolist()]
+    ends = np.cumsum(counts).tolist()
+    runs = [waypoints[end-count:end] for (end, count) in zip(ends, counts.tolist())]
+  else:
+    runs = expandCommands(commands, max_chord)
+
+  subpaths = groupSubpaths(commands, runs)
+
+  # Trim off (0, 0) point tacked on at end by Inkscape GCode plugin
+  if subpaths and subpaths[-1] and subpaths[-1][-1] == (0., 0.):
+    subpaths[-1].pop()
+  return [path for path in subpaths if path]
+
+
+# Gather the runs of waypoints for each command into subpaths, starting
+# a new one at every G00.
+def groupSubpaths(commands, runs):
+  subpaths = []
+  for (cmd, run) in zip(commands, runs):
+    if cmd.g == 0 or not subpaths:
+      subpaths.append([])
+    subpaths[-1].extend(run)
+  return subpaths
+
+
+# True if line is a G00 rapid to an explicit X and Y. Such a line sets
+# the motion mode and position, so the G-code can be split just before
+# it and each piece parsed on its own. The modal feed rate and Z do carry
+# across it, so a piece's commands start with f and z of None where the
+# sequential parse has the previous values; this is only safe because
+# nothing downstream of the tokenizer uses f or z.
+def startsPath(line):
+  if line.lstrip()[:2] != 'G0':
+    return False
+  words = dict(_GCODE_WORD.findall(_GCODE_COMMENT.sub('', line)))
+  return words.get('G') in ('0', '00') and 'X' in words and 'Y' in words
+
+
+# Split lines at path boundaries (see startsPath) into about count
+# pieces of similar size.
+def splitPaths(lines, count):
+  target = max(1, len(lines) // max(1, count))
+  pieces = []
+  start = 0
+  for (i, line) in enumerate(lines):
+    if i - start >= target and startsPath(line):
+      pieces.append(lines[start:i])
+      start = i
+  pieces.append(lines[start:])
+  return pieces
+
+
+# Worker for parallelParse: the bounding box of one piece of G-code, or
+# None if it has no moves (or only the final move back to the origin).
+def pieceBounds(job):
+  (lines, last) = job
+  commands = list(tokenizeGcode(lines))
+  if not commands:
+    return None
+  try:
+    return commandBounds(commands, trim=last)
+  except ValueError:
+    return None
+
+
+# Worker for parallelParse: expand one piece of G-code into waypoints
+# (or subpaths), returning them with its command and arc counts.
+def parsePiece(job):
+  (lines, max_chord, subpaths) = job
+  commands = list(tokenizeGcode(lines))
+  runs = expandCommands(commands, max_chord)
+  if subpaths:
+    result = [path for path in groupSubpaths(commands, runs) if path]
+  else:
+    result = list(itertools.chain.from_iterable(runs))
+  return (result, len(commands), sum(1 for cmd in commands if cmd.g >= 2))
+
+
+# Like parseGcode (or parseSubpaths, if subpaths is True), but split
+# into pieces at path boundaries that are parsed in a pool of jobs
+# worker processes and then joined back up in order. The result is
+# identical to the sequential parse.
+def parallelParse(input, jobs=None, chord_error=None, subpaths=False,
+                  stats=None):
+  lines = list(input)
+  jobs = jobs or multiprocessing.cpu_count()
+  pieces = splitPaths(lines, 4 * jobs)
+  pool = multiprocessing.Pool(jobs)
+  try:
+    max_chord = None
+    if chord_error is not None:
+      bounds = pool.map(pieceBounds, [(piece, i == len(pieces) - 1)
+                                      for (i, piece) in enumerate(pieces)])
+      bounds = [b for b in bounds if b is not None]
+      if bounds:
+        (minxs, maxxs, minys, maxys) = zip(*bounds)
+        max_chord = chord_error / screenScale(min(minxs), max(maxxs),
+                                              min(minys), max(maxys))
+    results = pool.map(parsePiece, [(piece, max_chord, subpaths)
+                                    for piece in pieces], chunksize=1)
+  finally:
+    pool.close()
+    pool.join()
+
+  if stats is not None:
+    for key in ('lines', 'commands', 'arcs'):
+      stats.setdefault(key, 0)
+    stats['lines'] += len(lines)
+    stats['commands'] += sum(r[1] for r in results)
+    stats['arcs'] += sum(r[2] for r in results)
+  waypoints = list(itertools.chain.from_iterable(r[0] for r in results))
+
+  # Trim off (0, 0) point tacked on at end by Inkscape GCode plugin
+  if subpaths:
+    if waypoints and waypoints[-1][-1] == (0., 0.):
+      waypoints[-1].pop()
+    return [path for path in waypoints if path]
+  if waypoints and waypoints[-1] == (0., 0.):
+    waypoints = waypoints[:-1]
+  return waypoints
+
+
+# Scale factor that fits a bounding box onto the Etch-a-Sketch. Raises
+# ValueError if the box is a single point.
+def screenScale(minx, maxx, miny, maxy, width=WIDTH_STEPS,
+                height=HEIGHT_STEPS):
   dx = maxx - minx
   dy = maxy - miny
+  if dx <= 0 and dy <= 0:
+    raise ValueError('drawing has no extent to scale')
   # Scale longest axis to fit.
   if dx > dy:
-    scale = WIDTH_STEPS / dx
+    return width / dx
   else:
-    scale = HEIGHT_STEPS / dy
+    return height / dy
+
+
+# Find min and max ranges, as (minx, maxx, miny, maxy), in a single
+# pass over any iterable of points. Raises ValueError if there are none.
+def pointBounds(pts):
+  it = iter(pts)
+  try:
+    (minx, miny) = (maxx, maxy) = next(it)
+  except StopIteration:
+    raise ValueError('no drawable points')
+  for (x, y) in it:
+    if x < minx:
+      minx = x
+    elif x > maxx:
+      maxx = x
+    if y < miny:
+      miny = y
+    elif y > maxy:
+      maxy = y
+  return (minx, maxx, miny, maxy)
+
+
+def scaleToScreen(pts, width=WIDTH_STEPS, height=HEIGHT_STEPS):
+  (minx, maxx, miny, maxy) = pointBounds(pts)
+  scale = screenScale(minx, maxx, miny, maxy, width, height)
   ret = []
   for (x, y) in pts:
     tx = (x-minx) * scale
@@ -143,21 +625,2225 @@ def removeDuplicates(pts):
   return ret
 
 
-# Parse and process the input file.
-waypoints = parseGcode(fileinput.input())
-waypoints = scaleToScreen(waypoints)
-waypoints = removeDuplicates(waypoints)
-
-# Write out the output.
-print '#define GCODE_NUM_POINTS %d' % len(waypoints)
-print 'const std::pair<long, long> _GCODE_POINTS[%d] = {' % len(waypoints)
-for (x, y) in waypoints:
-  print '  { std::make_pair(%d, %d) },' % (x, y)
-print '};'
-
-# Draw it on the screen.
-xes = [x for (x, y) in waypoints]
-yes = [y for (x, y) in waypoints]
-plt.plot(xes, yes)
-plt.axes().set_aspect('equal')
-plt.show()
+_izip = getattr(itertools, 'izip', zip)
+
+
+# A list of (x, y) stepper positions, packed into a single flat array of
+# 32-bit ints (the size of the firmware's long) rather than a Python
+# tuple per point. Indexing and iterating give (x, y) tuples, and
+# slicing gives another StepArray.
+class StepArray(object):
+  def __init__(self, points=()):
+    self.data = array.array('i', itertools.chain.from_iterable(points))
+
+  @classmethod
+  def fromArray(cls, data):
+    steps = cls()
+    steps.data = data
+    return steps
+
+  def __len__(self):
+    return len(self.data) // 2
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      (start, stop, stride) = i.indices(len(self))
+      if stride == 1:
+        return StepArray.fromArray(self.data[2*start:2*max(start, stop)])
+      return StepArray(self[k] for k in range(start, stop, stride))
+    if i < 0:
+      i += len(self)
+    if not 0 <= i < len(self):
+      raise IndexError('StepArray index out of range')
+    return (self.data[2*i], self.data[2*i+1])
+
+  def __iter__(self):
+    it = iter(self.data)
+    return _izip(it, it)
+
+  def __eq__(self, other):
+    if isinstance(other, StepArray):
+      return self.data == other.data
+    return list(self) == [tuple(pt) for pt in other]
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __repr__(self):
+    return 'StepArray(%r)' % list(self)
+
+  # For numpy: an (N, 2) int32 view of the points.
+  def __array__(self, dtype=None, copy=None):
+    steps = np.frombuffer(self.data, dtype=np.int32).reshape(-1, 2)
+    return steps.astype(dtype or np.int32)
+
+  def append(self, point):
+    self.data.extend(point)
+
+  def extend(self, points):
+    self.data.extend(itertools.chain.from_iterable(points))
+
+
+# Scale pts onto a width by height screen (as scaleToScreen) and round
+# down to whole steps, as EscherStepper::push does, dropping repeated
+# points. Returns a StepArray. This is the Scale and Dedup stages in a
+# single faster pass (see ScaleSteps). Nothing is left of minx or below
+# miny, so int() rounds down just as floor() would.
+def scaleToSteps(pts, width=WIDTH_STEPS, height=HEIGHT_STEPS):
+  (minx, maxx, miny, maxy) = pointBounds(pts)
+  scale = screenScale(minx, maxx, miny, maxy, width, height)
+  data = array.array('i')
+  append = data.append
+  (lastx, lasty) = (None, None)
+  for (x, y) in pts:
+    tx = int((x-minx) * scale)
+    ty = int((y-miny) * scale)
+    if tx != lastx or ty != lasty:
+      append(tx)
+      append(ty)
+      (lastx, lasty) = (tx, ty)
+  return StepArray.fromArray(data)
+
+
+# The point of pts[first+1:last] furthest from the segment pts[first]
+# to pts[last], as (squared distance, index), or (-1.0, first) if there
+# are none. Distances are to the segment rather than the infinite line,
+# so points beyond either end count by how far they overshoot. If limit2
+# is given, stops at the first point more than that (squared) away.
+def farthestPoint(pts, first, last, limit2=None):
+  (ax, ay) = pts[first]
+  (bx, by) = pts[last]
+  dx = bx - ax
+  dy = by - ay
+  length2 = dx*dx + dy*dy
+  worst = -1.0
+  index = first
+  for i in range(first+1, last):
+    (px, py) = pts[i]
+    ex = px - ax
+    ey = py - ay
+    if length2 > 0:
+      t = (ex*dx + ey*dy) / length2
+      if t > 1.0:
+        ex = px - bx
+        ey = py - by
+      elif t > 0.0:
+        ex -= t * dx
+        ey -= t * dy
+    d2 = ex*ex + ey*ey
+    if d2 > worst:
+      worst = d2
+      index = i
+      if limit2 is not None and worst > limit2:
+        break
+  return (worst, index)
+
+
+# Runs longer than this many points are split in the middle by
+# simplifyPath, rather than at their furthest point.
+SIMPLIFY_RUN = 1024
+
+
+# Where simplifyPath splits the run pts[first:last+1], as (squared
+# distance, index): its furthest point from the segment joining its
+# ends (see farthestPoint). Ramer-Douglas-Peucker is quadratic when
+# every split only peels a few points off a long run, as happens all
+# the way round a spiral, so long runs are split in the middle instead.
+# That keeps the whole simplification O(n log n) at the cost of at most
+# a point or so per SIMPLIFY_RUN, and every dropped point is still
+# within tolerance.
+def simplifySplit(pts, first, last):
+  (worst, index) = farthestPoint(pts, first, last)
+  if last - first > SIMPLIFY_RUN:
+    index = (first + last) // 2
+  return (worst, index)
+
+
+# Simplify a polyline with the Ramer-Douglas-Peucker algorithm, dropping
+# points so that the path never strays more than tolerance (in the same
+# units as the points) from the original. Distances are measured to
+# segments rather than to infinite lines, so retraced strokes survive.
+# Runs in O(n log n) (see simplifySplit).
+def simplifyPath(pts, tolerance):
+  n = len(pts)
+  if n < 3:
+    return list(pts)
+  tolerance2 = tolerance * tolerance
+  keep = [False] * n
+  keep[0] = keep[n-1] = True
+  stack = [(0, n-1)]
+  while stack:
+    (first, last) = stack.pop()
+    (worst, index) = simplifySplit(pts, first, last)
+    if worst > tolerance2:
+      keep[index] = True
+      stack.append((first, index))
+      stack.append((index, last))
+  return [pt for (pt, k) in zip(pts, keep) if k]
+
+
+# The squared tolerance below which simplifyPath would keep each of pts
+# (infinite for the end points). Ramer-Douglas-Peucker splits runs the
+# same way whatever the tolerance, and a point survives if its own split
+# and every split above it are further off than the tolerance, so
+# simplifyPath(pts, t) keeps exactly the points whose value here is
+# more than t*t.
+def simplifyThresholds(pts):
+  n = len(pts)
+  inf = float('inf')
+  thresholds = [0.0] * n
+  if n == 0:
+    return thresholds
+  thresholds[0] = thresholds[n-1] = inf
+  stack = [(0, n-1, inf)]
+  while stack:
+    (first, last, limit) = stack.pop()
+    if last - first < 2:
+      continue
+    (worst, index) = simplifySplit(pts, first, last)
+    limit = min(limit, worst)
+    thresholds[index] = limit
+    stack.append((first, index, limit))
+    stack.append((index, last, limit))
+  return thresholds
+
+
+# A uniform grid over points, used for nearest-neighbour queries when
+# ordering subpaths. Each entry is stored under its point with a key.
+class PointGrid:
+  def __init__(self, points, cell):
+    self.cell = cell
+    self.cells = collections.defaultdict(set)
+    self.points = {}
+    for (key, pt) in points:
+      self.add(key, pt)
+
+  def _cell(self, pt):
+    return (int(math.floor(pt[0] / self.cell)), int(math.floor(pt[1] / self.cell)))
+
+  def add(self, key, pt):
+    self.points[key] = pt
+    self.cells[self._cell(pt)].add(key)
+
+  def remove(self, key):
+    cell = self.cells[self._cell(self.points.pop(key))]
+    cell.discard(key)
+
+  # The cells ring cells away from (cx, cy): the perimeter of the
+  # (2*ring+1)-cell square around it.
+  @staticmethod
+  def _ring(cx, cy, ring):
+    if ring == 0:
+      yield (cx, cy)
+      return
+    for gx in range(cx - ring, cx + ring + 1):
+      yield (gx, cy - ring)
+      yield (gx, cy + ring)
+    for gy in range(cy - ring + 1, cy + ring):
+      yield (cx - ring, gy)
+      yield (cx + ring, gy)
+
+  # Return up to k (distance, key) pairs closest to pt, nearest first.
+  def nearest(self, pt, k=1):
+    (cx, cy) = self._cell(pt)
+    found = []
+    ring = 0
+    while len(self.points) > 0:
+      for cell in self._ring(cx, cy, ring):
+        for key in self.cells.get(cell, ()):
+          (x, y) = self.points[key]
+          found.append((math.hypot(x - pt[0], y - pt[1]), key))
+      found.sort()
+      del found[k:]
+      # Anything in later rings is at least this far away.
+      if len(found) >= min(k, len(self.points)) and found[-1][0] <= ring * self.cell:
+        break
+      ring += 1
+    return found
+
+
+def _distance(a, b):
+  return math.hypot(a[0] - b[0], a[1] - b[1])
+
+
+# Total distance travelled between subpaths, starting at start (or the
+# beginning of the first subpath). Subpaths are drawn from first to last
+# point, so this is the length of all the connecting strokes.
+def pathTravel(subpaths, start=None):
+  if not subpaths:
+    return 0.0
+  if start is None:
+    start = subpaths[0][0]
+  total = _distance(start, subpaths[0][0])
+  for (prev, cur) in zip(subpaths, subpaths[1:]):
+    total += _distance(prev[-1], cur[0])
+  return total
+
+
+# Rotate a closed subpath (whose first and last points are the same) so
+# that it starts and ends at its j'th point.
+def rotateLoop(path, j):
+  loop = path[:-1]
+  return loop[j:] + loop[:j+1]
+
+
+# Reorder (and where useful, reverse) subpaths to reduce the distance
+# travelled between them. Closed subpaths may also be entered at any of
+# their points.
+#
+# A greedy nearest-neighbour tour from start is built with a PointGrid
+# over the candidate entry points and then improved with 2-opt moves,
+# each of which reverses a run of subpaths. Moves are only tried towards
+# the k nearest subpaths, to keep this fast on drawings with thousands
+# of subpaths. The original order is kept if it is already shorter.
+def orderSubpaths(subpaths, start=None, k=10, max_passes=10):
+  n = len(subpaths)
+  if n < 2:
+    return list(subpaths)
+  if start is None:
+    start = subpaths[0][0]
+  xs = [pt[0] for path in subpaths for pt in (path[0], path[-1])]
+  ys = [pt[1] for path in subpaths for pt in (path[0], path[-1])]
+  cell = max(max(xs) - min(xs), max(ys) - min(ys), 1e-9) / math.sqrt(n)
+
+  # Greedy nearest-neighbour tour. Arriving at an open subpath's last
+  # point means drawing it backwards.
+  closed = [len(path) > 2 and path[0] == path[-1] for path in subpaths]
+  entries = {}
+  for (i, path) in enumerate(subpaths):
+    if closed[i]:
+      entries[i] = range(len(path) - 1)
+    else:
+      entries[i] = sorted(set([0, len(path) - 1]))
+  # Closed subpaths can put thousands of entry points in one cell of the
+  # subpath-sized grid, so size this one's cells for the entry points.
+  count = sum(len(entries[i]) for i in range(n))
+  grid = PointGrid([((i, j), subpaths[i][j]) for i in range(n)
+                    for j in entries[i]], cell * math.sqrt(n / float(count)))
+  paths = []
+  pos = start
+  while grid.points:
+    (_, (i, j)) = grid.nearest(pos)[0]
+    for entry in entries[i]:
+      grid.remove((i, entry))
+    path = subpaths[i]
+    if closed[i]:
+      path = rotateLoop(path, j)
+    elif j > 0:
+      path = path[::-1]
+    paths.append(path)
+    pos = path[-1]
+
+  # 2-opt: reversing order[a..b] (and flipping each subpath in it)
+  # replaces the edges into a and out of b, leaving the rest unchanged.
+  order = list(range(n))
+  flipped = [False] * n
+  where = list(range(n))
+
+  def first(p):
+    return paths[order[p]][-1 if flipped[p] else 0]
+
+  def last(p):
+    return paths[order[p]][0 if flipped[p] else -1]
+
+  def tryReverse(a, b):
+    prev = start if a == 0 else last(a-1)
+    before = _distance(prev, first(a))
+    after = _distance(prev, last(b))
+    if b + 1 < n:
+      before += _distance(last(b), first(b+1))
+      after += _distance(first(a), first(b+1))
+    if after >= before - 1e-9:
+      return False
+    order[a:b+1] = order[a:b+1][::-1]
+    flipped[a:b+1] = [not f for f in flipped[a:b+1][::-1]]
+    for p in range(a, b+1):
+      where[order[p]] = p
+    return True
+
+  endpoints = [((i, end), paths[i][-end]) for i in range(n) for end in (0, 1)]
+  grid = PointGrid(endpoints, cell)
+  neighbours = {}
+  for (key, pt) in endpoints:
+    neighbours[key] = [i for (_, (i, _)) in grid.nearest(pt, k + 2) if i != key[0]]
+  neighbours[None] = [i for (_, (i, _)) in grid.nearest(start, k)]
+
+  for _ in range(max_passes):
+    improved = False
+    for p in range(n):
+      # Moves that join the end of p-1 to a nearby subpath...
+      key = None if p == 0 else (order[p-1], 0 if flipped[p-1] else 1)
+      for i in neighbours[key]:
+        if where[i] >= p and tryReverse(p, where[i]):
+          improved = True
+      # ... and moves that join a nearby subpath to the start of p.
+      if p > 0:
+        for i in neighbours[(order[p], 1 if flipped[p] else 0)]:
+          if where[i] < p and tryReverse(where[i], p-1):
+            improved = True
+    if not improved:
+      break
+
+  ordered = [paths[i][::-1] if f else paths[i] for (i, f) in zip(order, flipped)]
+
+  # Finally, re-enter each closed subpath at the point closest to its
+  # neighbours now that they are known.
+  for p in range(n):
+    path = ordered[p]
+    if len(path) > 2 and path[0] == path[-1]:
+      prev = start if p == 0 else ordered[p-1][-1]
+      nxt = ordered[p+1][0] if p + 1 < n else None
+      def cost(pt):
+        return _distance(prev, pt) + (_distance(pt, nxt) if nxt else 0.0)
+      j = min(range(len(path) - 1), key=lambda j: cost(path[j]))
+      ordered[p] = rotateLoop(path, j)
+
+  if pathTravel(ordered, start) >= pathTravel(subpaths, start):
+    return list(subpaths)
+  return ordered
+
+
+# Distance from point p to the segment a-b.
+def segmentDistance(p, a, b):
+  return math.sqrt(farthestPoint((a, p, b), 0, 2)[0])
+
+
+# A uniform grid over the segments drawn so far, for asking whether a
+# new segment would only go over ink that is already there. Each segment
+# is filed under every cell it passes through.
+class SegmentGrid:
+  def __init__(self, cell):
+    self.cell = cell
+    self.cells = collections.defaultdict(list)
+    self.segments = []
+
+  def _cell(self, pt):
+    return (int(math.floor(pt[0] / self.cell)), int(math.floor(pt[1] / self.cell)))
+
+  def add(self, a, b):
+    index = len(self.segments)
+    self.segments.append((a, b))
+    steps = int(_distance(a, b) / (self.cell / 2.0)) + 1
+    for s in range(steps + 1):
+      t = float(s) / steps
+      cell = self.cells[self._cell((a[0] + t * (b[0] - a[0]),
+                                    a[1] + t * (b[1] - a[1])))]
+      if not cell or cell[-1] != index:
+        cell.append(index)
+
+  # Distance from pt to the nearest segment, if it is within one cell.
+  def distance(self, pt):
+    (cx, cy) = self._cell(pt)
+    best = float('inf')
+    for gx in (cx - 1, cx, cx + 1):
+      for gy in (cy - 1, cy, cy + 1):
+        for index in self.cells.get((gx, gy), ()):
+          (a, b) = self.segments[index]
+          best = min(best, segmentDistance(pt, a, b))
+    return best
+
+  # True if every part of a-b is within tolerance of some segment.
+  def covers(self, a, b, tolerance):
+    steps = int(_distance(a, b) / tolerance) + 1
+    for s in range(steps + 1):
+      t = float(s) / steps
+      if self.distance((a[0] + t * (b[0] - a[0]),
+                        a[1] + t * (b[1] - a[1]))) > tolerance:
+        return False
+    return True
+
+
+# Length of the path through pts.
+def pathLength(pts):
+  return sum(_distance(a, b) for (a, b) in zip(pts, pts[1:]))
+
+
+# Drop strokes that only go back over ink already drawn. Each run of
+# covered segments is replaced by the fewest straight hops between its
+# points that are themselves covered, so the path stays continuous and
+# nothing new is drawn; a covered run at the very end is dropped. pts
+# and tolerance are in steps.
+def removeOverlaps(pts, tolerance):
+  n = len(pts)
+  if n < 2:
+    return list(pts)
+  grid = SegmentGrid(max(2.0 * tolerance, 2.0))
+  out = [pts[0]]
+  i = 0
+  while i < n - 1:
+    if not grid.covers(pts[i], pts[i+1], tolerance):
+      grid.add(pts[i], pts[i+1])
+      out.append(pts[i+1])
+      i += 1
+      continue
+    last = i + 1
+    while last < n - 1 and grid.covers(pts[last], pts[last+1], tolerance):
+      last += 1
+    if last == n - 1:
+      break
+    # Gallop then bisect for the furthest point we can hop to.
+    while i < last:
+      (good, step, bad) = (i + 1, 1, last + 1)
+      if grid.covers(pts[i], pts[last], tolerance):
+        good = last
+      while good < last:
+        probe = min(good + step, last)
+        if not grid.covers(pts[i], pts[probe], tolerance):
+          bad = probe
+          break
+        (good, step) = (probe, step * 2)
+      while bad - good > 1:
+        mid = (good + bad) // 2
+        if grid.covers(pts[i], pts[mid], tolerance):
+          good = mid
+        else:
+          bad = mid
+      if pts[good] != out[-1]:
+        out.append(pts[good])
+      i = good
+  return out
+
+
+# Largest radius (in G-code units) fitArcs will use. Flatter runs are
+# left as lines, which keeps the firmware's float arithmetic accurate.
+MAX_ARC_RADIUS = 1000.0
+
+# The firmware's doArc splits arcs into segments this long (its
+# CM_PER_SEGMENT, in EscherParser.cpp), so fitted arcs are checked
+# against the chords it will draw rather than doArc's finer default.
+FIRMWARE_CM_PER_SEGMENT = 5.0
+
+
+# Largest distance from pts[first+1:last] to the line pts[first] to
+# pts[last], or None if any point is more than tolerance away.
+def lineDeviation(pts, first, last, tolerance):
+  limit2 = tolerance * tolerance
+  worst = farthestPoint(pts, first, last, limit2)[0]
+  if worst > limit2:
+    return None
+  return math.sqrt(max(worst, 0.0))
+
+
+# Fit an arc through pts[first], pts[last] and the point midway between
+# them. Returns (cx, cy, cw, deviation) if every point in between lies
+# on the arc, in order, within tolerance of the chords the firmware's
+# doArc will draw for it (see FIRMWARE_CM_PER_SEGMENT); otherwise None.
+def arcDeviation(pts, first, last, tolerance):
+  (ax, ay) = pts[first]
+  (bx, by) = pts[(first + last) // 2]
+  (ex, ey) = pts[last]
+  d = 2.0 * (ax * (by - ey) + bx * (ey - ay) + ex * (ay - by))
+  if d == 0:
+    return None
+  a2 = ax*ax + ay*ay
+  b2 = bx*bx + by*by
+  e2 = ex*ex + ey*ey
+  cx = (a2 * (by - ey) + b2 * (ey - ay) + e2 * (ay - by)) / d
+  cy = (a2 * (ex - bx) + b2 * (ax - ex) + e2 * (bx - ax)) / d
+  # Anticlockwise is G03, which doArc calls cw.
+  cw = d > 0
+  (radius, angle1, sweep) = arcSweep(ax, ay, ex, ey, cx, cy, cw)
+  sweep = abs(sweep)
+  if radius > MAX_ARC_RADIUS or sweep == 0 or sweep > 1.9 * math.pi:
+    return None
+  num_segments = int(math.floor(sweep * radius / FIRMWARE_CM_PER_SEGMENT))
+  if num_segments < 1:
+    return None
+  sagitta = radius * (1.0 - math.cos(sweep / (2.0 * num_segments)))
+  if sagitta > tolerance:
+    return None
+
+  direction = 1.0 if cw else -1.0
+  twopi = 2.0 * math.pi
+  worst = sagitta
+  previous = 0.0
+  for i in range(first+1, last):
+    (px, py) = pts[i]
+    dev = abs(math.hypot(px - cx, py - cy) - radius) + sagitta
+    if dev > tolerance:
+      return None
+    offset = (direction * (math.atan2(py - cy, px - cx) - angle1)) % twopi
+    if offset < previous or offset > sweep:
+      return None
+    previous = offset
+    worst = max(worst, dev)
+  return (cx, cy, cw, worst)
+
+
+# Longest run pts[first:last+1] (last >= first+least) for which fit
+# succeeds, found by galloping then bisecting. Returns (last, result),
+# or (None, None) if even the shortest run does not fit.
+def _longestFit(fit, pts, first, least, tolerance):
+  n = len(pts)
+  if first + least >= n:
+    return (None, None)
+  good = first + least
+  result = fit(pts, first, good, tolerance)
+  if result is None:
+    return (None, None)
+  step = least
+  bad = n
+  while good + step < n:
+    r = fit(pts, first, good + step, tolerance)
+    if r is None:
+      bad = good + step
+      break
+    (good, result) = (good + step, r)
+    step *= 2
+  else:
+    if good < n - 1:
+      r = fit(pts, first, n - 1, tolerance)
+      if r is not None:
+        return (n - 1, r)
+      bad = n - 1
+  while bad - good > 1:
+    mid = (good + bad) // 2
+    r = fit(pts, first, mid, tolerance)
+    if r is None:
+      bad = mid
+    else:
+      (good, result) = (mid, r)
+  return (good, result)
+
+
+# Replace runs of pts (in G-code units) with the fewest lines and arcs
+# that stay within tolerance of every point. Returns a list of
+# GcodeCommands (G01, G02 or G03) leading on from pts[0], and the
+# largest deviation of any point from the path they draw.
+def fitArcs(pts, tolerance):
+  commands = []
+  worst = 0.0
+  first = 0
+  while first < len(pts) - 1:
+    (line_last, line_dev) = _longestFit(lineDeviation, pts, first, 1,
+                                        tolerance)
+    (arc_last, arc) = _longestFit(arcDeviation, pts, first, 2, tolerance)
+    if arc_last is not None and arc_last > line_last:
+      (cx, cy, cw, dev) = arc
+      (x, y) = pts[arc_last]
+      (px, py) = pts[first]
+      commands.append(GcodeCommand(3 if cw else 2, x, y, cx - px, cy - py,
+                                   None, None))
+      first = arc_last
+    else:
+      (x, y) = pts[line_last]
+      commands.append(GcodeCommand(1, x, y, None, None, None, None))
+      (first, dev) = (line_last, line_dev)
+    worst = max(worst, dev)
+  return (commands, worst)
+
+
+# Write subpaths of fitted commands (as (start, commands) pairs) back out
+# as G-code that EscherParser can read.
+def writeFittedGcode(paths, out, tolerance):
+  out.write('(Arc-fitted by gcoderip.py to within %g)\n' % tolerance)
+  out.write('G21 (All units in mm)\n')
+  for ((x, y), commands) in paths:
+    out.write('G00 X%.6f Y%.6f\n' % (x, y))
+    for cmd in commands:
+      if cmd.g == 1:
+        out.write('G01 X%.6f Y%.6f\n' % (cmd.x, cmd.y))
+      else:
+        out.write('G%02d X%.6f Y%.6f I%.6f J%.6f\n' %
+                  (cmd.g, cmd.x, cmd.y, cmd.i, cmd.j))
+  # Inkscape's plugin always finishes with a move back to the origin.
+  out.write('G00 X0.0000 Y0.0000\n')
+  out.write('M2\n')
+
+
+# Speed limits for planMotion, in steps per second (and per second
+# squared). The Escher firmware drives every move at MAX_SPEED (50) and
+# stops at each waypoint, so BASE_SPEED matches that for comparison.
+BASE_SPEED = 50.0
+PLAN_MAX_SPEED = 200.0
+PLAN_ACCELERATION = 800.0
+# How far (in steps) the path may be imagined to cut a corner when
+# working out how fast it can be taken, as in GRBL.
+PLAN_JUNCTION_DEVIATION = 1.0
+
+
+# Plan the speed at which to pass through each waypoint (in steps), in
+# the style of GRBL's look-ahead planner. Each corner gets a speed limit
+# from its angle and the junction deviation, each segment a nominal
+# speed from max_speed on its longer axis, and forward and backward
+# passes then make sure no segment needs more than acceleration to get
+# from one point's speed to the next. Starts and ends at rest. Returns a
+# list of speeds, one per point.
+def planMotion(pts, max_speed=PLAN_MAX_SPEED, acceleration=PLAN_ACCELERATION,
+               junction_deviation=PLAN_JUNCTION_DEVIATION):
+  n = len(pts)
+  if n < 2:
+    return [0.0] * n
+  pts = [(int(x), int(y)) for (x, y) in pts]
+
+  # Length, unit direction and nominal speed of each segment. A
+  # zero-length segment keeps the direction of the one before it.
+  lengths = []
+  units = []
+  nominal = []
+  unit = (0.0, 0.0)
+  for ((x0, y0), (x1, y1)) in zip(pts, pts[1:]):
+    (dx, dy) = (x1 - x0, y1 - y0)
+    length = math.hypot(dx, dy)
+    if length > 0:
+      unit = (dx / length, dy / length)
+      nominal.append(max_speed * length / max(abs(dx), abs(dy)))
+    else:
+      nominal.append(max_speed)
+    lengths.append(length)
+    units.append(unit)
+
+  # Corner speed limits.
+  speeds = [0.0] * n
+  for i in range(1, n - 1):
+    (u, v) = (units[i-1], units[i])
+    limit = min(nominal[i-1], nominal[i])
+    cos_theta = -(u[0] * v[0] + u[1] * v[1])
+    if cos_theta > 0.999999:
+      # Reversal; come to a stop.
+      limit = 0.0
+    elif cos_theta > -0.999999:
+      sin_theta_d2 = math.sqrt(0.5 * (1.0 - cos_theta))
+      limit = min(limit, math.sqrt(acceleration * junction_deviation *
+                                   sin_theta_d2 / (1.0 - sin_theta_d2)))
+    speeds[i] = limit
+
+  # Backward pass: make sure we can always slow down in time...
+  for i in range(n - 2, 0, -1):
+    speeds[i] = min(speeds[i], math.sqrt(speeds[i+1] ** 2 +
+                                         2.0 * acceleration * lengths[i]))
+  # ... and forward pass: and speed up in time.
+  for i in range(1, n):
+    speeds[i] = min(speeds[i], math.sqrt(speeds[i-1] ** 2 +
+                                         2.0 * acceleration * lengths[i-1]))
+  return speeds
+
+
+# Estimated time to draw pts with the speeds from planMotion, following
+# a trapezoidal speed profile along each segment.
+def plannedTime(pts, speeds, max_speed=PLAN_MAX_SPEED,
+                acceleration=PLAN_ACCELERATION):
+  total = 0.0
+  pts = [(int(x), int(y)) for (x, y) in pts]
+  for i in range(len(pts) - 1):
+    ((x0, y0), (x1, y1)) = (pts[i], pts[i+1])
+    length = math.hypot(x1 - x0, y1 - y0)
+    if length == 0:
+      continue
+    cruise = max_speed * length / max(abs(x1 - x0), abs(y1 - y0))
+    (v0, v1) = (speeds[i], speeds[i+1])
+    peak = math.sqrt((2.0 * acceleration * length + v0 * v0 + v1 * v1) / 2.0)
+    if peak <= cruise:
+      total += ((peak - v0) + (peak - v1)) / acceleration
+    else:
+      ramps = (2.0 * cruise * cruise - v0 * v0 - v1 * v1) / (2.0 * acceleration)
+      total += (((cruise - v0) + (cruise - v1)) / acceleration +
+                (length - ramps) / cruise)
+  return total
+
+
+# Estimated time for the current firmware to draw pts: every move runs
+# at speed steps per second on its longer axis, stopping at each point.
+def constantSpeedTime(pts, speed=BASE_SPEED):
+  total = 0.0
+  pts = [(int(x), int(y)) for (x, y) in pts]
+  for ((x0, y0), (x1, y1)) in zip(pts, pts[1:]):
+    total += max(abs(x1 - x0), abs(y1 - y0)) / speed
+  return total
+
+
+# Write the speeds from planMotion as a table to go with the points.
+def writeSpeedsHeader(speeds, out, max_speed=PLAN_MAX_SPEED,
+                      acceleration=PLAN_ACCELERATION):
+  out.write('#define GCODE_MAX_SPEED %d\n' % max_speed)
+  out.write('#define GCODE_ACCELERATION %d\n' % acceleration)
+  out.write('// Speed (steps/s) to pass through each of _GCODE_POINTS.\n')
+  out.write('const uint16_t _GCODE_SPEEDS[%d] = {\n' % len(speeds))
+  for i in range(0, len(speeds), 16):
+    out.write('  %s,\n' % ', '.join(['%d' % s for s in speeds[i:i+16]]))
+  out.write('};\n')
+
+
+# Run the whole conversion on some G-code, returning the scaled
+# waypoints. The options are as for the command-line flags. If stats is
+# a dict, the number of lines, commands and arcs read are added to it,
+# along with a list of per-stage measurements (see Pipeline.run).
+# If jobs is given, the G-code is parsed by that many processes (see
+# parallelParse) and numpy is not used.
+def processGcode(input, numpy=False, chord_error=None, simplify=None,
+                 reorder=False, overlaps=None, jobs=None, stats=None,
+                 width=WIDTH_STEPS, height=HEIGHT_STEPS):
+  pipeline = Pipeline(drawingStages(numpy, chord_error, simplify, reorder,
+                                    overlaps, jobs, width, height,
+                                    fused=stats is None))
+  return _steps(pipeline.run(input, stats))
+
+
+# Measure a stage of the conversion, appending a dict to stats['stages']
+# (if stats is given) with its name and wall time in seconds. If
+# stats['trace_memory'] is set and tracemalloc is available, the peak
+# memory the stage allocated is recorded too, in KB; tracing makes
+# everything several times slower, so the times are then only useful
+# relative to each other. The dict is yielded so the caller can add
+# counts such as points_in and points_out.
+@contextlib.contextmanager
+def measureStage(stats, name, points_in=None):
+  stage = {'stage': name}
+  if points_in is not None:
+    stage['points_in'] = points_in
+  if stats is None:
+    yield stage
+    return
+  # Leave tracemalloc alone if someone else is already using it.
+  trace = stats.get('trace_memory') and tracemalloc is not None and \
+      not tracemalloc.is_tracing()
+  if trace:
+    tracemalloc.start()
+  start = time.time()
+  try:
+    yield stage
+  finally:
+    stage['seconds'] = time.time() - start
+    if trace:
+      stage['peak_kb'] = tracemalloc.get_traced_memory()[1] / 1024.0
+      tracemalloc.stop()
+    stats.setdefault('stages', []).append(stage)
+
+
+# The points as a StepArray, if they are not one already.
+def _steps(pts):
+  return pts if isinstance(pts, StepArray) else StepArray(pts)
+
+
+# One step of the conversion, for a Pipeline to chain together. Calling
+# a stage with an iterable of items (G-code lines, GcodeCommands,
+# waypoints or subpaths, as named by takes) returns an iterable of the
+# items it gives. Stages that can work point by point return an
+# iterator; the rest need to see everything first and return a list.
+#
+# After a run, report() returns any counts the stage wants recorded
+# with its measurements, and those named in totals are also added up in
+# the top level of the stats. A stage object keeps these counts, so it
+# should only be used for one run at a time.
+class Stage(object):
+  name = None
+  takes = 'points'
+  gives = 'points'
+  totals = ()
+
+  def __call__(self, items):
+    raise NotImplementedError
+
+  def report(self):
+    return {}
+
+
+# Lines of G-code in, GcodeCommands out (see tokenizeGcode).
+class Tokenize(Stage):
+  name = 'tokenize'
+  takes = 'lines'
+  gives = 'commands'
+  totals = ('lines', 'commands', 'arcs')
+
+  def __call__(self, lines):
+    self.counts = dict.fromkeys(self.totals, 0)
+    return countCommands(tokenizeGcode(countLines(lines, self.counts)),
+                         self.counts)
+
+  def report(self):
+    return dict(self.counts)
+
+
+# GcodeCommands in, waypoints out, with arcs broken up into segments as
+# parseGcode does. With subpaths=True, gives a list of subpaths instead
+# (see parseSubpaths). Only streams the waypoints when the commands do
+# not have to be seen first, i.e. without chord_error or vectorized.
+class ExpandArcs(Stage):
+  name = 'expand'
+  takes = 'commands'
+
+  def __init__(self, chord_error=None, vectorized=False, subpaths=False):
+    self.chord_error = chord_error
+    self.vectorized = vectorized
+    self.subpaths = subpaths
+    self.gives = 'subpaths' if subpaths else 'points'
+
+  def __call__(self, commands):
+    (commands, max_chord) = chordCommands(commands, self.vectorized,
+                                          self.chord_error)
+    if self.subpaths:
+      return expandSubpaths(commands, max_chord, self.vectorized)
+    if self.vectorized:
+      return expandWaypoints(commands, max_chord, vectorized=True)
+    return trimFinalOrigin(itertools.chain.from_iterable(
+        expandCommands(commands, max_chord)))
+
+
+# Lines of G-code in, waypoints (or subpaths) out: Tokenize and
+# ExpandArcs in one, spread over jobs processes (see parallelParse).
+class ParallelParse(Stage):
+  name = 'parse'
+  takes = 'lines'
+  totals = ('lines', 'commands', 'arcs')
+
+  def __init__(self, jobs=None, chord_error=None, subpaths=False):
+    self.jobs = jobs
+    self.chord_error = chord_error
+    self.subpaths = subpaths
+    self.gives = 'subpaths' if subpaths else 'points'
+
+  def __call__(self, lines):
+    self.counts = {}
+    return parallelParse(lines, self.jobs, self.chord_error, self.subpaths,
+                         self.counts)
+
+  def report(self):
+    return dict(self.counts)
+
+
+# Subpaths in, waypoints out, with the subpaths reordered to shorten the
+# travel between them (see orderSubpaths). The travel is reported in
+# steps on a width by height screen, or in G-code units if width is None.
+class Reorder(Stage):
+  name = 'reorder'
+  takes = 'subpaths'
+
+  def __init__(self, width=WIDTH_STEPS, height=HEIGHT_STEPS):
+    self.width = width
+    self.height = height
+
+  def __call__(self, subpaths):
+    subpaths = list(subpaths)
+    waypoints = list(itertools.chain.from_iterable(subpaths))
+    if self.width is None:
+      (scale, units) = (1.0, 'G-code units')
+    else:
+      scale = screenScale(*pointBounds(waypoints), width=self.width,
+                          height=self.height)
+      units = 'steps'
+    before = pathTravel(subpaths)
+    subpaths = orderSubpaths(subpaths)
+    after = pathTravel(subpaths, waypoints[0])
+    print('Reordered %d subpaths: travel %d -> %d %s' %
+          (len(subpaths), before * scale, after * scale, units),
+          file=sys.stderr)
+    self.counts = {'subpaths': len(subpaths), 'travel_before': before * scale,
+                   'travel_after': after * scale, 'travel_units': units}
+    return list(itertools.chain.from_iterable(subpaths))
+
+  def report(self):
+    return dict(self.counts)
+
+
+# Waypoints in G-code units in, stepper positions out: scaled onto a
+# width by height screen (as scaleToScreen) and rounded down to whole
+# steps, as EscherStepper::push does. Needs the bounding box first.
+class Scale(Stage):
+  name = 'scale'
+
+  def __init__(self, width=WIDTH_STEPS, height=HEIGHT_STEPS):
+    self.width = width
+    self.height = height
+
+  def __call__(self, pts):
+    if not hasattr(pts, '__len__'):
+      pts = list(pts)
+    (minx, maxx, miny, maxy) = pointBounds(pts)
+    scale = screenScale(minx, maxx, miny, maxy, self.width, self.height)
+    floor = math.floor
+    return ((int(floor((x-minx) * scale)), int(floor((y-miny) * scale)))
+            for (x, y) in pts)
+
+
+# Scale and Dedup in one faster pass (see scaleToSteps), for when they
+# do not need to be measured separately.
+class ScaleSteps(Stage):
+  name = 'scale'
+
+  def __init__(self, width=WIDTH_STEPS, height=HEIGHT_STEPS):
+    self.width = width
+    self.height = height
+
+  def __call__(self, pts):
+    if not hasattr(pts, '__len__'):
+      pts = list(pts)
+    return scaleToSteps(pts, self.width, self.height)
+
+
+# Drops each point that repeats the one before it.
+class Dedup(Stage):
+  name = 'dedup'
+
+  def __call__(self, pts):
+    self.duplicates = 0
+    return self.dedup(pts)
+
+  def dedup(self, pts):
+    last = None
+    for pt in pts:
+      if pt == last:
+        self.duplicates += 1
+        continue
+      yield pt
+      last = pt
+
+  def report(self):
+    return {'duplicates': self.duplicates}
+
+
+# Drops points while keeping within tolerance of the path (see
+# simplifyPath).
+class Simplify(Stage):
+  name = 'simplify'
+
+  def __init__(self, tolerance):
+    self.tolerance = tolerance
+
+  def __call__(self, pts):
+    pts = _steps(pts)
+    before = len(pts)
+    pts = simplifyPath(pts, self.tolerance)
+    print('Simplified path from %d to %d points (%d removed)' %
+          (before, len(pts), before - len(pts)), file=sys.stderr)
+    return pts
+
+
+# Skips strokes that retrace ones already drawn (see removeOverlaps).
+class RemoveOverlaps(Stage):
+  name = 'overlaps'
+
+  def __init__(self, tolerance):
+    self.tolerance = tolerance
+
+  def __call__(self, pts):
+    pts = _steps(pts)
+    before = pathLength(pts)
+    pts = removeOverlaps(pts, self.tolerance)
+    after = pathLength(pts)
+    print('Removed overlapping strokes: drawing %d -> %d steps (%.1f%% saved)' %
+          (before, after, 100.0 * (before - after) / before if before else 0),
+          file=sys.stderr)
+    self.counts = {'distance_before': before, 'distance_after': after}
+    return pts
+
+  def report(self):
+    return dict(self.counts)
+
+
+# The emitters below write out the stepper positions they are given,
+# passing them on as a StepArray so that several can be chained.
+
+# Writes a header in one of HEADER_FORMATS to out.
+class WriteHeader(Stage):
+  name = 'write'
+
+  def __init__(self, out, format='pairs'):
+    self.out = out
+    self.format = format
+
+  def __call__(self, pts):
+    pts = _steps(pts)
+    HEADER_FORMATS[self.format](pts, self.out)
+    return pts
+
+
+# Plans a speed for each point and writes them to out (see planMotion),
+# reporting the time saved.
+class PlanSpeeds(Stage):
+  name = 'plan'
+
+  def __init__(self, out, max_speed=PLAN_MAX_SPEED,
+               acceleration=PLAN_ACCELERATION,
+               junction_deviation=PLAN_JUNCTION_DEVIATION):
+    self.out = out
+    self.max_speed = max_speed
+    self.acceleration = acceleration
+    self.junction_deviation = junction_deviation
+
+  def __call__(self, pts):
+    pts = _steps(pts)
+    speeds = planMotion(pts, self.max_speed, self.acceleration,
+                        self.junction_deviation)
+    writeSpeedsHeader(speeds, self.out, self.max_speed, self.acceleration)
+    print('Estimated draw time %.0fs -> %.0fs with planning' %
+          (constantSpeedTime(pts),
+           plannedTime(pts, speeds, self.max_speed, self.acceleration)),
+          file=sys.stderr)
+    return pts
+
+
+# Splits the points into chunks of chunk_points (see chunkPoints),
+# writing the table of chunks to out and a manifest to the path
+# manifest (see writeManifest), if they are given.
+class WriteChunks(Stage):
+  name = 'chunks'
+
+  def __init__(self, chunk_points=CHUNK_POINTS, out=None, manifest=None,
+               source=(), options=None):
+    self.chunk_points = chunk_points
+    self.out = out
+    self.manifest = manifest
+    self.source = source
+    self.options = options
+
+  def __call__(self, pts):
+    pts = _steps(pts)
+    if self.manifest:
+      with open(self.manifest, 'w') as f:
+        chunks = writeManifest(pts, f, self.chunk_points, self.source,
+                               self.options)
+    else:
+      chunks = chunkPoints(pts, self.chunk_points)
+    if self.out is not None:
+      writeChunksHeader(chunks, self.out, self.chunk_points)
+    self.chunks = len(chunks)
+    return pts
+
+  def report(self):
+    return {'chunks': self.chunks}
+
+
+# Writes a precompiled drawing file to path (see writeDrawing).
+class WriteDrawing(Stage):
+  name = 'drawing'
+
+  def __init__(self, path, block_size=256, profile='', width=WIDTH_STEPS,
+               height=HEIGHT_STEPS):
+    self.path = path
+    self.block_size = block_size
+    self.profile = profile
+    self.width = width
+    self.height = height
+
+  def __call__(self, pts):
+    pts = _steps(pts)
+    with open(self.path, 'wb') as f:
+      writeDrawing(pts, f, block_size=self.block_size, profile=self.profile,
+                   width=self.width, height=self.height)
+    return pts
+
+
+# Writes a PNG preview to path (see rasterize).
+class WritePng(Stage):
+  name = 'png'
+
+  def __init__(self, path, width=WIDTH_STEPS, height=HEIGHT_STEPS):
+    self.path = path
+    self.width = width
+    self.height = height
+
+  def __call__(self, pts):
+    pts = _steps(pts)
+    writePng(self.path, rasterize(pts, self.width, self.height))
+    return pts
+
+
+# Shows the points in a matplotlib window.
+class ShowPreview(Stage):
+  name = 'preview'
+
+  def __call__(self, pts):
+    pts = _steps(pts)
+    showPreview(pts)
+    return pts
+
+
+# Chains a list of Stages together, feeding each one's output into the
+# next.
+class Pipeline(object):
+  def __init__(self, stages):
+    self.stages = list(stages)
+
+  # Run items through every stage, returning what the last one gives.
+  # Without stats, the stages are simply chained, so stages that stream
+  # run interleaved. If stats is a dict, each stage is instead run to
+  # completion and measured in turn (see measureStage), recording how
+  # many items it took and gave (as e.g. points_in and points_out) along
+  # with its report().
+  def run(self, items, stats=None):
+    for stage in self.stages:
+      if stats is None:
+        items = stage(items)
+        continue
+      with measureStage(stats, stage.name) as record:
+        if hasattr(items, '__len__'):
+          record[stage.takes + '_in'] = len(items)
+        items = stage(items)
+        if not hasattr(items, '__len__'):
+          items = list(items)
+        record[stage.gives + '_out'] = len(items)
+        record.update(stage.report())
+      for key in stage.totals:
+        stats[key] = stats.get(key, 0) + record[key]
+    return items
+
+
+# The stages that parse G-code lines into waypoints in G-code units, as
+# the first half of processGcode. width and height are the screen that
+# Reorder reports its travel on.
+def parseStages(numpy=False, chord_error=None, reorder=False, jobs=None,
+                width=WIDTH_STEPS, height=HEIGHT_STEPS):
+  if jobs is not None:
+    stages = [ParallelParse(jobs, chord_error, subpaths=reorder)]
+  else:
+    stages = [Tokenize(), ExpandArcs(chord_error, numpy, subpaths=reorder)]
+  if reorder:
+    stages.append(Reorder(width, height))
+  return stages
+
+
+# The stages that scale waypoints onto a width by height screen in whole
+# steps and clean them up, as the second half of processGcode. With
+# fused=True, scaling and deduplicating are one ScaleSteps stage.
+def finishStages(simplify=None, overlaps=None, width=WIDTH_STEPS,
+                 height=HEIGHT_STEPS, fused=False):
+  if fused:
+    stages = [ScaleSteps(width, height)]
+  else:
+    stages = [Scale(width, height), Dedup()]
+  if simplify is not None:
+    stages.append(Simplify(simplify))
+  if overlaps is not None:
+    stages.append(RemoveOverlaps(overlaps))
+  return stages
+
+
+# All the stages for processGcode, before any emitters.
+def drawingStages(numpy=False, chord_error=None, simplify=None,
+                  reorder=False, overlaps=None, jobs=None,
+                  width=WIDTH_STEPS, height=HEIGHT_STEPS, fused=False):
+  if chord_error is not None:
+    chord_error = machineChordError(chord_error, [(width, height)])
+  return (parseStages(numpy, chord_error, reorder, jobs, width, height) +
+          finishStages(simplify, overlaps, width, height, fused))
+
+
+# parseGcode measures chord_error in steps at the default WIDTH_STEPS by
+# HEIGHT_STEPS scale. Returns the chord_error to give it so that arcs
+# are fine enough for every one of the (width, height) screens given.
+def machineChordError(chord_error, sizes):
+  return chord_error / max(max(float(w) / WIDTH_STEPS, float(h) / HEIGHT_STEPS)
+                           for (w, h) in sizes)
+
+
+# Read a profiles file: a JSON object with "machines", mapping machine
+# names to their "width" and "height" in steps, and "outputs", a list of
+# levels of detail to write with --lod. Each output has a "name", a
+# "machine", and optionally a "simplify" tolerance in steps, a
+# "max_points" budget and a header "format". Raises ValueError if the
+# file does not make sense.
+def loadProfiles(path):
+  with open(path) as f:
+    profiles = json.load(f)
+  machines = profiles.get('machines', {})
+  for (name, machine) in machines.items():
+    if machine.get('width', 0) <= 0 or machine.get('height', 0) <= 0:
+      raise ValueError('machine %s needs a positive width and height' % name)
+  for output in profiles.get('outputs', []):
+    if output.get('machine') not in machines:
+      raise ValueError('output %s has unknown machine %s' %
+                       (output.get('name'), output.get('machine')))
+    if output.get('max_points') is not None and output['max_points'] < 2:
+      raise ValueError('output %s needs max_points of at least 2' %
+                       output.get('name'))
+    if output.get('format', 'pairs') not in HEADER_FORMATS:
+      raise ValueError('output %s has unknown format %s' %
+                       (output.get('name'), output.get('format')))
+  return profiles
+
+
+# Simplify pts with simplifyPath at tolerance (if any), raising the
+# tolerance as far as needed to get down to max_points (if given).
+# Returns the points and the tolerance used.
+def simplifyToBudget(pts, tolerance=None, max_points=None):
+  if max_points is None or len(pts) <= max_points:
+    if tolerance:
+      pts = simplifyPath(pts, tolerance)
+    return (StepArray(pts), tolerance)
+  thresholds = simplifyThresholds(pts)
+  limit = (tolerance or 0.0) ** 2
+  if sum(1 for t in thresholds if t > limit) > max_points:
+    # Just enough to leave out everything past the budget.
+    limit = sorted(thresholds, reverse=True)[max_points]
+    # Make sure simplifyPath(pts, tolerance) agrees, despite rounding.
+    tolerance = math.sqrt(limit)
+    while tolerance * tolerance < limit:
+      tolerance += tolerance * 2.0 ** -52
+    limit = tolerance * tolerance
+  return (StepArray(pt for (pt, t) in zip(pts, thresholds) if t > limit),
+          tolerance)
+
+
+# Parse some G-code once and write a header for every output in
+# profiles (see loadProfiles) into output_dir, named after prefix and
+# the output. Arcs are interpolated finely enough for the largest
+# machine. overlaps, if given, removes retraced strokes (see
+# removeOverlaps) from every output before it is simplified. If plan is
+# given, as (max_speed, acceleration, junction_deviation), each header
+# also gets a table of speeds (see planMotion). Returns a list of
+# (output, tolerance, waypoints).
+def writeLevelsOfDetail(input, profiles, prefix, output_dir, numpy=False,
+                        chord_error=None, reorder=False, overlaps=None,
+                        jobs=None, plan=None):
+  machines = profiles['machines']
+  outputs = profiles.get('outputs', [])
+  if chord_error is not None:
+    chord_error = machineChordError(
+        chord_error, [(machines[output['machine']]['width'],
+                       machines[output['machine']]['height'])
+                      for output in outputs])
+  # The outputs are for different machines, so report the reordered
+  # travel in G-code units.
+  shared = list(Pipeline(parseStages(numpy, chord_error, reorder, jobs,
+                                     None, None)).run(input))
+  if not os.path.isdir(output_dir):
+    os.makedirs(output_dir)
+  results = []
+  for output in outputs:
+    machine = machines[output['machine']]
+    waypoints = _steps(Pipeline(finishStages(
+        overlaps=overlaps, width=machine['width'],
+        height=machine['height'], fused=True)).run(shared))
+    (waypoints, tolerance) = simplifyToBudget(waypoints,
+                                              output.get('simplify'),
+                                              output.get('max_points'))
+    path = os.path.join(output_dir, '%s-%s.h' % (prefix, output['name']))
+    with open(path, 'w') as f:
+      HEADER_FORMATS[output.get('format', 'pairs')](waypoints, f)
+      if plan is not None:
+        (max_speed, acceleration, junction_deviation) = plan
+        speeds = planMotion(waypoints, max_speed, acceleration,
+                            junction_deviation)
+        writeSpeedsHeader(speeds, f, max_speed, acceleration)
+    results.append((output, tolerance, waypoints))
+  return results
+
+
+# Pass lines through, counting them into stats['lines'].
+def countLines(input, stats):
+  for line in input:
+    stats['lines'] += 1
+    yield line
+
+
+# Pass GcodeCommands through, counting them into stats['commands'] and
+# stats['arcs'].
+def countCommands(commands, stats):
+  for cmd in commands:
+    stats['commands'] += 1
+    if cmd.g >= 2:
+      stats['arcs'] += 1
+    yield cmd
+
+
+# Write waypoints as a table of std::pair<long, long>, one per point.
+def writePairsHeader(waypoints, out):
+  out.write('#define GCODE_NUM_POINTS %d\n' % len(waypoints))
+  out.write('const std::pair<long, long> _GCODE_POINTS[%d] = {\n' % len(waypoints))
+  for (x, y) in waypoints:
+    out.write('  { std::make_pair(%d, %d) },\n' % (x, y))
+  out.write('};\n')
+
+
+# Append n to out as a zigzag-encoded varint: small magnitudes of either
+# sign take a single byte, with 7 bits of payload per byte.
+def writeVarint(n, out):
+  n = (n << 1) ^ (n >> 63)
+  while n >= 0x80:
+    out.append((n & 0x7f) | 0x80)
+    n >>= 7
+  out.append(n)
+
+
+# Read a zigzag varint from data at offset, returning (n, new offset).
+def readVarint(data, offset):
+  n = 0
+  shift = 0
+  while True:
+    b = data[offset]
+    offset += 1
+    n |= (b & 0x7f) << shift
+    shift += 7
+    if b < 0x80:
+      return ((n >> 1) ^ -(n & 1), offset)
+
+
+# Pack waypoints into a compact byte string: the first point followed
+# by the (dx, dy) delta to each following point, all as zigzag varints.
+# Points are truncated to whole steps, as in the pairs header.
+def packPoints(waypoints):
+  out = bytearray()
+  (lastx, lasty) = (0, 0)
+  for (x, y) in waypoints:
+    (x, y) = (int(x), int(y))
+    writeVarint(x - lastx, out)
+    writeVarint(y - lasty, out)
+    (lastx, lasty) = (x, y)
+  return out
+
+
+# Reference decoder for packPoints; returns a list of (x, y) steps.
+def unpackPoints(data):
+  data = bytearray(data)
+  pts = []
+  (x, y) = (0, 0)
+  offset = 0
+  while offset < len(data):
+    (dx, offset) = readVarint(data, offset)
+    (dy, offset) = readVarint(data, offset)
+    x += dx
+    y += dy
+    pts.append((x, y))
+  return pts
+
+
+# Write waypoints as a packPoints() byte array.
+def writePackedHeader(waypoints, out):
+  data = packPoints(waypoints)
+  out.write('#define GCODE_NUM_POINTS %d\n' % len(waypoints))
+  out.write('#define GCODE_PACKED_SIZE %d\n' % len(data))
+  out.write('// First point, then (dx, dy) to each following point, all as\n')
+  out.write('// zigzag varints: 7 bits per byte, least significant first, high\n')
+  out.write('// bit set on all but the last byte; (n >> 1) ^ -(n & 1) decodes.\n')
+  out.write('const uint8_t _GCODE_PACKED[%d] = {\n' % len(data))
+  for i in range(0, len(data), 16):
+    out.write('  %s,\n' % ', '.join(['0x%02x' % b for b in data[i:i+16]]))
+  out.write('};\n')
+
+
+# Precompiled drawing files, for copying to SPIFFS in place of G-code.
+# All fields are little-endian:
+#
+#   header  'ESCD', version (u16), block size in points (u16),
+#           point count (u32), block count (u32), width and height
+#           steps (u16 each), bounding box minx, maxx, miny, maxy in
+#           steps (i32 each), profile name (16 bytes, NUL padded)
+#   index   byte offset of each block from the start of the file (u32)
+#   blocks  packPoints() of each run of block size points, so every
+#           block starts with an absolute position
+DRAWING_MAGIC = b'ESCD'
+DRAWING_VERSION = 1
+DRAWING_PROFILE_BYTES = 16
+# Largest block size, width or height the header's u16 fields can hold.
+DRAWING_MAX_U16 = 0xffff
+DRAWING_HEADER = struct.Struct('<4sHHIIHHiiii%ds' % DRAWING_PROFILE_BYTES)
+
+DrawingHeader = collections.namedtuple('DrawingHeader',
+    'version block_size num_points num_blocks width height '
+    'minx maxx miny maxy profile offsets')
+
+
+# Write waypoints to out (a binary file) as a precompiled drawing. Raises
+# ValueError if profile does not fit in the header.
+def writeDrawing(waypoints, out, block_size=256, profile='',
+                 width=WIDTH_STEPS, height=HEIGHT_STEPS):
+  name = profile.encode('ascii')
+  if len(name) > DRAWING_PROFILE_BYTES:
+    raise ValueError('Profile name %s is longer than %d bytes' %
+                     (profile, DRAWING_PROFILE_BYTES))
+  if not 1 <= block_size <= DRAWING_MAX_U16:
+    raise ValueError('Block size %d is not between 1 and %d' %
+                     (block_size, DRAWING_MAX_U16))
+  if not (0 <= width <= DRAWING_MAX_U16 and 0 <= height <= DRAWING_MAX_U16):
+    raise ValueError('Drawing size %dx%d does not fit in the header' %
+                     (width, height))
+  pts = [(int(x), int(y)) for (x, y) in waypoints]
+  blocks = [packPoints(pts[i:i+block_size])
+            for i in range(0, len(pts), block_size)]
+  (minx, maxx, miny, maxy) = pointBounds(pts) if pts else (0, 0, 0, 0)
+  offset = DRAWING_HEADER.size + 4 * len(blocks)
+  offsets = []
+  for block in blocks:
+    offsets.append(offset)
+    offset += len(block)
+  out.write(DRAWING_HEADER.pack(DRAWING_MAGIC, DRAWING_VERSION, block_size,
+                                len(pts), len(blocks), width, height,
+                                minx, maxx, miny, maxy, name))
+  out.write(struct.pack('<%dI' % len(offsets), *offsets))
+  for block in blocks:
+    out.write(bytes(block))
+
+
+# Read the header and block index of a drawing file.
+def readDrawingHeader(f):
+  fields = DRAWING_HEADER.unpack(f.read(DRAWING_HEADER.size))
+  if fields[0] != DRAWING_MAGIC:
+    raise ValueError('Not an Escher drawing file')
+  if fields[1] != DRAWING_VERSION:
+    raise ValueError('Unsupported drawing version %d' % fields[1])
+  num_blocks = fields[4]
+  offsets = struct.unpack('<%dI' % num_blocks, f.read(4 * num_blocks))
+  profile = fields[11].rstrip(b'\0').decode('ascii')
+  return DrawingHeader(*(fields[1:11] + (profile, offsets)))
+
+
+# Read the points in one block of a drawing file, seeking straight to it.
+def readDrawingBlock(f, header, block):
+  start = header.offsets[block]
+  if block + 1 < header.num_blocks:
+    end = header.offsets[block + 1]
+  else:
+    f.seek(0, os.SEEK_END)
+    end = f.tell()
+  f.seek(start)
+  return unpackPoints(f.read(end - start))
+
+
+# Read a whole drawing file, returning (header, points).
+def readDrawing(f):
+  header = readDrawingHeader(f)
+  pts = []
+  for block in range(header.num_blocks):
+    pts += readDrawingBlock(f, header, block)
+  return (header, pts)
+
+
+# CRC-32 of pts as little-endian int32 x, y pairs (as the firmware holds
+# them), continuing from crc if given.
+def pointsChecksum(pts, crc=0):
+  flat = [int(v) for pt in pts for v in pt]
+  return zlib.crc32(struct.pack('<%di' % len(flat), *flat), crc) & 0xffffffff
+
+
+# Split waypoints into chunks of chunk_points, so that a drawing can be
+# restarted from the start of any chunk. Returns a list of dicts, each
+# with the chunk's index, the first of waypoints it holds and how many,
+# the position it draws from (the end of the chunk before, or its own
+# first point), where it ends, and the pointsChecksum of its points.
+def chunkPoints(waypoints, chunk_points=CHUNK_POINTS):
+  pts = [(int(x), int(y)) for (x, y) in waypoints]
+  chunks = []
+  for first in range(0, len(pts), chunk_points):
+    run = pts[first:first+chunk_points]
+    chunks.append({
+      'index': len(chunks),
+      'first': first,
+      'count': len(run),
+      'start': list(pts[first-1] if first else run[0]),
+      'end': list(run[-1]),
+      'crc32': pointsChecksum(run),
+    })
+  return chunks
+
+
+# Write the chunks from chunkPoints as a table to go with the points.
+def writeChunksHeader(chunks, out, chunk_points=CHUNK_POINTS):
+  out.write('#define GCODE_CHUNK_POINTS %d\n' % chunk_points)
+  out.write('#define GCODE_NUM_CHUNKS %d\n' % len(chunks))
+  out.write('// Each chunk of _GCODE_POINTS: its first point, the position it\n')
+  out.write('// draws from, and the CRC-32 of its points as int32 x, y pairs.\n')
+  out.write('const struct { uint32_t first; long x, y; uint32_t crc; } '
+            '_GCODE_CHUNKS[%d] = {\n' % len(chunks))
+  for chunk in chunks:
+    out.write('  { %d, %d, %d, 0x%08x },\n' %
+              (chunk['first'], chunk['start'][0], chunk['start'][1],
+               chunk['crc32']))
+  out.write('};\n')
+
+
+# Write a JSON manifest of the chunks of waypoints to out, with each
+# chunk's points in packPoints format (base64-encoded) so that a host
+# can stream the drawing from any chunk without the G-code. source and
+# options (the processGcode arguments) are recorded so that the points
+# can be checked against the G-code later (see verifyManifest).
+def writeManifest(waypoints, out, chunk_points=CHUNK_POINTS, source=(),
+                  options=None):
+  pts = [(int(x), int(y)) for (x, y) in waypoints]
+  chunks = chunkPoints(pts, chunk_points)
+  for chunk in chunks:
+    data = packPoints(pts[chunk['first']:chunk['first']+chunk['count']])
+    chunk['data'] = base64.b64encode(bytes(data)).decode('ascii')
+  json.dump({
+    'version': MANIFEST_VERSION,
+    'source': list(source),
+    'options': options or {},
+    'points': len(pts),
+    'chunk_points': chunk_points,
+    'crc32': pointsChecksum(pts),
+    'chunks': chunks,
+  }, out, indent=1, sort_keys=True)
+  return chunks
+
+
+# The points of one chunk of a manifest, checked against its count,
+# end and checksum. Raises ValueError if they do not match.
+def manifestChunk(manifest, index):
+  chunk = manifest['chunks'][index]
+  pts = unpackPoints(base64.b64decode(chunk['data']))
+  if len(pts) != chunk['count'] or not pts or \
+      pts[-1] != tuple(chunk['end']) or pointsChecksum(pts) != chunk['crc32']:
+    raise ValueError('chunk %d is damaged' % index)
+  return pts
+
+
+# Replay every chunk of a manifest in order, checking that each one is
+# intact and starts where the one before it left off, and that together
+# they make up the whole drawing. Returns the points; raises ValueError
+# at the first thing wrong.
+def replayManifest(manifest):
+  if manifest.get('version') != MANIFEST_VERSION:
+    raise ValueError('unknown manifest version %r' % manifest.get('version'))
+  pts = []
+  crc = 0
+  for (index, chunk) in enumerate(manifest['chunks']):
+    if chunk['index'] != index or chunk['first'] != len(pts):
+      raise ValueError('chunk %d is out of place' % index)
+    run = manifestChunk(manifest, index)
+    if tuple(chunk['start']) != (pts[-1] if pts else run[0]):
+      raise ValueError('chunk %d does not start where chunk %d ends' %
+                       (index, index - 1))
+    crc = pointsChecksum(run, crc)
+    pts += run
+  if len(pts) != manifest['points'] or crc != manifest['crc32']:
+    raise ValueError('chunks make %d points (CRC %08x), not %d (CRC %08x)' %
+                     (len(pts), crc, manifest['points'], manifest['crc32']))
+  return pts
+
+
+# The points to send to pick a drawing back up at the start of chunk
+# index: the position that chunk draws from, then everything from that
+# chunk on.
+def resumePoints(manifest, index):
+  pts = []
+  for i in range(index, len(manifest['chunks'])):
+    pts += manifestChunk(manifest, i)
+  if index > 0:
+    pts.insert(0, tuple(manifest['chunks'][index]['start']))
+  return pts
+
+
+# Check a manifest: replay its chunks (see replayManifest) and, if the
+# G-code lines it was made from are given, check that they still give
+# the same points. Returns the points; raises ValueError if anything
+# does not match.
+def verifyManifest(manifest, input=None):
+  pts = replayManifest(manifest)
+  if input is not None:
+    expected = processGcode(input, **manifest['options'])
+    if list(expected) != pts:
+      raise ValueError('chunks do not match the G-code (%d points, not %d)' %
+                       (len(pts), len(expected)))
+  return pts
+
+
+HEADER_FORMATS = {
+  'pairs': writePairsHeader,
+  'packed': writePackedHeader,
+}
+
+
+# Stream the lines of a file through a read-only memory map, so that
+# they are paged in from disk rather than read into memory up front.
+def mappedLines(path):
+  with open(path, 'rb') as f:
+    if os.fstat(f.fileno()).st_size == 0:
+      return
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      for line in iter(mm.readline, b''):
+        yield line.decode('ascii', 'replace')
+    finally:
+      mm.close()
+
+
+# Drop the (0, 0) point that the Inkscape GCode plugin tacks on at the
+# end of a stream of waypoints, as parseGcode does.
+def trimFinalOrigin(pts):
+  prev = None
+  for pt in pts:
+    if prev is not None:
+      yield prev
+    prev = pt
+  if prev is not None and prev != (0., 0.):
+    yield prev
+
+
+# Convert a G-code file to a pairs header in constant memory, however
+# large the input. The first pass over the file finds only the bounding
+# box; the second parses, scales, removes duplicates and writes each
+# point as it goes. With chord_error, an extra first pass finds the
+# exact geometry bounds needed to size the arc segments.
+#
+# The points written are the same as for processGcode, but as the
+# count is only known at the end, GCODE_NUM_POINTS follows the table.
+def streamGcode(path, out, chord_error=None, width=WIDTH_STEPS,
+                height=HEIGHT_STEPS):
+  max_chord = None
+  if chord_error is not None:
+    chord_error = machineChordError(chord_error, [(width, height)])
+    scale = screenScale(*commandBounds(tokenizeGcode(mappedLines(path))))
+    max_chord = chord_error / scale
+
+  def waypoints():
+    return trimFinalOrigin(itertools.chain.from_iterable(
+        expandCommands(tokenizeGcode(mappedLines(path)), max_chord)))
+
+  (minx, maxx, miny, maxy) = pointBounds(waypoints())
+  scale = screenScale(minx, maxx, miny, maxy, width, height)
+
+  count = 0
+  prev = None
+  floor = math.floor
+  out.write('const std::pair<long, long> _GCODE_POINTS[] = {\n')
+  for (x, y) in waypoints():
+    point = (int(floor((x-minx) * scale)), int(floor((y-miny) * scale)))
+    if point != prev:
+      prev = point
+      out.write('  { std::make_pair(%d, %d) },\n' % point)
+      count += 1
+  out.write('};\n')
+  out.write('#define GCODE_NUM_POINTS %d\n' % count)
+  return count
+
+
+# Draw waypoints in a matplotlib window. matplotlib is only imported
+# here, as it is slow to load and needs a display.
+def showPreview(waypoints):
+  import matplotlib.pyplot as plt
+  xes = [x for (x, y) in waypoints]
+  yes = [y for (x, y) in waypoints]
+  plt.plot(xes, yes)
+  plt.gca().set_aspect('equal')
+  plt.show()
+
+
+# Draw a line from (x0, y0) to (x1, y1) into a bytearray image with
+# Bresenham's algorithm.
+def drawLine(pixels, width, x0, y0, x1, y1):
+  dx = abs(x1 - x0)
+  dy = -abs(y1 - y0)
+  sx = 1 if x0 < x1 else -1
+  sy = 1 if y0 < y1 else -1
+  err = dx + dy
+  while True:
+    pixels[y0 * width + x0] = 0
+    if x0 == x1 and y0 == y1:
+      return
+    e2 = 2 * err
+    if e2 >= dy:
+      err += dy
+      x0 += sx
+    if e2 <= dx:
+      err += dx
+      y0 += sy
+
+
+# Rasterize waypoints, in steps, into an 8-bit grayscale image one pixel
+# per step, drawn black on white with y pointing up as on the
+# Etch-a-Sketch. The image covers at least width x height steps, growing
+# to fit any points beyond that. Returns (pixels, width, height) with
+# pixels as a bytearray of rows from the top. With vectorized=True (the
+# default when numpy is available) every segment is drawn at once.
+def rasterize(waypoints, width=WIDTH_STEPS, height=HEIGHT_STEPS, margin=4,
+              vectorized=(np is not None)):
+  if not vectorized:
+    pts = [(max(int(x), 0), max(int(y), 0)) for (x, y) in waypoints]
+    if pts:
+      (_, maxx, _, maxy) = pointBounds(pts)
+      (width, height) = (max(width, maxx), max(height, maxy))
+    (w, h) = (width + 1 + 2 * margin, height + 1 + 2 * margin)
+    pts = [(x + margin, height - y + margin) for (x, y) in pts]
+    pixels = bytearray(b'\xff' * (w * h))
+    for ((x0, y0), (x1, y1)) in zip(pts, pts[1:]):
+      drawLine(pixels, w, x0, y0, x1, y1)
+    if len(pts) == 1:
+      drawLine(pixels, w, pts[0][0], pts[0][1], pts[0][0], pts[0][1])
+    return (pixels, w, h)
+
+  pts = np.maximum(np.array(waypoints, dtype=float).reshape(-1, 2), 0).astype(np.int64)
+  if len(pts):
+    (width, height) = (max(width, pts[:, 0].max()), max(height, pts[:, 1].max()))
+  (w, h) = (width + 1 + 2 * margin, height + 1 + 2 * margin)
+  pts[:, 0] += margin
+  pts[:, 1] = height - pts[:, 1] + margin
+  image = np.full((h, w), 255, dtype=np.uint8)
+  if len(pts) > 1:
+    # Step along the longer axis of each segment, one pixel at a time.
+    (p0, d) = (pts[:-1], np.diff(pts, axis=0))
+    steps = np.abs(d).max(axis=1)
+    seg = np.repeat(np.arange(len(d)), steps + 1)
+    i = np.arange(len(seg)) - np.repeat(np.cumsum(steps + 1) - (steps + 1), steps + 1)
+    t = i / np.maximum(steps[seg], 1).astype(float)
+    xs = np.rint(p0[seg, 0] + t * d[seg, 0]).astype(np.int64)
+    ys = np.rint(p0[seg, 1] + t * d[seg, 1]).astype(np.int64)
+    image[ys, xs] = 0
+  image[pts[:, 1], pts[:, 0]] = 0
+  return (bytearray(image.tobytes()), int(w), int(h))
+
+
+# Write a (pixels, width, height) grayscale image as a PNG file.
+def writePng(path, image):
+  (pixels, width, height) = image
+  def chunk(kind, data):
+    return (struct.pack('>I', len(data)) + kind + data +
+            struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+  # Each row is preceded by its filter type, 0 (none).
+  raw = bytearray()
+  for row in range(height):
+    raw.append(0)
+    raw += pixels[row * width:(row + 1) * width]
+  with open(path, 'wb') as f:
+    f.write(b'\x89PNG\r\n\x1a\n')
+    f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)))
+    f.write(chunk(b'IDAT', zlib.compress(bytes(raw), 6)))
+    f.write(chunk(b'IEND', b''))
+
+
+# Options that change the compiled output, and so form part of the
+# batch cache key along with the machine's width and height.
+BATCH_OPTIONS = ('numpy', 'chord_error', 'simplify', 'reorder',
+                 'remove_overlaps', 'format', 'plan', 'max_speed',
+                 'acceleration', 'junction_deviation')
+
+
+# Cache key for compiling data (the raw G-code) with options: a hash of
+# the input, the options and this script, so that changes to any of
+# them invalidate the cached result.
+def cacheKey(data, options):
+  h = hashlib.sha1()
+  with open(os.path.abspath(__file__).replace('.pyc', '.py'), 'rb') as f:
+    h.update(f.read())
+  h.update(json.dumps(options, sort_keys=True).encode('utf-8'))
+  h.update(data)
+  return h.hexdigest()
+
+
+_replace = getattr(os, 'replace', os.rename)
+
+
+# Write a file through a uniquely named temporary file next to path,
+# moving it into place only once it is complete. An interrupted run
+# never leaves a partial file behind, and workers writing the same path
+# at once cannot trip over each other's temporary files.
+@contextlib.contextmanager
+def replaceFile(path):
+  (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                               prefix=os.path.basename(path) + '.',
+                               suffix='.tmp')
+  try:
+    with os.fdopen(fd, 'w') as f:
+      yield f
+    _replace(tmp, path)
+  except BaseException:
+    os.remove(tmp)
+    raise
+
+
+# The summary of a finished cache entry (see compileFile) for path, with
+# its header copied to output, or None if the entry is not there yet.
+def cachedSummary(cached, path, output, start):
+  if not os.path.exists(cached + '.json'):
+    return None
+  with open(cached + '.json') as f:
+    summary = json.load(f)
+  shutil.copyfile(cached + '.h', output)
+  # Files with the same contents share an entry.
+  summary['file'] = os.path.basename(path)
+  summary['cached'] = True
+  summary['seconds'] = time.time() - start
+  return summary
+
+
+# Compile one G-code file for compileBatch, returning its summary. Runs
+# in a worker process, so takes a single tuple argument.
+def compileFile(job):
+  (path, options, output_dir, cache_dir) = job
+  start = time.time()
+  name = os.path.splitext(os.path.basename(path))[0]
+  output = os.path.join(output_dir, name + '.h')
+  with open(path, 'rb') as f:
+    data = f.read()
+  key = cacheKey(data, options)
+  cached = os.path.join(cache_dir, key)
+
+  summary = cachedSummary(cached, path, output, start)
+  if summary is not None:
+    return summary
+
+  stats = {}
+  lines = data.decode('utf-8', 'replace').splitlines(True)
+  waypoints = processGcode(lines, numpy=options['numpy'],
+                           chord_error=options['chord_error'],
+                           simplify=options['simplify'],
+                           reorder=options['reorder'],
+                           overlaps=options['remove_overlaps'],
+                           width=options['width'], height=options['height'],
+                           stats=stats)
+  # Another worker may have compiled the same contents meanwhile.
+  summary = cachedSummary(cached, path, output, start)
+  if summary is not None:
+    return summary
+  # The header goes in before the summary, so an entry with a summary is
+  # always complete.
+  with measureStage(stats, 'write', len(waypoints)):
+    with replaceFile(cached + '.h') as f:
+      HEADER_FORMATS[options['format']](waypoints, f)
+      if options['plan']:
+        speeds = planMotion(waypoints, options['max_speed'],
+                            options['acceleration'],
+                            options['junction_deviation'])
+        writeSpeedsHeader(speeds, f, options['max_speed'],
+                          options['acceleration'])
+  summary = {
+    'file': os.path.basename(path),
+    'lines': stats['lines'],
+    'arcs': stats['arcs'],
+    'points': len(waypoints),
+    'compile_seconds': time.time() - start,
+    'stages': stats['stages'],
+  }
+  with replaceFile(cached + '.json') as f:
+    json.dump(summary, f)
+  shutil.copyfile(cached + '.h', output)
+  summary['cached'] = False
+  summary['seconds'] = time.time() - start
+  return summary
+
+
+# Compile every *.gcode file in directory to a header in output_dir,
+# using a pool of jobs worker processes. Results are cached in cache_dir
+# by cacheKey, so unchanged drawings are skipped. Returns a list of
+# per-file summaries, which is also written to output_dir/summary.json.
+def compileBatch(directory, options, output_dir=None, cache_dir=None, jobs=None):
+  output_dir = output_dir or directory
+  cache_dir = cache_dir or os.path.join(output_dir, '.gcoderip-cache')
+  for d in (output_dir, cache_dir):
+    if not os.path.isdir(d):
+      os.makedirs(d)
+  paths = sorted(glob.glob(os.path.join(directory, '*.gcode')))
+  work = [(path, options, output_dir, cache_dir) for path in paths]
+  pool = multiprocessing.Pool(jobs)
+  try:
+    summaries = pool.map(compileFile, work, chunksize=1)
+  finally:
+    pool.close()
+    pool.join()
+  with open(os.path.join(output_dir, 'summary.json'), 'w') as f:
+    json.dump(summaries, f, indent=2, sort_keys=True)
+  return summaries
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Convert G-code into a header of stepper positions.')
+  parser.add_argument('--numpy', action='store_true',
+                      help='Expand arcs in one vectorized batch (needs numpy)')
+  parser.add_argument('--chord-error', type=float, metavar='STEPS',
+                      help='Split arcs adaptively, keeping each chord within '
+                           'this many steps of the true curve')
+  parser.add_argument('--simplify', type=float, metavar='STEPS',
+                      help='Drop points while keeping the path within this '
+                           'many steps of the original')
+  parser.add_argument('--remove-overlaps', type=float, metavar='STEPS',
+                      help='Skip strokes that retrace ones already drawn, to '
+                           'within this many steps')
+  parser.add_argument('--reorder', action='store_true',
+                      help='Reorder subpaths to shorten the strokes drawn '
+                           'between them')
+  parser.add_argument('--format', choices=sorted(HEADER_FORMATS), default='pairs',
+                      help='Header format: a std::pair table, or a compact '
+                           'delta-encoded byte array')
+  parser.add_argument('--drawing', metavar='FILE',
+                      help='Also write a precompiled drawing file for SPIFFS')
+  parser.add_argument('--block-size', type=int, default=256, metavar='POINTS',
+                      help='Points per seekable block in the drawing file')
+  parser.add_argument('--batch', metavar='DIR',
+                      help='Compile every *.gcode file in DIR to a header, in '
+                           'parallel, skipping unchanged files')
+  parser.add_argument('--output-dir', metavar='DIR',
+                      help='Where --batch and --lod write headers (default: '
+                           'the input directory)')
+  parser.add_argument('--cache-dir', metavar='DIR',
+                      help='Where --batch caches results (default: '
+                           '.gcoderip-cache in the output directory)')
+  parser.add_argument('--jobs', type=int, metavar='N',
+                      help='Number of --batch worker processes (default: one '
+                           'per CPU); without --batch, parse the input in '
+                           'this many processes')
+  parser.add_argument('--stream', action='store_true',
+                      help='Convert a single file in constant memory (pairs '
+                           'format only; no --numpy, --reorder or --simplify)')
+  parser.add_argument('--preview', action='store_true',
+                      help='Show the result in a matplotlib window')
+  parser.add_argument('--png', metavar='FILE',
+                      help='Write a PNG preview of the result')
+  parser.add_argument('--profiles', default=PROFILES, metavar='FILE',
+                      help='Machine profiles and levels of detail (default: '
+                           'profiles.json next to this script)')
+  parser.add_argument('--machine', metavar='NAME',
+                      help='Scale for this machine from --profiles, instead '
+                           'of the built-in %dx%d steps' %
+                           (WIDTH_STEPS, HEIGHT_STEPS))
+  parser.add_argument('--lod', action='store_true',
+                      help='Parse once and write a header for every output in '
+                           '--profiles into --output-dir')
+  parser.add_argument('--stats', metavar='FILE',
+                      help='Write the time, memory and point counts of each '
+                           'stage to FILE as JSON')
+  parser.add_argument('--stats-memory', action='store_true',
+                      help='Also record the peak memory of each stage in '
+                           '--stats (slow)')
+  parser.add_argument('--plan', action='store_true',
+                      help='Plan a speed for each point and write them out as '
+                           '_GCODE_SPEEDS')
+  parser.add_argument('--max-speed', type=float, default=PLAN_MAX_SPEED,
+                      metavar='STEPS/S', help='Top speed for --plan')
+  parser.add_argument('--acceleration', type=float, default=PLAN_ACCELERATION,
+                      metavar='STEPS/S^2', help='Acceleration for --plan')
+  parser.add_argument('--junction-deviation', type=float,
+                      default=PLAN_JUNCTION_DEVIATION, metavar='STEPS',
+                      help='Corner speed tolerance for --plan')
+  parser.add_argument('--chunks', type=int, metavar='POINTS',
+                      help='Also write a table splitting the points into '
+                           'chunks of this many, each with its start '
+                           'position and checksum, so a drawing can be '
+                           'resumed (default with --manifest: %d)' %
+                           CHUNK_POINTS)
+  parser.add_argument('--manifest', metavar='FILE',
+                      help='Write the chunks and their points to FILE as '
+                           'JSON, for resuming from the host')
+  parser.add_argument('--verify', metavar='MANIFEST',
+                      help='Instead of converting, check that the chunks in '
+                           'MANIFEST rebuild the drawing (and match the '
+                           'G-code files, if any are given)')
+  parser.add_argument('--fit-arcs', type=float, metavar='MM',
+                      help='Instead of a header, write out G-code with runs of '
+                           'short lines replaced by arcs, within this many '
+                           'G-code units of the original')
+  parser.add_argument('files', nargs='*',
+                      help='G-code files to read (default: stdin)')
+  args = parser.parse_args()
+  if args.numpy and np is None:
+    parser.error('--numpy requires numpy to be installed')
+  if args.numpy and args.jobs and not args.batch:
+    parser.error('--jobs cannot be combined with --numpy')
+  if args.chunks is not None and args.chunks < 1:
+    parser.error('--chunks needs at least 1 point per chunk')
+  # _GCODE_CHUNKS indexes _GCODE_POINTS, and the packed deltas run on
+  # from one chunk into the next, so there is nowhere to resume from.
+  if args.chunks and args.format == 'packed':
+    parser.error('--chunks needs --format pairs')
+  # The drawing header only has room for a short machine name.
+  if (args.drawing and args.machine and
+      len(args.machine.encode('utf-8')) > DRAWING_PROFILE_BYTES):
+    parser.error('--drawing needs a --machine name of at most %d bytes' %
+                 DRAWING_PROFILE_BYTES)
+  if not 1 <= args.block_size <= DRAWING_MAX_U16:
+    parser.error('--block-size must be between 1 and %d' % DRAWING_MAX_U16)
+  if args.simplify is not None and args.simplify <= 0:
+    parser.error('--simplify must be greater than 0')
+  if args.chord_error is not None and args.chord_error <= 0:
+    parser.error('--chord-error must be greater than 0')
+  if args.remove_overlaps is not None and args.remove_overlaps <= 0:
+    parser.error('--remove-overlaps must be greater than 0')
+  if args.fit_arcs is not None and args.fit_arcs <= 0:
+    parser.error('--fit-arcs must be greater than 0')
+
+  # Complain about flags that a mode such as --stream cannot honour.
+  def reject(mode, flags):
+    for (flag, given) in flags:
+      if given:
+        parser.error('%s cannot be combined with %s' % (flag, mode))
+
+  # Give up on input with nothing to draw, rather than a traceback.
+  def fail(e, name=None):
+    print('%s: %s' % (name or ' '.join(args.files) or '<stdin>', e),
+          file=sys.stderr)
+    sys.exit(1)
+
+  if args.verify:
+    try:
+      with open(args.verify) as f:
+        manifest = json.load(f)
+      pts = verifyManifest(manifest, fileinput.input(args.files)
+                           if args.files else None)
+    except (IOError, ValueError, KeyError) as e:
+      print('%s: FAILED: %s' % (args.verify, e), file=sys.stderr)
+      sys.exit(1)
+    print('%s: OK, %d chunks rebuild %d points%s' %
+          (args.verify, len(manifest['chunks']), len(pts),
+           ', matching %s' % ' '.join(args.files) if args.files else ''),
+          file=sys.stderr)
+    return
+
+  (width, height) = (WIDTH_STEPS, HEIGHT_STEPS)
+  if args.machine or args.lod:
+    try:
+      profiles = loadProfiles(args.profiles)
+    except (IOError, ValueError) as e:
+      parser.error('bad --profiles file %s: %s' % (args.profiles, e))
+    if args.machine:
+      if args.machine not in profiles['machines']:
+        parser.error('unknown --machine %s (choose from %s)' %
+                     (args.machine, ', '.join(sorted(profiles['machines']))))
+      machine = profiles['machines'][args.machine]
+      (width, height) = (machine['width'], machine['height'])
+      if args.drawing and max(width, height) > DRAWING_MAX_U16:
+        parser.error('--drawing needs a --machine at most %d steps across' %
+                     DRAWING_MAX_U16)
+
+  if args.lod:
+    if len(args.files) != 1:
+      parser.error('--lod needs exactly one input file')
+    # Each output in --profiles names its own machine, tolerance and
+    # format.
+    reject('--lod', [('--fit-arcs', args.fit_arcs is not None),
+                     ('--machine', args.machine),
+                     ('--simplify', args.simplify is not None),
+                     ('--format packed', args.format != 'pairs'),
+                     ('--drawing', args.drawing),
+                     ('--png', args.png),
+                     ('--preview', args.preview),
+                     ('--chunks', args.chunks),
+                     ('--manifest', args.manifest),
+                     ('--stats', args.stats)])
+    prefix = os.path.splitext(os.path.basename(args.files[0]))[0]
+    plan = None
+    if args.plan:
+      plan = (args.max_speed, args.acceleration, args.junction_deviation)
+    output_dir = args.output_dir or os.path.dirname(args.files[0]) or '.'
+    try:
+      results = writeLevelsOfDetail(fileinput.input(args.files), profiles,
+                                    prefix, output_dir, numpy=args.numpy,
+                                    chord_error=args.chord_error,
+                                    reorder=args.reorder,
+                                    overlaps=args.remove_overlaps,
+                                    jobs=args.jobs, plan=plan)
+    except ValueError as e:
+      fail(e)
+    print('%-24s %-14s %10s %10s' % ('output', 'machine', 'tolerance',
+                                      'points'), file=sys.stderr)
+    for (output, tolerance, waypoints) in results:
+      print('%-24s %-14s %10s %10d' %
+            (output['name'], output['machine'],
+             '-' if tolerance is None else '%.2f' % tolerance,
+             len(waypoints)), file=sys.stderr)
+    return
+
+  if args.batch:
+    reject('--batch', [('--fit-arcs', args.fit_arcs is not None),
+                       ('--drawing', args.drawing),
+                       ('--png', args.png), ('--preview', args.preview),
+                       ('--chunks', args.chunks),
+                       ('--manifest', args.manifest),
+                       ('--stats', args.stats)])
+    options = dict((name, getattr(args, name)) for name in BATCH_OPTIONS)
+    options.update(width=width, height=height)
+    try:
+      summaries = compileBatch(args.batch, options, args.output_dir,
+                               args.cache_dir, args.jobs)
+    except ValueError as e:
+      fail(e, args.batch)
+    print('%-24s %8s %8s %8s %8s %s' %
+          ('file', 'lines', 'arcs', 'points', 'seconds', ''), file=sys.stderr)
+    for s in summaries:
+      print('%-24s %8d %8d %8d %8.2f %s' %
+            (s['file'], s['lines'], s['arcs'], s['points'], s['seconds'],
+             'cached' if s['cached'] else ''), file=sys.stderr)
+    return
+
+  if args.stream:
+    if len(args.files) != 1:
+      parser.error('--stream needs exactly one input file')
+    reject('--stream', [('--fit-arcs', args.fit_arcs is not None),
+                        ('--numpy', args.numpy),
+                        ('--reorder', args.reorder),
+                        ('--simplify', args.simplify is not None),
+                        ('--remove-overlaps', args.remove_overlaps is not None),
+                        ('--format packed', args.format != 'pairs'),
+                        ('--drawing', args.drawing),
+                        ('--plan', args.plan),
+                        ('--png', args.png),
+                        ('--preview', args.preview),
+                        ('--chunks', args.chunks),
+                        ('--manifest', args.manifest),
+                        ('--stats', args.stats)])
+    try:
+      streamGcode(args.files[0], sys.stdout, chord_error=args.chord_error,
+                  width=width, height=height)
+    except ValueError as e:
+      fail(e)
+    return
+
+  if args.fit_arcs is not None:
+    # Arc fitting writes G-code rather than a header, so none of the
+    # step-space options apply.
+    reject('--fit-arcs', [('--numpy', args.numpy),
+                          ('--reorder', args.reorder),
+                          ('--simplify', args.simplify is not None),
+                          ('--remove-overlaps',
+                           args.remove_overlaps is not None),
+                          ('--format packed', args.format != 'pairs'),
+                          ('--drawing', args.drawing),
+                          ('--machine', args.machine),
+                          ('--jobs', args.jobs),
+                          ('--plan', args.plan),
+                          ('--png', args.png),
+                          ('--preview', args.preview),
+                          ('--chunks', args.chunks),
+                          ('--manifest', args.manifest),
+                          ('--stats', args.stats)])
+    lines = list(fileinput.input(args.files))
+    fitted = []
+    worst = 0.0
+    for path in parseSubpaths(lines, chord_error=args.chord_error):
+      (commands, dev) = fitArcs(path, args.fit_arcs)
+      fitted.append((path[0], commands))
+      worst = max(worst, dev)
+    out = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+    writeFittedGcode(fitted, out, args.fit_arcs)
+    output = out.getvalue()
+    sys.stdout.write(output)
+    (in_bytes, out_bytes) = (sum(len(l) for l in lines), len(output))
+    out_lines = output.count('\n')
+    # An empty input has nothing to compare against.
+    def ratio(new, old):
+      return '%.1f%%' % (100.0 * new / old) if old else '-'
+    print('%d -> %d lines (%s), %d -> %d bytes (%s), max deviation %.4f' %
+          (len(lines), out_lines, ratio(out_lines, len(lines)),
+           in_bytes, out_bytes, ratio(out_bytes, in_bytes), worst),
+          file=sys.stderr)
+    return
+
+  # Parse and process the input file, and write out the output.
+  stages = drawingStages(numpy=args.numpy, chord_error=args.chord_error,
+                         simplify=args.simplify, reorder=args.reorder,
+                         overlaps=args.remove_overlaps, jobs=args.jobs,
+                         width=width, height=height,
+                         fused=args.stats is None)
+  stages.append(WriteHeader(sys.stdout, args.format))
+  if args.chunks or args.manifest:
+    options = {'numpy': args.numpy, 'chord_error': args.chord_error,
+               'simplify': args.simplify, 'reorder': args.reorder,
+               'overlaps': args.remove_overlaps, 'width': width,
+               'height': height}
+    stages.append(WriteChunks(args.chunks or CHUNK_POINTS,
+                              sys.stdout if args.chunks else None,
+                              args.manifest, args.files, options))
+  if args.plan:
+    stages.append(PlanSpeeds(sys.stdout, args.max_speed, args.acceleration,
+                             args.junction_deviation))
+  if args.drawing:
+    stages.append(WriteDrawing(args.drawing, args.block_size,
+                               args.machine or '', width, height))
+  if args.png:
+    stages.append(WritePng(args.png, width, height))
+  if args.preview:
+    stages.append(ShowPreview())
+
+  stats = {'trace_memory': args.stats_memory} if args.stats else None
+  start = time.time()
+  try:
+    waypoints = Pipeline(stages).run(fileinput.input(args.files), stats)
+  except ValueError as e:
+    fail(e)
+  if args.stats:
+    stats.update(files=args.files, points=len(waypoints),
+                 seconds=time.time() - start,
+                 options=dict((name, getattr(args, name)) for name in
+                              BATCH_OPTIONS + ('jobs', 'machine')))
+    with open(args.stats, 'w') as f:
+      json.dump(stats, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+  main()
@@ -1,77 +1,644 @@
 #!/usr/bin/python
 
-import serial
+# This script plots where the Escher is drawing, live, from the lines
+# it prints over serial:
+#
+#   MDW x y tx ty
+#
+# where (x, y) is the current stepper position and (tx, ty) the
+# position it is heading for. The actual path is drawn in black and
+# the target path in blue. Any other lines are ignored.
+#
+# With --binary, the records are read as fixed-size binary frames
+# instead, which take half the bytes and much less work to decode:
+#
+#   0xA5 0x5A                 sync bytes
+#   x, y, tx, ty (int16)      little-endian
+#   crc    (uint8)            CRC-8 (polynomial 0x07, starting at 0)
+#                             of the eight bytes of x..ty
+#
+# A frame that fails its CRC is skipped and the next sync bytes
+# searched for, so the stream recovers from noise or dropped bytes.
+#
+# --record saves everything read from the port, with when it arrived,
+# and --replay plays a recording back in place of the port, in real
+# time or --speed times faster, so a session can be looked at again or
+# the plotting benchmarked without the Escher attached.
+#
+#   ./serialplot.py --record session.escr
+#   ./serialplot.py --replay session.escr --speed 10
+#
+# The serial port is read on its own thread, which hands batches of
+# records to the window through a bounded queue. The window is redrawn
+# at a fixed frame rate, drawing everything that arrived since the last
+# frame in one go, so a slow redraw never holds up reading the port.
+
+from __future__ import division, print_function
+
+import argparse
+import re
+import struct
+import sys
+import threading
 import time
 
-from graphics import *
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+try:
+  import serial
+except ImportError:
+  serial = None
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
 
 WIDTH = 700
 HEIGHT = 500
 
-curx = 0
-cury = HEIGHT
-curtx = 0
-curty = HEIGHT
+PORT = '/dev/cu.SLAB_USBtoUART'
+BAUD = 2000000
 
-win = GraphWin("serialplot", WIDTH, HEIGHT)
+# A whole MDW line, matched straight out of SerialReader's buffer.
+MDW_RECORD = re.compile(br'^MDW[ \t]+(-?\d+)[ \t]+(-?\d+)[ \t]+(-?\d+)'
+                        br'[ \t]+(-?\d+)[ \t\r]*$', re.M)
+# The start of any MDW line, whether or not it parses.
+MDW_LINE = re.compile(br'^MDW', re.M)
 
-def update_plot(xes, yes):
-  pass
+# Longest line worth keeping while waiting for its newline.
+MAX_LINE = 4096
 
-def processLine(line):
-  global curx, cury, curtx, curty
-  global win
+# Binary frames (see --binary).
+FRAME_SYNC = b'\xa5\x5a'
+FRAME = struct.Struct('<2shhhhB')
 
-  if line.startswith('MDW '):
-    try:
-      vals = line.split()
-      x = int(vals[1])
-      y = int(vals[2])
-      tx = int(vals[3])
-      ty = int(vals[4])
-      if (x > WIDTH):
-        x = WIDTH
-      if (y > HEIGHT):
-        y = HEIGHT
-      if (tx > WIDTH):
-        tx = WIDTH
-      if (ty > HEIGHT):
-        ty = HEIGHT
-
-      y = HEIGHT - y  # Flip upside down
-      ty = HEIGHT - ty  # Flip upside down
-
-      ln = Line(Point(curx, cury), Point(x, y))
-      ln.draw(win)
-      curx = x
-      cury = y
-
-      ln2 = Line(Point(curtx, curty), Point(tx, ty))
-      ln2.setOutline("blue")
-      ln2.draw(win)
-      curtx = tx
-      curty = ty
 
+def _crc8Table(poly=0x07):
+  table = []
+  for byte in range(256):
+    crc = byte
+    for _ in range(8):
+      crc = ((crc << 1) ^ poly if crc & 0x80 else crc << 1) & 0xff
+    table.append(crc)
+  return table
+
+CRC8_TABLE = _crc8Table()
+
+
+# Batches of records the reader thread can get ahead of the window by
+# before it starts dropping them, and the window's frame rate.
+QUEUE_BATCHES = 256
+FPS = 30
+
+# Points in each polyline on the canvas before a new one is started.
+POLYLINE_POINTS = 2000
+
+
+# Reads MDW records from a serial port (or anything with read(), such
+# as a pty or a file) in bulk. Each poll() reads as much as is waiting
+# into a reusable buffer and returns every complete record in it as an
+# (x, y, tx, ty) tuple, keeping any partial line for next time. Lines
+# are found and parsed in place with MDW_RECORD, rather than built up a
+# byte at a time. MDW lines that do not parse are counted in bad.
+class SerialReader(object):
+  def __init__(self, port, chunk_size=65536):
+    self.port = port
+    self.chunk = bytearray(chunk_size)
+    self.view = memoryview(self.chunk)
+    self.buf = bytearray()
+    self.reads = 0
+    self.bytes = 0
+    self.records = 0
+    self.bad = 0
+
+  # Read whatever is waiting on the port into the buffer, waiting (up to
+  # the port's timeout) for at least one byte. Returns the number of
+  # bytes read.
+  def fill(self):
+    size = len(self.chunk)
+    waiting = getattr(self.port, 'in_waiting', None)
+    if waiting is not None:
+      size = min(max(waiting, 1), size)
+    if hasattr(self.port, 'readinto'):
+      n = self.port.readinto(self.view[:size]) or 0
+      self.buf += self.view[:n]
+    else:
+      data = self.port.read(size)
+      n = len(data)
+      self.buf += data
+    self.reads += 1
+    self.bytes += n
+    return n
+
+  # Take the complete records out of the buffer.
+  def takeRecords(self):
+    end = self.buf.rfind(b'\n') + 1
+    if not end:
+      if len(self.buf) > MAX_LINE:
+        # Line noise; no sense keeping it.
+        self.bad += len(MDW_LINE.findall(self.buf))
+        del self.buf[:]
+      return []
+    found = MDW_RECORD.findall(self.buf, 0, end)
+    self.bad += len(MDW_LINE.findall(self.buf, 0, end)) - len(found)
+    del self.buf[:end]
+    self.records += len(found)
+    return [(int(x), int(y), int(tx), int(ty)) for (x, y, tx, ty) in found]
+
+  def poll(self):
+    self.fill()
+    return self.takeRecords()
+
+
+# CRC-8 of some bytes, as used in binary frames.
+def crc8(data):
+  crc = 0
+  for byte in bytearray(data):
+    crc = CRC8_TABLE[crc ^ byte]
+  return crc
+
+
+# Encode (x, y, tx, ty) records as the binary frames --binary reads. This
+# is a host-side encoder for synthetic and test streams; Escher.ino still
+# only prints MDW lines, and sending these frames from the firmware is not
+# part of this.
+def encodeFrames(records):
+  out = bytearray()
+  for record in records:
+    frame = FRAME.pack(FRAME_SYNC, *(record + (0,)))
+    out += frame[:-1]
+    out.append(crc8(frame[2:-1]))
+  return bytes(out)
+
+
+# Decode up to count back-to-back frames from buf at offset, stopping at
+# the first that has the wrong sync bytes or CRC. Returns the records of
+# the good ones.
+def decodeFrames(buf, offset, count):
+  if np is not None:
+    return _decodeFramesNumpy(buf, offset, count)
+  records = []
+  for i in range(offset, offset + count * FRAME.size, FRAME.size):
+    (sync, x, y, tx, ty, crc) = FRAME.unpack_from(buf, i)
+    if sync != FRAME_SYNC or crc8(buf[i+2:i+FRAME.size-1]) != crc:
+      break
+    records.append((x, y, tx, ty))
+  return records
+
+
+FRAME_DTYPE = None if np is None else np.dtype(
+    [('sync', 'V2'), ('x', '<i2'), ('y', '<i2'), ('tx', '<i2'),
+     ('ty', '<i2'), ('crc', 'u1')])
+CRC8_ARRAY = None if np is None else np.array(CRC8_TABLE, dtype=np.uint8)
+
+
+# decodeFrames with numpy, checking every frame's CRC at once.
+def _decodeFramesNumpy(buf, offset, count):
+  raw = np.frombuffer(buf, dtype=np.uint8, count=count * FRAME.size,
+                      offset=offset).reshape(count, FRAME.size)
+  crc = np.zeros(count, dtype=np.uint8)
+  for k in range(2, FRAME.size - 1):
+    crc = CRC8_ARRAY[crc ^ raw[:, k]]
+  good = (raw[:, 0] == bytearray(FRAME_SYNC)[0]) & \
+      (raw[:, 1] == bytearray(FRAME_SYNC)[1]) & (crc == raw[:, -1])
+  if not good.all():
+    count = int(np.argmin(good))
+  frames = np.frombuffer(buf, dtype=FRAME_DTYPE, count=count, offset=offset)
+  return [tuple(record) for record in
+          frames[['x', 'y', 'tx', 'ty']].tolist()]
+
+
+# A SerialReader for binary frames. Frames that fail their CRC are
+# counted in bad, and bytes skipped looking for sync bytes in skipped.
+class FrameReader(SerialReader):
+  def __init__(self, port, chunk_size=65536):
+    SerialReader.__init__(self, port, chunk_size)
+    self.skipped = 0
+
+  def takeRecords(self):
+    buf = self.buf
+    records = []
+    pos = 0
+    while True:
+      start = buf.find(FRAME_SYNC, pos)
+      if start < 0:
+        # Keep a trailing first sync byte, in case the second is next.
+        end = len(buf) - 1 if buf[-1:] == FRAME_SYNC[:1] else len(buf)
+        self.skipped += end - pos
+        pos = end
+        break
+      self.skipped += start - pos
+      count = (len(buf) - start) // FRAME.size
+      if not count:
+        pos = start
+        break
+      found = decodeFrames(buf, start, count)
+      records += found
+      pos = start + len(found) * FRAME.size
+      if len(found) < count and buf[pos:pos+2] == FRAME_SYNC:
+        # A bad frame: look for the next sync bytes after its own.
+        self.bad += 1
+        self.skipped += 1
+        pos += 1
+    del buf[:pos]
+    self.records += len(records)
+    return records
+
+
+# Recorded sessions (see SessionWriter).
+SESSION_MAGIC = b'ESCR\x01'
+
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
+def _writeUvarint(n, out):
+  while n >= 0x80:
+    out.append((n & 0x7f) | 0x80)
+    n >>= 7
+  out.append(n)
+
+
+# Read an unsigned varint from a file, or None at the end of the file.
+def _readUvarint(f):
+  (n, shift) = (0, 0)
+  while True:
+    b = f.read(1)
+    if not b:
+      if shift:
+        raise EOFError('recording ends in the middle of a chunk')
+      return None
+    byte = bytearray(b)[0]
+    n |= (byte & 0x7f) << shift
+    if not byte & 0x80:
+      return n
+    shift += 7
+
+
+# Writes the bytes read from a port to a binary file f, for replaying
+# later with ReplayPort. After SESSION_MAGIC, each chunk of bytes is
+# stored as the microseconds since the chunk before (or the start of
+# the recording) and its length, both as varints, then the bytes.
+class SessionWriter(object):
+  def __init__(self, f):
+    self.f = f
+    self.f.write(SESSION_MAGIC)
+    self.start = None
+    self.micros = 0
+
+  # Record data as arriving now, or at time t (in seconds, on the same
+  # clock as the rest of the recording).
+  def write(self, data, t=None):
+    if t is None:
+      t = _monotonic()
+    if self.start is None:
+      self.start = t
+    micros = max(int(round((t - self.start) * 1e6)), self.micros)
+    entry = bytearray()
+    _writeUvarint(micros - self.micros, entry)
+    _writeUvarint(len(data), entry)
+    self.f.write(bytes(entry))
+    self.f.write(bytes(data))
+    self.micros = micros
+
+  def close(self):
+    self.f.close()
+
+
+# Read the chunks of a recorded session from a binary file f, yielding
+# (seconds into the session, bytes) for each.
+def readSession(f):
+  if f.read(len(SESSION_MAGIC)) != SESSION_MAGIC:
+    raise ValueError('not a serialplot recording')
+  t = 0.0
+  while True:
+    delay = _readUvarint(f)
+    if delay is None:
+      return
+    t += delay / 1e6
+    size = _readUvarint(f)
+    data = f.read(size) if size is not None else b''
+    if size is None or len(data) != size:
+      raise EOFError('recording ends in the middle of a chunk')
+    yield (t, data)
+
+
+# Passes reads through to port, recording everything read with a
+# SessionWriter.
+class RecordingPort(object):
+  def __init__(self, port, writer):
+    self.port = port
+    self.writer = writer
+
+  @property
+  def in_waiting(self):
+    return getattr(self.port, 'in_waiting', None)
+
+  def read(self, size=1):
+    data = self.port.read(size)
+    if data:
+      self.writer.write(data)
+    return data
+
+  def close(self):
+    self.port.close()
+    self.writer.close()
+
+
+# Stands in for a serial port, playing back a session recorded by
+# SessionWriter from the file at path. Bytes become readable when they
+# arrived in the recording, sped up speed times; with a speed of 0 they
+# are all readable at once. Once everything has been read, done is set
+# and reads wait timeout seconds and return nothing, as a quiet serial
+# port would.
+class ReplayPort(object):
+  def __init__(self, path, speed=1.0, timeout=0.5):
+    self.f = open(path, 'rb')
+    self.chunks = readSession(self.f)
+    self.speed = speed
+    self.timeout = timeout
+    self.start = None
+    self.pending = b''
+    self.done = False
+
+  def read(self, size=1):
+    if not self.pending:
+      try:
+        (t, self.pending) = next(self.chunks)
+      except StopIteration:
+        self.done = True
+        time.sleep(self.timeout)
+        return b''
+      if self.start is None:
+        self.start = _monotonic() - (t / self.speed if self.speed else 0)
+      if self.speed:
+        delay = self.start + t / self.speed - _monotonic()
+        if delay > 0:
+          time.sleep(delay)
+    (data, self.pending) = (self.pending[:size], self.pending[size:])
+    return data
+
+  def close(self):
+    self.f.close()
+
+
+# Where a stepper position goes in the window: clipped to the window
+# and flipped, since the window's y axis points down.
+def screenPoint(x, y):
+  return (min(x, WIDTH), HEIGHT - min(y, HEIGHT))
+
+
+# One path drawn on a Tk canvas as a few long polyline items, rather
+# than an item per segment, so the canvas stays small however long the
+# drawing runs. extend() adds points to the end of the current item with
+# a single coords() call; once it has max_points, a new item is started
+# from its last point.
+class Trace(object):
+  def __init__(self, canvas, start, color, max_points=POLYLINE_POINTS):
+    self.canvas = canvas
+    self.color = color
+    self.max_points = max_points
+    self.item = None
+    self.coords = list(start)
+    self.items = 0
+
+  def extend(self, points):
+    while points:
+      room = self.max_points - len(self.coords) // 2
+      for (x, y) in points[:room]:
+        self.coords += (x, y)
+      points = points[room:]
+      if self.item is None:
+        self.item = self.canvas.create_line(*self.coords, fill=self.color)
+        self.items += 1
+      else:
+        self.canvas.coords(self.item, *self.coords)
+      if len(self.coords) // 2 >= self.max_points:
+        self.item = None
+        self.coords = self.coords[-2:]
+
+  # Where the path has got to.
+  def end(self):
+    return tuple(self.coords[-2:])
+
+
+# Draws the records from a SerialReader onto a Tk canvas (such as a
+# graphics.GraphWin) as two Traces: the actual path in black and the
+# target path in blue. Nothing is flushed to the screen; see Renderer.
+class Plotter(object):
+  def __init__(self, canvas, max_points=POLYLINE_POINTS):
+    self.actual = Trace(canvas, (0, HEIGHT), "black", max_points)
+    self.target = Trace(canvas, (0, HEIGHT), "blue", max_points)
+
+  def plot(self, records):
+    self.actual.extend([screenPoint(x, y) for (x, y, tx, ty) in records])
+    self.target.extend([screenPoint(tx, ty) for (x, y, tx, ty) in records])
+
+
+# Polls a SerialReader on its own thread, putting each batch of records
+# on the queue pending. If the queue is full the batch is dropped, rather than
+# holding up the port; overflows counts how often, and dropped how many
+# records were lost. With block, it waits for room instead, which suits a
+# ReplayPort: nothing is lost however fast the replay runs. max_depth is the
+# most batches ever waiting.
+class ReaderThread(threading.Thread):
+  def __init__(self, reader, pending, block=False):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.reader = reader
+    self.queue = pending
+    self.block = block
+    self.running = True
+    self.batches = 0
+    self.overflows = 0
+    self.dropped = 0
+    self.max_depth = 0
+
+  def run(self):
+    while self.running:
+      records = self.reader.poll()
+      if not records:
+        continue
+      if self.block:
+        self.putBlocking(records)
+      else:
+        try:
+          self.queue.put_nowait(records)
+          self.batches += 1
+        except queue.Full:
+          self.overflows += 1
+          self.dropped += len(records)
+      self.max_depth = max(self.max_depth, self.queue.qsize())
+
+  # Wait for room on the queue, checking now and then that stop() has
+  # not been called.
+  def putBlocking(self, records):
+    while self.running:
+      try:
+        self.queue.put(records, timeout=0.1)
+        self.batches += 1
+        return
+      except queue.Full:
+        pass
+
+  # Ask the thread to finish, which it does after its current poll().
+  def stop(self):
+    self.running = False
+
+
+# Draws whatever records are waiting on the queue pending with a
+# Plotter, then calls flush once to put them on the screen, fps times a second.
+class Renderer(object):
+  def __init__(self, plotter, pending, flush, fps=FPS):
+    self.plotter = plotter
+    self.queue = pending
+    self.flush = flush
+    self.interval = 1.0 / fps
+    self.deadline = None
+    self.frames = 0
+    self.records = 0
+    self.late = 0
+    self.frame_seconds = 0.0
+    self.worst_frame = 0.0
+
+  # Draw one frame, returning the number of records drawn.
+  def frame(self):
+    start = time.time()
+    records = []
+    while True:
+      try:
+        records += self.queue.get_nowait()
+      except queue.Empty:
+        break
+    self.plotter.plot(records)
+    self.flush()
+    elapsed = time.time() - start
+    self.frames += 1
+    self.records += len(records)
+    self.frame_seconds += elapsed
+    self.worst_frame = max(self.worst_frame, elapsed)
+    return len(records)
+
+  # Draw a frame and wait until the next one is due. A frame that runs
+  # over is counted in late, and the next starts straight away.
+  def tick(self):
+    if self.deadline is None:
+      self.deadline = time.time()
+    self.frame()
+    self.deadline += self.interval
+    delay = self.deadline - time.time()
+    if delay > 0:
+      time.sleep(delay)
+    else:
+      self.late += 1
+      self.deadline = time.time()
+
+
+# A line of counters from a ReaderThread and Renderer that have been
+# running for seconds.
+def statusLine(thread, renderer, seconds):
+  frames = max(renderer.frames, 1)
+  return ('%d records/s read, %d drawn, %d frames (%d late, avg %.1fms, '
+          'worst %.1fms), queue %d (max %d), %d dropped in %d overflows' %
+          (thread.reader.records / seconds, renderer.records / seconds,
+           renderer.frames, renderer.late,
+           1000.0 * renderer.frame_seconds / frames,
+           1000.0 * renderer.worst_frame, thread.queue.qsize(),
+           thread.max_depth, thread.dropped, thread.overflows))
+
+
+# Open the serial port, waiting for it to turn up.
+def openPort(path, baud):
+  if serial is None:
+    sys.exit('serialplot.py needs pyserial (pip install pyserial)')
+  while True:
+    try:
+      return serial.Serial(path, baud, timeout=0.5)
     except Exception as e:
-      print 'Problem plotting line: ' + line,
-      print e
-
-ser = None
-while ser == None:
-  try:
-    ser = serial.Serial('/dev/cu.SLAB_USBtoUART', 2000000, timeout=10)
-  except Exception as e:
-    print 'Waiting for serial port...'
-    print e
-    time.sleep(1)
-    ser = None
-
-curline = ''
-while True:
-  c = ser.read()
-  curline += c
-  if c == '\n':
-    line = curline
-    curline = ''
-    processLine(line)
+      print('Waiting for serial port...')
+      print(e)
+      time.sleep(1)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Plot the Escher\'s position as it draws.')
+  parser.add_argument('--port', metavar='PATH',
+                      help='Serial port the Escher is on (default: %s)' %
+                           PORT)
+  parser.add_argument('--baud', type=int, default=BAUD,
+                      help='Serial baud rate')
+  parser.add_argument('--binary', action='store_true',
+                      help='Read binary frames rather than MDW lines')
+  parser.add_argument('--fps', type=float, default=FPS,
+                      help='Frames per second to redraw at')
+  parser.add_argument('--queue', type=int, default=QUEUE_BATCHES,
+                      metavar='BATCHES',
+                      help='Batches of records to buffer for the window '
+                           'before dropping them')
+  parser.add_argument('--record', metavar='FILE',
+                      help='Also save everything read to FILE, to replay '
+                           'later')
+  parser.add_argument('--replay', metavar='FILE',
+                      help='Play back a --record file instead of reading '
+                           'the serial port')
+  parser.add_argument('--speed', type=float, default=1.0, metavar='N',
+                      help='Replay N times faster than it was recorded '
+                           '(0 for as fast as possible)')
+  parser.add_argument('--stats-every', type=float, default=5.0,
+                      metavar='SECONDS',
+                      help='How often to print the counters (0 for never)')
+  args = parser.parse_args()
+  if args.fps <= 0:
+    parser.error('--fps must be positive')
+  if args.queue < 1:
+    parser.error('--queue must be at least 1')
+  if args.speed < 0:
+    parser.error('--speed must not be negative')
+  if args.stats_every < 0:
+    parser.error('--stats-every must not be negative')
+  if args.replay and args.port:
+    parser.error('--port cannot be combined with --replay')
+
+  replay = None
+  if args.replay:
+    port = replay = ReplayPort(args.replay, args.speed)
+  else:
+    port = openPort(args.port or PORT, args.baud)
+  if args.record:
+    port = RecordingPort(port, SessionWriter(open(args.record, 'wb')))
+
+  import graphics
+  win = graphics.GraphWin("serialplot", WIDTH, HEIGHT, autoflush=False)
+  records = queue.Queue(args.queue)
+  reader = (FrameReader if args.binary else SerialReader)(port)
+  thread = ReaderThread(reader, records, block=replay is not None)
+  renderer = Renderer(Plotter(win), records, graphics.update, args.fps)
+  thread.start()
+  bad = 0
+  start = last = time.time()
+  while not win.isClosed():
+    renderer.tick()
+    if thread.reader.bad != bad:
+      print('Skipped %d %s' % (thread.reader.bad - bad,
+                               'frames with bad CRCs' if args.binary else
+                               'MDW lines that did not parse'))
+      bad = thread.reader.bad
+    now = time.time()
+    if args.stats_every and now - last >= args.stats_every:
+      print(statusLine(thread, renderer, now - start))
+      last = now
+    if replay and replay.done and records.empty():
+      print('Replay finished after %.1fs' % (now - start))
+      print(statusLine(thread, renderer, now - start))
+      replay = None
+  thread.stop()
+  thread.join()
+  port.close()
+
 
+if __name__ == '__main__':
+  main()